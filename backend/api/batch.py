@@ -0,0 +1,73 @@
+from django.db import transaction
+
+from foodgram_backend.signals import relations_added, relations_removed
+from recipes.models import DataVersion
+
+CREATED = 'created'
+EXISTS = 'exists'
+DELETED = 'deleted'
+ABSENT = 'absent'
+NOT_FOUND = 'not_found'
+SELF = 'self'
+
+
+def batch_add(model, user, targets, ids):
+    """Создаёт связи пользователя с объектами одним INSERT.
+
+    Статусы и relations_added строятся по строкам, которые вернул
+    INSERT ... RETURNING, поэтому параллельные запросы с теми же id
+    не сообщают о создании дважды. Возвращает словарь id → статус.
+    """
+    with transaction.atomic():
+        found = set(targets.filter(id__in=ids).values_list('id', flat=True))
+        created = set(model.relations.add_many(
+            user, [pk for pk in ids if pk in found],
+        ))
+        if created:
+            DataVersion.objects.bump(DataVersion.viewer(user.id))
+            relations_added.send(
+                sender=model, user=user,
+                target_ids=[pk for pk in ids if pk in created],
+            )
+    return {
+        pk: NOT_FOUND if pk not in found
+        else CREATED if pk in created else EXISTS
+        for pk in ids
+    }
+
+
+def batch_remove(model, user, targets, ids):
+    """Удаляет связи пользователя с объектами одним DELETE.
+
+    Статусы и relations_removed строятся по строкам, которые вернул
+    DELETE ... RETURNING. Существование остальных объектов проверяется
+    отдельным запросом. Возвращает словарь id → статус.
+    """
+    with transaction.atomic():
+        deleted = set(model.relations.remove_many(user, ids))
+        if deleted:
+            # Сигналы post_delete не отправляются: версия зрителя
+            # обновляется, а relations_removed отправляется один раз
+            # на всю пачку.
+            DataVersion.objects.bump(DataVersion.viewer(user.id))
+            relations_removed.send(
+                sender=model, user=user,
+                target_ids=[pk for pk in ids if pk in deleted],
+            )
+    rest = [pk for pk in ids if pk not in deleted]
+    found = set(
+        targets.filter(id__in=rest).values_list('id', flat=True)
+    ) if rest else set()
+    return {
+        pk: DELETED if pk in deleted
+        else ABSENT if pk in found else NOT_FOUND
+        for pk in ids
+    }
+
+
+def get_batch_results(statuses):
+    return {
+        'results': [
+            {'id': pk, 'status': status} for pk, status in statuses.items()
+        ]
+    }
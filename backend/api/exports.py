@@ -0,0 +1,97 @@
+import csv
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+from recipes.models import ShoppingListItem
+
+
+class Echo:
+    """Буфер для csv.writer, возвращающий записанную строку."""
+
+    def write(self, value):
+        return value
+
+
+def get_shopping_list(user):
+    """Итоговый список покупок, читаемый с сервера порциями."""
+    return (
+        ShoppingListItem.objects.filter(user=user)
+        .values('ingredient__name', 'ingredient__measurement_unit', 'amount')
+        .order_by('ingredient__name')
+        .iterator(chunk_size=settings.SHOPPING_LIST_CHUNK_SIZE)
+    )
+
+
+def export_txt(items):
+    for item in items:
+        yield (
+            f"{item['ingredient__name']}\t{item['amount']}\t"
+            f"{item['ingredient__measurement_unit']} \n"
+        )
+
+
+def export_csv(items):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('name', 'amount', 'measurement_unit'))
+    for item in items:
+        yield writer.writerow((
+            item['ingredient__name'],
+            item['amount'],
+            item['ingredient__measurement_unit'],
+        ))
+
+
+def export_json(items):
+    separator = ''
+    yield '['
+    for item in items:
+        yield separator + json.dumps({
+            'name': item['ingredient__name'],
+            'amount': item['amount'],
+            'measurement_unit': item['ingredient__measurement_unit'],
+        }, ensure_ascii=False)
+        separator = ','
+    yield ']'
+
+
+EXPORT_FORMATS = {
+    'txt': ('text/plain; charset=utf-8', export_txt),
+    'csv': ('text/csv; charset=utf-8', export_csv),
+    'json': ('application/json', export_json),
+}
+
+
+def stream_export(chunks, cache_key):
+    """Склеивает строки в блоки и кэширует небольшой результат.
+
+    Накопление для кэша прекращается, как только размер выгрузки
+    превышает SHOPPING_LIST_CACHE_MAX_SIZE, поэтому память
+    ограничена независимо от размера корзины.
+    """
+    block_size = settings.SHOPPING_LIST_BLOCK_SIZE
+    max_size = settings.SHOPPING_LIST_CACHE_MAX_SIZE
+    block, block_length, parts, size = [], 0, [], 0
+    for chunk in chunks:
+        chunk = chunk.encode()
+        block.append(chunk)
+        block_length += len(chunk)
+        if block_length >= block_size:
+            data = b''.join(block)
+            block, block_length = [], 0
+            size += len(data)
+            if parts is not None and size <= max_size:
+                parts.append(data)
+            else:
+                parts = None
+            yield data
+    data = b''.join(block)
+    size += len(data)
+    if parts is not None and size <= max_size:
+        cache.set(
+            cache_key, b''.join(parts) + data,
+            settings.SHOPPING_LIST_CACHE_TIMEOUT,
+        )
+    if data:
+        yield data
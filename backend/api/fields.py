@@ -30,3 +30,23 @@ class Hex2NameColor(serializers.Field):
         except ValueError:
             raise serializers.ValidationError('Для этого цвета нет имени')
         return data
+
+
+class DimensionPrimaryKeyField(serializers.PrimaryKeyRelatedField):
+    """Первичный ключ справочника, проверяемый по кэшу в памяти."""
+
+    def __init__(self, dimension, **kwargs):
+        self.dimension = dimension
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            pk = int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        obj = self.dimension.get(pk, self.context)
+        if obj is None:
+            self.fail('does_not_exist', pk_value=data)
+        return obj
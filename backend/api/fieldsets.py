@@ -0,0 +1,37 @@
+from rest_framework import serializers
+
+
+def get_requested_fields(request, field_names):
+    """Поля ответа с учётом параметров запроса ?fields= и ?omit=."""
+    field_names = list(field_names)
+    if request is None:
+        return field_names
+    fields = request.query_params.get('fields')
+    if fields:
+        fields = set(fields.split(','))
+        field_names = [name for name in field_names if name in fields]
+    omit = request.query_params.get('omit')
+    if omit:
+        omit = set(omit.split(','))
+        field_names = [name for name in field_names if name not in omit]
+    return field_names
+
+
+class SparseFieldsetMixin:
+    """Сокращённый набор полей для сериализатора верхнего уровня.
+
+    Вложенные сериализаторы (например, автор рецепта) не сокращаются.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if not self.is_root():
+            return fields
+        requested = get_requested_fields(self.context.get('request'), fields)
+        return {name: fields[name] for name in requested}
+
+    def is_root(self):
+        return self.parent is None or (
+            isinstance(self.parent, serializers.ListSerializer)
+            and self.parent.parent is None
+        )
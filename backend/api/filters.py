@@ -1,10 +1,73 @@
 from django import forms
+from django.conf import settings
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            TrigramSimilarity)
+from django.db import connections
+from django.db.models import (Case, Exists, F, IntegerField, OuterRef, Q,
+                              Value, When)
 
 import django_filters
+from api.viewer import CART, FAVORITES, get_viewer
 from django_filters import rest_framework
-from foodgram_backend.constants import FILTER_VALUE
-from recipes.models import Ingredient, Recipe
-from rest_framework import exceptions
+from foodgram_backend.constants import (FILTER_VALUE, MAX_BATCH_SIZE,
+                                        MAX_INLINE_IDS, SEARCH_CONFIG)
+from recipes.ingredient_index import recipe_ingredient_index
+from recipes.models import DataVersion, Ingredient, Recipe, RecipeIngredient
+from rest_framework import exceptions, filters
+
+
+def search_by_name(queryset, value):
+    """Поиск по названию с ранжированием.
+
+    Названия, начинающиеся с value, идут первыми. Отбор одинаков на всех
+    СУБД (icontains, на PostgreSQL его обслуживает триграммный индекс
+    по UPPER(name), если в value не меньше трёх символов; более короткие
+    запросы читают таблицу целиком), на PostgreSQL остальные совпадения
+    дополнительно сортируются по триграммной похожести.
+    """
+    default_ordering = queryset.query.order_by
+    queryset = queryset.filter(name__icontains=value).annotate(
+        name_rank=Case(
+            When(name__istartswith=value, then=Value(0)),
+            default=Value(1),
+            output_field=IntegerField(),
+        ),
+    )
+    if connections[queryset.db].vendor != 'postgresql':
+        return queryset.order_by('name_rank', *default_ordering)
+    return queryset.annotate(
+        name_similarity=TrigramSimilarity('name', value),
+    ).order_by('name_rank', '-name_similarity', *default_ordering)
+
+
+def filter_by_viewer(queryset, request, relation, lookup):
+    """Рецепты из избранного или корзины пользователя запроса.
+
+    Небольшое множество id из ViewerContext подставляется в IN, для
+    больших и незагруженных остаётся соединение по lookup.
+    """
+    ids = get_viewer(request).get_ids(relation)
+    if ids is not None and len(ids) <= MAX_INLINE_IDS:
+        return queryset.filter(pk__in=list(ids))
+    return queryset.filter(**{lookup: request.user})
+
+
+def order_by_ids(queryset, ids):
+    """Выборка рецептов из ids в порядке их следования."""
+    return queryset.filter(id__in=ids).order_by(Case(
+        *[When(id=pk, then=position) for position, pk in enumerate(ids)],
+        output_field=IntegerField(),
+    ))
+
+
+class NameSearchFilter(filters.SearchFilter):
+    """Поиск рецептов по названию (параметр search)."""
+
+    def filter_queryset(self, request, queryset, view):
+        value = request.query_params.get(self.search_param, '').strip()
+        if not value:
+            return queryset
+        return search_by_name(queryset, value)
 
 
 class NonValidatingTagChoiceField(forms.MultipleChoiceField):
@@ -12,17 +75,41 @@ class NonValidatingTagChoiceField(forms.MultipleChoiceField):
         pass
 
 
-class NonValidatingTagFilter(django_filters.AllValuesMultipleFilter):
+class TagSlugFilter(django_filters.MultipleChoiceFilter):
     field_class = NonValidatingTagChoiceField
 
 
+class IntegerInFilter(django_filters.BaseInFilter, django_filters.Filter):
+    """Список целых через запятую, дробные значения дают 400."""
+
+    field_class = forms.IntegerField
+
+
 class RecipeFilter(rest_framework.FilterSet):
     """Фильтрация рецептов.
 
     По Тегам, Автору, Избранным рецептам и рецептам в Корзине покупок.
     """
 
-    tags = NonValidatingTagFilter(field_name='tags__slug')
+    ids = IntegerInFilter(method='filter_ids', label='Рецепты по id')
+    q = django_filters.CharFilter(
+        method='filter_q', label='Полнотекстовый поиск',
+    )
+    has_ingredients = IntegerInFilter(
+        method='filter_has_ingredients',
+        label='Рецепты из имеющихся ингредиентов',
+    )
+    missing_max = django_filters.NumberFilter(
+        method='filter_missing_max',
+        min_value=0,
+        label='Сколько ингредиентов может не хватать',
+    )
+    tags = TagSlugFilter(method='filter_tags', label='Теги')
+    tags_mode = django_filters.ChoiceFilter(
+        method='filter_tags_mode',
+        choices=(('any', 'Любой из тегов'), ('all', 'Все теги')),
+        label='Режим фильтра по тегам',
+    )
     is_favorited = django_filters.NumberFilter(
         method='filter_is_favorited',
         label='В избранном',
@@ -34,7 +121,63 @@ class RecipeFilter(rest_framework.FilterSet):
 
     class Meta:
         model = Recipe
-        fields = ('tags', 'author', 'is_favorited', 'is_in_shopping_cart')
+        fields = (
+            'ids', 'q', 'has_ingredients', 'missing_max', 'tags',
+            'tags_mode', 'author', 'is_favorited', 'is_in_shopping_cart',
+        )
+
+    def filter_q(self, queryset, name, value):
+        if connections[queryset.db].vendor != 'postgresql':
+            return queryset.filter(
+                Q(name__icontains=value)
+                | Q(text__icontains=value)
+                | Exists(RecipeIngredient.objects.filter(
+                    recipe=OuterRef('pk'), ingredient__name__icontains=value,
+                ))
+            )
+        query = SearchQuery(
+            value, config=SEARCH_CONFIG, search_type='websearch',
+        )
+        return queryset.filter(search_vector=query).annotate(
+            search_rank=SearchRank(F('search_vector'), query),
+        ).order_by('-search_rank', *queryset.query.order_by)
+
+    def filter_ids(self, queryset, name, value):
+        if len(value) > MAX_BATCH_SIZE:
+            raise exceptions.ValidationError(
+                {'ids': [f'Не больше {MAX_BATCH_SIZE} рецептов за запрос']}
+            )
+        return order_by_ids(queryset, list(dict.fromkeys(value)))
+
+    def filter_has_ingredients(self, queryset, name, value):
+        missing_max = self.form.cleaned_data.get('missing_max') or 0
+        return order_by_ids(queryset, recipe_ingredient_index.search(
+            list(value),
+            int(missing_max),
+            DataVersion.objects.get_versions(DataVersion.RECIPES)[
+                DataVersion.RECIPES
+            ],
+            settings.RECIPE_MATCH_LIMIT,
+        ))
+
+    def filter_missing_max(self, queryset, name, value):
+        return queryset
+
+    def filter_tags(self, queryset, name, value):
+        recipe_tags = Recipe.tags.through.objects.filter(
+            recipe=OuterRef('pk')
+        )
+        slugs = set(value)
+        if self.form.cleaned_data.get('tags_mode') == 'all':
+            for slug in slugs:
+                queryset = queryset.filter(
+                    Exists(recipe_tags.filter(tag__slug=slug))
+                )
+            return queryset
+        return queryset.filter(Exists(recipe_tags.filter(tag__slug__in=slugs)))
+
+    def filter_tags_mode(self, queryset, name, value):
+        return queryset
 
     def filter_is_favorited(self, queryset, name, value):
         if value not in FILTER_VALUE:
@@ -44,7 +187,9 @@ class RecipeFilter(rest_framework.FilterSet):
                 ]}
             )
         if value == 1 and self.request.user.is_authenticated:
-            return queryset.filter(favorites__user=self.request.user)
+            return filter_by_viewer(
+                queryset, self.request, FAVORITES, 'favorites__user',
+            )
         return queryset
 
     def filter_is_in_shopping_cart(self, queryset, name, value):
@@ -55,13 +200,18 @@ class RecipeFilter(rest_framework.FilterSet):
                 ]}
             )
         if value == 1 and self.request.user.is_authenticated:
-            return queryset.filter(cart__user=self.request.user)
+            return filter_by_viewer(
+                queryset, self.request, CART, 'cart__user',
+            )
         return queryset
 
 
 class IngredientFilter(rest_framework.FilterSet):
-    name = rest_framework.CharFilter(lookup_expr='istartswith')
+    name = rest_framework.CharFilter(method='filter_name')
 
     class Meta:
         model = Ingredient
         fields = ('name', )
+
+    def filter_name(self, queryset, name, value):
+        return search_by_name(queryset, value)
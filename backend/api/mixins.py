@@ -0,0 +1,87 @@
+import hashlib
+
+from django.utils.cache import (get_conditional_response, patch_vary_headers,
+                                quote_etag)
+from django.utils.http import http_date
+
+from api.viewer import get_viewer
+from recipes.models import DataVersion
+
+
+class ConditionalGetMixin:
+    """Условные GET-запросы (ETag / Last-Modified) по версиям данных.
+
+    Валидаторы считаются до обращения к сериализаторам, и при совпадении
+    If-None-Match / If-Modified-Since сразу возвращается 304.
+    Для ответов, зависящих от пользователя, в валидатор входят его id
+    и версия его избранного, корзины и подписок.
+    """
+
+    version_name = None
+    extra_version_names = ()
+    viewer_specific = False
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(
+            request, self.get_list_validators(request),
+            super().list, *args, **kwargs,
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(
+            request, self.get_detail_validators(request, **kwargs),
+            super().retrieve, *args, **kwargs,
+        )
+
+    def get_version_names(self, request):
+        names = [self.version_name, *self.extra_version_names]
+        if self.viewer_specific and request.user.is_authenticated:
+            names.append(DataVersion.viewer(request.user.id))
+        return names
+
+    def load_versions(self, request, names):
+        """Загружает версии и передаёт версию зрителя в ViewerContext."""
+        self.versions = DataVersion.objects.get_versions(*names)
+        if request.user.is_authenticated:
+            get_viewer(request).version = self.versions.get(
+                DataVersion.viewer(request.user.id)
+            )
+        return self.versions
+
+    def get_list_validators(self, request):
+        self.load_versions(request, self.get_version_names(request))
+        return self.build_validators(request, self.versions.values())
+
+    def get_detail_validators(self, request, **kwargs):
+        return self.get_list_validators(request)
+
+    def build_validators(self, request, versions):
+        versions = list(versions)
+        user_id = request.user.id if self.viewer_specific else None
+        raw = '|'.join(
+            [request.get_full_path(), str(user_id)]
+            + [str(version) for version, _ in versions]
+        )
+        timestamps = [updated_at for _, updated_at in versions if updated_at]
+        return (
+            quote_etag(hashlib.md5(raw.encode()).hexdigest()),
+            int(max(timestamps).timestamp()) if timestamps else None,
+        )
+
+    def conditional_response(self, request, validators, handler,
+                             *args, **kwargs):
+        if validators is None:
+            return handler(request, *args, **kwargs)
+        etag, last_modified = validators
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified,
+        )
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            if self.viewer_specific:
+                patch_vary_headers(response, ('Authorization',))
+        return response
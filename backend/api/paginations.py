@@ -1,6 +1,278 @@
-from rest_framework import pagination
+import base64
+import binascii
+import hashlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import EmptyPage, Paginator
+from django.db import connection
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from recipes.models import TimelineEntry
+from rest_framework import exceptions, pagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class CustomPagination(pagination.PageNumberPagination):
     page_size = 6
     page_size_query_param = 'limit'
+
+
+class ApproximateCountPaginator(Paginator):
+    """Пагинатор, не доверяющий приблизительному count при выборке."""
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            return super().validate_number(number)
+        if number < 1:
+            raise EmptyPage('Номер страницы меньше 1')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        object_list = self.object_list[bottom:bottom + self.per_page]
+        if number > 1 and not object_list:
+            raise EmptyPage('Страница не содержит результатов')
+        return self._get_page(object_list, number, self)
+
+
+class ApproximateCountPagination(CustomPagination):
+    """Пагинация с дешёвым подсчётом количества объектов.
+
+    Для выборок без фильтров count берётся из кэша или из статистики
+    таблицы PostgreSQL (pg_class.reltuples), если она больше порога.
+    Отфильтрованные и небольшие выборки считаются точно.
+    Поле count_is_exact в ответе сообщает, точен ли count.
+    """
+
+    unfiltered_query_params = (
+        'page', 'limit', 'recipes_limit', 'fields', 'omit',
+    )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.count_is_exact = True
+        return super().paginate_queryset(queryset, request, view)
+
+    def django_paginator_class(self, queryset, page_size):
+        if self.is_filtered(self.request):
+            return Paginator(queryset, page_size)
+        count, self.count_is_exact = self.get_count(queryset)
+        paginator_class = (
+            Paginator if self.count_is_exact else ApproximateCountPaginator
+        )
+        paginator = paginator_class(queryset, page_size)
+        paginator.count = count
+        return paginator
+
+    def is_filtered(self, request):
+        return any(
+            param not in self.unfiltered_query_params
+            for param in request.query_params
+        )
+
+    def get_count(self, queryset):
+        queryset = queryset.order_by()
+        try:
+            sql = str(queryset.query)
+        except EmptyResultSet:
+            return 0, True
+        key = 'pagination-count:' + hashlib.md5(sql.encode()).hexdigest()
+        count = cache.get(key)
+        if count is not None:
+            return count, False
+        threshold = settings.PAGINATION_COUNT_ESTIMATE_THRESHOLD
+        count, is_exact = self.count_or_estimate(queryset, threshold)
+        if count >= threshold:
+            cache.set(key, count, settings.PAGINATION_COUNT_CACHE_TIMEOUT)
+        return count, is_exact
+
+    def count_or_estimate(self, queryset, threshold):
+        """Точный count или оценка pg_class.reltuples одним запросом.
+
+        Оценка применима только к выборке всей таблицы без условий.
+        COUNT(*) в CASE выполняется, лишь если оценка меньше порога,
+        поэтому у небольших таблиц запросов не больше, чем без оценки.
+        """
+        if connection.vendor != 'postgresql' or queryset.query.where:
+            return queryset.count(), True
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT CASE WHEN reltuples >= %s THEN reltuples::bigint '
+                f'ELSE (SELECT COUNT(*) FROM ({sql}) AS counted) END, '
+                'reltuples >= %s '
+                'FROM pg_class WHERE oid = %s::regclass',
+                (
+                    threshold, *params, threshold,
+                    connection.ops.quote_name(queryset.model._meta.db_table),
+                ),
+            )
+            count, is_estimate = cursor.fetchone()
+        return count, not is_estimate
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        response.data['count_is_exact'] = self.count_is_exact
+        return response
+
+
+class KeysetPagination(pagination.BasePagination):
+    """Курсорная пагинация по паре (pub_date, id).
+
+    Стоимость любой страницы одинакова: вместо OFFSET и COUNT(*)
+    запрос продолжается с позиции последней записи предыдущей страницы.
+    """
+
+    cursor_query_param = 'cursor'
+    page_size = CustomPagination.page_size
+    page_size_query_param = CustomPagination.page_size_query_param
+    max_page_size = 100
+    invalid_cursor_message = 'Неверный курсор'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor[0]
+        results = self.fetch(
+            queryset, cursor and cursor[1:], reverse, page_size + 1,
+        )
+        has_more = len(results) > page_size
+        results = results[:page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.first = results[0] if results else None
+        self.last = results[-1] if results else None
+        return results
+
+    def fetch(self, queryset, position, reverse, limit):
+        """До limit объектов после position в порядке выдачи."""
+        if position is not None:
+            pub_date, pk = position
+            if reverse:
+                queryset = queryset.filter(
+                    Q(pub_date__gt=pub_date) | Q(pub_date=pub_date, id__gt=pk)
+                )
+            else:
+                queryset = queryset.filter(
+                    Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, id__lt=pk)
+                )
+        ordering = ('pub_date', 'id') if reverse else ('-pub_date', '-id')
+        return list(queryset.order_by(*ordering)[:limit])
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            direction, pub_date, pk = base64.urlsafe_b64decode(
+                encoded.encode('ascii')
+            ).decode('ascii').split('|')
+            pub_date = parse_datetime(pub_date)
+            pk = int(pk)
+        except (binascii.Error, UnicodeError, ValueError):
+            raise exceptions.NotFound(self.invalid_cursor_message)
+        if pub_date is None or direction not in ('n', 'p'):
+            raise exceptions.NotFound(self.invalid_cursor_message)
+        return direction == 'p', pub_date, pk
+
+    def encode_cursor(self, recipe, reverse):
+        raw = '|'.join((
+            'p' if reverse else 'n',
+            recipe.pub_date.isoformat(),
+            str(recipe.pk),
+        ))
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii'),
+        )
+
+    def get_next_link(self):
+        if not self.has_next or self.last is None:
+            return None
+        return self.encode_cursor(self.last, reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or self.first is None:
+            return None
+        return self.encode_cursor(self.first, reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+
+class FeedPagination(KeysetPagination):
+    """Курсорная пагинация ленты подписок.
+
+    Ключи страницы читаются из ленты пользователя (TimelineEntry)
+    и рецептов авторов с fan-out on read, рецепты загружаются
+    из queryset только для этой страницы.
+    """
+
+    def fetch(self, queryset, position, reverse, limit):
+        keys = TimelineEntry.objects.get_feed_keys(
+            self.request.user, limit, position, reverse,
+        )
+        recipes = queryset.in_bulk([pk for _, pk in keys])
+        return [recipes[pk] for _, pk in keys if pk in recipes]
+
+
+class RecipePagination(ApproximateCountPagination):
+    """Постраничная пагинация с курсорным режимом по запросу.
+
+    Курсорный режим включается параметром cursor (пустым для первой
+    страницы), кроме выборок со своим порядком (ids, поиск, подбор по
+    ингредиентам). Выборка по списку ids отдаётся одной страницей.
+    """
+
+    keyset_class = KeysetPagination
+    ids_query_param = 'ids'
+    ranked_query_params = ('ids', 'q', 'search', 'has_ingredients')
+
+    def get_page_size(self, request):
+        ids = request.query_params.get(self.ids_query_param)
+        if ids:
+            return len(ids.split(','))
+        return super().get_page_size(request)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if any(
+            param in request.query_params
+            for param in self.ranked_query_params
+        ):
+            return super().paginate_queryset(queryset, request, view)
+        if self.keyset_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
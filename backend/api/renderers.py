@@ -0,0 +1,19 @@
+from rest_framework.renderers import JSONRenderer
+
+
+class ShoppingListTextRenderer(JSONRenderer):
+    """Формат txt для выгрузки списка покупок.
+
+    Сама выгрузка отдаётся потоком в обход рендерера,
+    ошибки (например, 401) рендерятся как JSON.
+    """
+
+    media_type = 'text/plain'
+    format = 'txt'
+
+
+class ShoppingListCSVRenderer(JSONRenderer):
+    """Формат csv для выгрузки списка покупок."""
+
+    media_type = 'text/csv'
+    format = 'csv'
@@ -1,12 +1,34 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.core.validators import MinValueValidator
+from django.db import models, transaction
 
-from api.fields import Base64ImageField, Hex2NameColor
-from foodgram_backend.constants import MIN_COOKING_TIME_VALUE
-from recipes.models import Ingredient, Recipe, RecipeIngredient, Tag
+from api.fields import (Base64ImageField, DimensionPrimaryKeyField,
+                        Hex2NameColor)
+from api.fieldsets import SparseFieldsetMixin
+from api.viewer import CART, FAVORITES, SUBSCRIPTIONS, get_context_viewer
+from foodgram_backend.constants import MAX_BATCH_SIZE, MIN_COOKING_TIME_VALUE
+from foodgram_backend.managers import delete_rows
+from recipes.dimensions import get_versions, ingredient_cache, tag_cache
+from recipes.models import (Ingredient, Recipe, RecipeIngredient,
+                            RecipeQuerySet, ShoppingListItem, Tag)
 from rest_framework import exceptions, serializers
 from users.serializers import UserSerializer
 
 
+class IdListSerializer(serializers.Serializer):
+    """Список id для пакетных операций."""
+
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=MAX_BATCH_SIZE,
+    )
+
+    def validate_ids(self, ids):
+        return list(dict.fromkeys(ids))
+
+
 class TagSerializer(serializers.ModelSerializer):
     color = Hex2NameColor()
 
@@ -39,8 +61,8 @@ class RecipeIngredientGetSerializer(serializers.ModelSerializer):
 
 
 class RecipeIngredientPostSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(
-        queryset=Ingredient.objects.all()
+    id = DimensionPrimaryKeyField(
+        ingredient_cache, queryset=Ingredient.objects.all(),
     )
     amount = serializers.IntegerField(
         validators=(
@@ -56,8 +78,33 @@ class RecipeIngredientPostSerializer(serializers.ModelSerializer):
         fields = ('id', 'amount')
 
 
-class RecipeGetSerializer(serializers.ModelSerializer):
-    tags = TagSerializer(many=True, read_only=True)
+class RecipeListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        if isinstance(data, models.Manager):
+            data = data.all()
+        return self.child.to_representation_many(list(data))
+
+
+class RecipeGetSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """Рецепт для чтения.
+
+    Общая для всех пользователей часть рецепта кэшируется по id и версии
+    (updated_at), поля зрителя подставляются при каждом запросе.
+    """
+
+    VIEWER_FIELDS = {
+        'is_favorited': 'is_favorited',
+        'is_in_shopping_cart': 'is_in_shopping_cart',
+        'author': 'author_is_subscribed',
+    }
+    VIEWER_RELATIONS = {
+        'is_favorited': (FAVORITES, 'pk'),
+        'is_in_shopping_cart': (CART, 'pk'),
+        'author_is_subscribed': (SUBSCRIPTIONS, 'author_id'),
+    }
+
+    tags = TagSerializer(many=True, read_only=True, source='tag_objects')
     ingredients = RecipeIngredientGetSerializer(
         many=True,
         source='recipeingredient',
@@ -82,18 +129,138 @@ class RecipeGetSerializer(serializers.ModelSerializer):
             'text',
             'cooking_time',
         )
+        list_serializer_class = RecipeListSerializer
 
-    def get_is_favorited(self, object):
+    def get_cache_key(self, recipe):
         request = self.context.get('request')
-        if not request or request.user.is_anonymous:
-            return False
-        return request.user.favorites.filter(recipe=object).exists()
+        base_url = request.build_absolute_uri('/') if request else ''
+        # Теги и ингредиенты берутся из снимка той версии справочника,
+        # которую запрос прочитал до рецептов. Без версии в ключе правка
+        # справочника между этими чтениями закэшировала бы старые
+        # названия под новым updated_at.
+        versions = get_versions(self.context)
+        dimensions = '.'.join(
+            str(versions[dimension.version_name][0])
+            for field, dimension in (
+                ('tags', tag_cache), ('ingredients', ingredient_cache),
+            )
+            if field in self.fields
+        )
+        key = (
+            f'recipe:{recipe.pk}:{recipe.updated_at.isoformat()}:'
+            f'{dimensions}:{base_url}'
+        )
+        if len(self.fields) != len(self.Meta.fields):
+            key += ':' + ','.join(self.fields)
+        return key
 
-    def get_is_in_shopping_cart(self, object):
-        request = self.context.get('request')
-        if not request or request.user.is_anonymous:
-            return False
-        return request.user.cart.filter(recipe=object).exists()
+    def to_representation(self, recipe):
+        return self.to_representation_many([recipe])[0]
+
+    def to_representation_many(self, recipes):
+        keys = {recipe.pk: self.get_cache_key(recipe) for recipe in recipes}
+        self.preload_viewer(recipes)
+        viewer_fields = {
+            recipe.pk: self.get_viewer_fields(recipe) for recipe in recipes
+        }
+        shared = cache.get_many(keys.values())
+        missing = [
+            recipe for recipe in recipes if keys[recipe.pk] not in shared
+        ]
+        if missing:
+            self.load_related(missing)
+            built = {}
+            for recipe in missing:
+                for attribute, value in viewer_fields[recipe.pk].items():
+                    setattr(recipe, attribute, value)
+                if 'author' in self.fields:
+                    recipe.author.is_subscribed = recipe.author_is_subscribed
+                built[keys[recipe.pk]] = super().to_representation(recipe)
+            cache.set_many(built, settings.RECIPE_CACHE_TIMEOUT)
+            shared.update(built)
+        representation = []
+        for recipe in recipes:
+            data = shared[keys[recipe.pk]]
+            fields = viewer_fields[recipe.pk]
+            if 'is_favorited' in fields:
+                data['is_favorited'] = fields['is_favorited']
+            if 'is_in_shopping_cart' in fields:
+                data['is_in_shopping_cart'] = fields['is_in_shopping_cart']
+            if 'author_is_subscribed' in fields:
+                data['author']['is_subscribed'] = (
+                    fields['author_is_subscribed']
+                )
+            representation.append(data)
+        return representation
+
+    def load_related(self, recipes):
+        models.prefetch_related_objects(
+            recipes, *RecipeQuerySet.related_lookups(self.fields)
+        )
+        if 'ingredients' in self.fields:
+            ingredients = ingredient_cache.get_objects(self.context)
+            for recipe in recipes:
+                for recipe_ingredient in recipe.recipeingredient.all():
+                    ingredient = ingredients.get(
+                        recipe_ingredient.ingredient_id
+                    )
+                    if ingredient is not None:
+                        recipe_ingredient.ingredient = ingredient
+        if 'tags' in self.fields:
+            tags = tag_cache.get_objects(self.context)
+            tag_ids = RecipeQuerySet.get_tag_ids(
+                [recipe.pk for recipe in recipes]
+            )
+            for recipe in recipes:
+                recipe.tag_objects = [
+                    tags[pk] if pk in tags else Tag.objects.get(pk=pk)
+                    for pk in tag_ids[recipe.pk]
+                ]
+
+    def preload_viewer(self, recipes):
+        """Проверяет флаги зрителя для всей страницы сразу.
+
+        Нужно, только если множества ViewerContext слишком велики
+        для загрузки, иначе preload ничего не делает.
+        """
+        viewer = get_context_viewer(self.context)
+        for field, attribute in self.VIEWER_FIELDS.items():
+            if field not in self.fields:
+                continue
+            relation, key = self.VIEWER_RELATIONS[attribute]
+            viewer.preload(relation, {
+                getattr(recipe, key) for recipe in recipes
+                if not hasattr(recipe, attribute)
+            })
+
+    def get_viewer_fields(self, recipe):
+        getters = {
+            'is_favorited': self.get_is_favorited,
+            'is_in_shopping_cart': self.get_is_in_shopping_cart,
+            'author_is_subscribed': self.get_author_is_subscribed,
+        }
+        return {
+            attribute: getters[attribute](recipe)
+            for field, attribute in self.VIEWER_FIELDS.items()
+            if field in self.fields
+        }
+
+    def get_viewer_flag(self, recipe, attribute):
+        if hasattr(recipe, attribute):
+            return getattr(recipe, attribute)
+        relation, key = self.VIEWER_RELATIONS[attribute]
+        return get_context_viewer(self.context).contains(
+            relation, getattr(recipe, key),
+        )
+
+    def get_author_is_subscribed(self, recipe):
+        return self.get_viewer_flag(recipe, 'author_is_subscribed')
+
+    def get_is_favorited(self, recipe):
+        return self.get_viewer_flag(recipe, 'is_favorited')
+
+    def get_is_in_shopping_cart(self, recipe):
+        return self.get_viewer_flag(recipe, 'is_in_shopping_cart')
 
 
 class RecipePostSerializer(serializers.ModelSerializer):
@@ -102,9 +269,8 @@ class RecipePostSerializer(serializers.ModelSerializer):
         many=True,
         source='recipeingredient',
     )
-    tags = serializers.PrimaryKeyRelatedField(
-        queryset=Tag.objects.all(),
-        many=True,
+    tags = DimensionPrimaryKeyField(
+        tag_cache, queryset=Tag.objects.all(), many=True,
     )
     image = Base64ImageField()
     cooking_time = serializers.IntegerField(
@@ -115,8 +281,6 @@ class RecipePostSerializer(serializers.ModelSerializer):
             ),
         )
     )
-    is_favorited = serializers.SerializerMethodField()
-    is_in_shopping_cart = serializers.SerializerMethodField()
 
     class Meta:
         model = Recipe
@@ -125,8 +289,6 @@ class RecipePostSerializer(serializers.ModelSerializer):
             'tags',
             'author',
             'ingredients',
-            'is_favorited',
-            'is_in_shopping_cart',
             'name',
             'image',
             'text',
@@ -158,18 +320,6 @@ class RecipePostSerializer(serializers.ModelSerializer):
             )
         return tags
 
-    def get_is_favorited(self, recipe):
-        user = self.context.get('view').request.user
-        if user.is_anonymous:
-            return False
-        return user.favorites.filter(recipe=recipe).exists()
-
-    def get_is_in_shopping_cart(self, recipe):
-        user = self.context.get('view').request.user
-        if user.is_anonymous:
-            return False
-        return user.cart.filter(recipe=recipe).exists()
-
     def add_ingredients(self, ingredients, recipe):
         RecipeIngredient.objects.bulk_create([
             RecipeIngredient(
@@ -180,6 +330,7 @@ class RecipePostSerializer(serializers.ModelSerializer):
             for ingredient in ingredients
         ])
 
+    @transaction.atomic
     def create(self, validated_data):
         author = self.context['request'].user
         tags = validated_data.pop('tags')
@@ -187,8 +338,50 @@ class RecipePostSerializer(serializers.ModelSerializer):
         recipe = Recipe.objects.create(author=author, **validated_data)
         recipe.tags.set(tags)
         self.add_ingredients(ingredients, recipe)
+        recipe.is_favorited = False
+        recipe.is_in_shopping_cart = False
         return recipe
 
+    def update_ingredients(self, recipe, ingredients):
+        """Применяет к ингредиентам рецепта только изменения."""
+        amounts = {
+            ingredient['id'].pk: ingredient['amount']
+            for ingredient in ingredients
+        }
+        current = {
+            recipe_ingredient.ingredient_id: recipe_ingredient
+            for recipe_ingredient in recipe.recipeingredient.all()
+        }
+        changed = []
+        for ingredient_id, recipe_ingredient in current.items():
+            amount = amounts.get(ingredient_id)
+            if amount is not None and amount != recipe_ingredient.amount:
+                recipe_ingredient.amount = amount
+                changed.append(recipe_ingredient)
+        RecipeIngredient.objects.bulk_update(changed, ['amount'])
+        self.add_ingredients(
+            [
+                ingredient for ingredient in ingredients
+                if ingredient['id'].pk not in current
+            ],
+            recipe,
+        )
+        removed_ids = current.keys() - amounts.keys()
+        if removed_ids:
+            # Рецепт сохраняется ниже, поэтому сигналы удаления строк
+            # (обновление версии рецепта) не нужны.
+            delete_rows(RecipeIngredient.objects.filter(
+                recipe=recipe, ingredient_id__in=removed_ids,
+            ))
+        affected_ids = (
+            {recipe_ingredient.ingredient_id for recipe_ingredient in changed}
+            | (amounts.keys() - current.keys())
+            | removed_ids
+        )
+        if affected_ids:
+            ShoppingListItem.objects.rebuild_recipe(recipe.pk, affected_ids)
+
+    @transaction.atomic
     def update(self, instance, validated_data):
         if 'recipeingredient' not in validated_data:
             raise serializers.ValidationError(
@@ -198,23 +391,19 @@ class RecipePostSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(
                 {'tags': ['Отсутствует в переданных данных']}
             )
-        recipe = instance
-        RecipeIngredient.objects.filter(recipe=recipe).delete()
-        instance.tags.clear()
-        instance.ingredients.clear()
-        tags = validated_data.get('tags')
-        instance.tags.set(tags)
-        ingredients = validated_data.get('recipeingredient')
+        instance.tags.set(validated_data['tags'])
+        self.update_ingredients(
+            instance, validated_data['recipeingredient']
+        )
         instance.image = validated_data.get('image', instance.image)
         instance.name = validated_data.get('name', instance.name)
         instance.text = validated_data.get('text', instance.text)
         instance.cooking_time = validated_data.get(
             'cooking_time', instance.cooking_time,
         )
-        self.add_ingredients(ingredients, recipe)
         instance.save()
         return instance
 
     def to_representation(self, recipe):
-        serializer = RecipeGetSerializer(recipe)
+        serializer = RecipeGetSerializer(recipe, context=self.context)
         return serializer.data
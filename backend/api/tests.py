@@ -1,8 +1,35 @@
 # backend/api/tests.py
+import importlib
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from http import HTTPStatus
+from itertools import combinations
+from unittest import mock, skipIf
 
 # from api import models
-from django.test import Client, TestCase
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import (Client, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+
+from api.serializers import RecipeGetSerializer
+from api.viewer import IdSet
+from recipes import dimensions
+from recipes.dimensions import ingredient_cache, tag_cache
+from recipes.ingredient_index import RecipeIngredientIndex
+from recipes.models import (Cart, DataVersion, Favorites, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingListItem, Tag,
+                            TimelineEntry)
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from users.models import Follow, User
+from users.serializers import UserSerializer
 
 
 class TaskiAPITestCase(TestCase):
@@ -12,3 +39,2165 @@ class TaskiAPITestCase(TestCase):
     def test_list_exists(self):
         response = self.guest_client.get('/api/recipes/')
         self.assertEqual(response.status_code, HTTPStatus.OK)
+
+
+class RecipeFixturesMixin:
+    """Набор данных для тестов API рецептов."""
+
+    recipes_amount = 12
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='reader', email='reader@foodgram.ru', password='pass',
+        )
+        cls.author = User.objects.create_user(
+            username='author', email='author@foodgram.ru', password='pass',
+        )
+        cls.token = Token.objects.create(user=cls.user)
+        cls.tag = Tag.objects.create(
+            name='Завтрак', color='#E26C2D', slug='breakfast',
+        )
+        cls.ingredient = Ingredient.objects.create(
+            name='Соль', measurement_unit='г',
+        )
+        cls.recipes = []
+        for number in range(cls.recipes_amount):
+            recipe = Recipe.objects.create(
+                name=f'Рецепт {number}',
+                text='Описание',
+                image='recipes/images/test.png',
+                cooking_time=10,
+                author=cls.author,
+            )
+            recipe.tags.set([cls.tag])
+            recipe.recipeingredient.create(
+                ingredient=cls.ingredient, amount=5,
+            )
+            cls.recipes.append(recipe)
+
+    def setUp(self):
+        cache.clear()
+        self.guest_client = Client()
+        self.user_client = Client(
+            HTTP_AUTHORIZATION=f'Token {self.token.key}'
+        )
+
+
+class RecipeViewerFlagsTestCase(RecipeFixturesMixin, TestCase):
+
+    def count_flag_queries(self, client, limit):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = client.get('/api/recipes/', {'limit': limit})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return sum(
+            1 for query in context.captured_queries
+            if query['sql'].startswith('SELECT')
+            and ('recipes_favorites' in query['sql']
+                 or 'recipes_cart' in query['sql'])
+        )
+
+    def test_flags_are_annotated(self):
+        Favorites.objects.create(user=self.user, recipe=self.recipes[0])
+        Cart.objects.create(user=self.user, recipe=self.recipes[1])
+        response = self.user_client.get(
+            '/api/recipes/', {'limit': self.recipes_amount}
+        )
+        results = {
+            recipe['id']: recipe for recipe in response.json()['results']
+        }
+        self.assertTrue(results[self.recipes[0].id]['is_favorited'])
+        self.assertFalse(results[self.recipes[0].id]['is_in_shopping_cart'])
+        self.assertTrue(results[self.recipes[1].id]['is_in_shopping_cart'])
+        self.assertFalse(results[self.recipes[2].id]['is_favorited'])
+
+    def test_flag_queries_do_not_depend_on_page_size(self):
+        for client in (self.guest_client, self.user_client):
+            with self.subTest(client=client):
+                self.assertEqual(
+                    self.count_flag_queries(client, 1),
+                    self.count_flag_queries(client, self.recipes_amount),
+                )
+
+
+class QueryBudgetTestCase(TestCase):
+    """Ограничение числа SQL-запросов для эндпоинтов API.
+
+    Бюджет не должен зависеть от размера страницы, иначе это N+1.
+    Справочники тегов и ингредиентов в памяти считаются прогретыми.
+    """
+
+    page_sizes = (1, 6, 100)
+    recipes_amount = 110
+    authors_amount = 10
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='reader', email='reader@foodgram.ru', password='pass',
+        )
+        cls.token = Token.objects.create(user=cls.user)
+        cls.tags = [
+            Tag.objects.create(name=name, color=color, slug=slug)
+            for name, color, slug in (
+                ('Завтрак', '#E26C2D', 'breakfast'),
+                ('Обед', '#49B64E', 'lunch'),
+            )
+        ]
+        cls.ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {number}', measurement_unit='г',
+            )
+            for number in range(5)
+        ]
+        cls.authors = [
+            User.objects.create_user(
+                username=f'author{number}',
+                email=f'author{number}@foodgram.ru',
+                password='pass',
+            )
+            for number in range(cls.authors_amount)
+        ]
+        for author in cls.authors[::2]:
+            Follow.objects.create(user=cls.user, author=author)
+        cls.recipes = []
+        for number in range(cls.recipes_amount):
+            recipe = Recipe.objects.create(
+                name=f'Рецепт {number}',
+                text='Описание',
+                image='recipes/images/test.png',
+                cooking_time=10,
+                author=cls.authors[number % cls.authors_amount],
+            )
+            recipe.tags.set(cls.tags)
+            RecipeIngredient.objects.bulk_create([
+                RecipeIngredient(
+                    recipe=recipe, ingredient=ingredient, amount=number + 1,
+                )
+                for ingredient in cls.ingredients
+            ])
+            if number % 3 == 0:
+                Favorites.objects.create(user=cls.user, recipe=recipe)
+            if number % 4 == 0:
+                Cart.objects.create(user=cls.user, recipe=recipe)
+            cls.recipes.append(recipe)
+        cls.own_recipe = Recipe.objects.create(
+            name='Свой рецепт',
+            text='Описание',
+            image='recipes/images/test.png',
+            cooking_time=10,
+            author=cls.user,
+        )
+        cls.own_recipe.tags.set(cls.tags)
+
+    def setUp(self):
+        self.guest_client = Client()
+        self.user_client = Client(
+            HTTP_AUTHORIZATION=f'Token {self.token.key}'
+        )
+        for dimension in (tag_cache, ingredient_cache):
+            dimension.get_objects({})
+
+    def assertQueriesAtMost(self, budget, client, method, url, data=None,
+                            status=HTTPStatus.OK):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            if method in ('post', 'patch', 'delete'):
+                response = getattr(client, method)(
+                    url, data, content_type='application/json',
+                )
+            else:
+                response = client.get(url, data)
+        self.assertEqual(response.status_code, status, url)
+        self.assertLessEqual(
+            len(context), budget,
+            f'{method.upper()} {url} {data}: ' + '\n'.join(
+                query['sql'] for query in context.captured_queries
+            ),
+        )
+        return response
+
+    def test_list_endpoints(self):
+        cases = (
+            ('/api/recipes/', {}, 10),
+            ('/api/recipes/', {'tags': ['breakfast', 'lunch']}, 10),
+            ('/api/recipes/', {'is_favorited': 1}, 10),
+            ('/api/recipes/', {'is_in_shopping_cart': 1}, 10),
+            ('/api/recipes/feed/', {}, 11),
+            ('/api/users/', {}, 3),
+            ('/api/users/subscriptions/', {'recipes_limit': 3}, 4),
+        )
+        for url, params, budget in cases:
+            for limit in self.page_sizes:
+                with self.subTest(url=url, params=params, limit=limit):
+                    self.assertQueriesAtMost(
+                        budget, self.user_client, 'get', url,
+                        {**params, 'limit': limit},
+                    )
+        for limit in self.page_sizes:
+            with self.subTest(url='/api/recipes/', anonymous=True):
+                self.assertQueriesAtMost(
+                    6, self.guest_client, 'get', '/api/recipes/',
+                    {'limit': limit},
+                )
+
+    def test_detail_and_catalogue_endpoints(self):
+        recipe = self.recipes[0]
+        cases = (
+            (f'/api/recipes/{recipe.id}/', 10),
+            (f'/api/users/{self.authors[0].id}/', 2),
+            ('/api/users/me/', 2),
+            ('/api/tags/', 3),
+            (f'/api/tags/{self.tags[0].id}/', 3),
+            ('/api/ingredients/', 3),
+            ('/api/ingredients/', 3, {'name': 'инг'}),
+            (f'/api/ingredients/{self.ingredients[0].id}/', 3),
+            ('/api/recipes/download_shopping_cart/', 2),
+        )
+        for url, budget, *params in cases:
+            with self.subTest(url=url):
+                self.assertQueriesAtMost(
+                    budget, self.user_client, 'get', url, *params,
+                )
+
+    def test_write_endpoints(self):
+        recipe = self.recipes[1]
+        author = self.authors[1]
+        # Внутри TestCase транзакция переключения связи выполняется
+        # точкой сохранения: два запроса SAVEPOINT и RELEASE.
+        cases = (
+            ('post', f'/api/recipes/{recipe.id}/favorite/',
+             None, 7, HTTPStatus.CREATED),
+            ('delete', f'/api/recipes/{recipe.id}/favorite/',
+             None, 6, HTTPStatus.NO_CONTENT),
+            ('post', f'/api/recipes/{recipe.id}/shopping_cart/',
+             None, 8, HTTPStatus.CREATED),
+            ('delete', f'/api/recipes/{recipe.id}/shopping_cart/',
+             None, 8, HTTPStatus.NO_CONTENT),
+            ('post', f'/api/users/{author.id}/subscribe/',
+             {'recipes_limit': 3}, 10, HTTPStatus.CREATED),
+            ('delete', f'/api/users/{author.id}/subscribe/',
+             None, 7, HTTPStatus.NO_CONTENT),
+            ('patch', f'/api/recipes/{self.own_recipe.id}/', {
+                'name': 'Новое название',
+                'text': 'Описание',
+                'cooking_time': 15,
+                'tags': [tag.id for tag in self.tags],
+                'ingredients': [
+                    {'id': ingredient.id, 'amount': 10}
+                    for ingredient in self.ingredients
+                ],
+            }, 14, HTTPStatus.OK),
+            ('post', '/api/recipes/', {
+                'name': 'Новый рецепт',
+                'text': 'Описание',
+                'cooking_time': 15,
+                'image': (
+                    'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAAB'
+                    'CAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU'
+                    '5ErkJggg=='
+                ),
+                'tags': [tag.id for tag in self.tags],
+                'ingredients': [
+                    {'id': ingredient.id, 'amount': 10}
+                    for ingredient in self.ingredients
+                ],
+            }, 17, HTTPStatus.CREATED),
+            ('delete', f'/api/recipes/{self.own_recipe.id}/',
+             None, 29, HTTPStatus.NO_CONTENT),
+        )
+        for method, url, data, budget, status in cases:
+            with self.subTest(method=method, url=url):
+                self.assertQueriesAtMost(
+                    budget, self.user_client, method, url, data, status,
+                )
+
+    def test_auth_endpoints(self):
+        with self.subTest(url='/api/auth/token/login/'):
+            self.assertQueriesAtMost(
+                4, self.guest_client, 'post', '/api/auth/token/login/',
+                {'email': 'reader@foodgram.ru', 'password': 'pass'},
+            )
+        with self.subTest(url='/api/users/set_password/'):
+            self.assertQueriesAtMost(
+                4, self.user_client, 'post', '/api/users/set_password/',
+                {'current_password': 'pass', 'new_password': 'N3wPass!x'},
+                HTTPStatus.NO_CONTENT,
+            )
+        with self.subTest(url='/api/auth/token/logout/'):
+            self.assertQueriesAtMost(
+                3, self.user_client, 'post', '/api/auth/token/logout/',
+                status=HTTPStatus.NO_CONTENT,
+            )
+
+
+class RecipeCursorPaginationTestCase(RecipeFixturesMixin, TestCase):
+
+    def walk(self, client, params):
+        ids, url, data = [], '/api/recipes/', {**params, 'cursor': ''}
+        while url:
+            response = client.get(url, data)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertNotIn('count', response.json())
+            ids += [recipe['id'] for recipe in response.json()['results']]
+            url, data = response.json()['next'], None
+        return ids
+
+    def test_cursor_pages_match_page_number_order(self):
+        Favorites.objects.create(user=self.user, recipe=self.recipes[3])
+        Favorites.objects.create(user=self.user, recipe=self.recipes[7])
+        for params in (
+            {},
+            {'tags': 'breakfast'},
+            {'author': self.author.id, 'is_favorited': 1},
+            {'tags': 'breakfast', 'is_in_shopping_cart': 1},
+        ):
+            with self.subTest(params=params):
+                expected = [
+                    recipe['id'] for recipe in self.user_client.get(
+                        '/api/recipes/',
+                        {**params, 'limit': self.recipes_amount},
+                    ).json()['results']
+                ]
+                self.assertEqual(
+                    self.walk(self.user_client, {**params, 'limit': 5}),
+                    expected,
+                )
+
+    def test_previous_cursor(self):
+        first = self.guest_client.get(
+            '/api/recipes/', {'cursor': '', 'limit': 5}
+        ).json()
+        self.assertIsNone(first['previous'])
+        second = self.guest_client.get(first['next']).json()
+        previous = self.guest_client.get(second['previous']).json()
+        self.assertEqual(previous['results'], first['results'])
+        self.assertIsNotNone(previous['next'])
+
+    def test_invalid_cursor(self):
+        response = self.guest_client.get('/api/recipes/', {'cursor': 'xxx'})
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+
+@override_settings(PAGINATION_COUNT_ESTIMATE_THRESHOLD=5)
+class ApproximateCountTestCase(RecipeFixturesMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_large_unfiltered_count_is_cached(self):
+        # Точен ли первый count, зависит от статистики таблицы в PostgreSQL.
+        first = self.guest_client.get('/api/recipes/').json()
+        self.assertEqual(first['count'], self.recipes_amount)
+        with self.assertNumQueries(2):
+            second = self.guest_client.get('/api/recipes/', {'page': 1})
+        self.assertEqual(second.json()['count'], self.recipes_amount)
+        self.assertFalse(second.json()['count_is_exact'])
+
+    @skipIf(
+        connection.vendor != 'postgresql',
+        'Оценка по статистике таблицы есть только в PostgreSQL',
+    )
+    def test_count_is_estimated_from_table_statistics(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE recipes_recipe')
+        response = self.guest_client.get('/api/recipes/').json()
+        self.assertEqual(response['count'], self.recipes_amount)
+        self.assertFalse(response['count_is_exact'])
+
+    def test_filtered_count_is_exact(self):
+        for _ in range(2):
+            response = self.guest_client.get(
+                '/api/recipes/', {'author': self.author.id}
+            ).json()
+            self.assertEqual(response['count'], self.recipes_amount)
+            self.assertTrue(response['count_is_exact'])
+
+    @override_settings(PAGINATION_COUNT_ESTIMATE_THRESHOLD=100)
+    def test_small_count_is_exact(self):
+        for _ in range(2):
+            response = self.guest_client.get('/api/users/').json()
+            self.assertEqual(response['count'], 2)
+            self.assertTrue(response['count_is_exact'])
+
+
+class RecipeCacheTestCase(RecipeFixturesMixin, TestCase):
+
+    def get_recipe(self, client=None):
+        return (client or self.guest_client).get(
+            f'/api/recipes/{self.recipes[0].id}/'
+        ).json()
+
+    def test_warm_cache_skips_related_queries(self):
+        self.guest_client.get('/api/recipes/', {'page': 1})
+        with self.assertNumQueries(3):
+            self.guest_client.get('/api/recipes/', {'page': 1})
+
+    def test_viewer_fields_are_not_shared(self):
+        Favorites.objects.create(user=self.user, recipe=self.recipes[0])
+        Follow.objects.create(user=self.user, author=self.author)
+        self.assertTrue(self.get_recipe(self.user_client)['is_favorited'])
+        anonymous = self.get_recipe()
+        self.assertFalse(anonymous['is_favorited'])
+        self.assertFalse(anonymous['author']['is_subscribed'])
+        user = self.get_recipe(self.user_client)
+        self.assertTrue(user['is_favorited'])
+        self.assertTrue(user['author']['is_subscribed'])
+
+    def test_recipe_ingredient_change_invalidates(self):
+        self.get_recipe()
+        recipe_ingredient = self.recipes[0].recipeingredient.get()
+        recipe_ingredient.amount = 7
+        recipe_ingredient.save()
+        self.assertEqual(self.get_recipe()['ingredients'][0]['amount'], 7)
+
+    def test_recipe_tags_change_invalidates(self):
+        self.get_recipe()
+        self.recipes[0].tags.clear()
+        self.assertEqual(self.get_recipe()['tags'], [])
+
+    def test_ingredient_change_invalidates(self):
+        self.get_recipe()
+        self.ingredient.name = 'Перец'
+        self.ingredient.save()
+        self.assertEqual(
+            self.get_recipe()['ingredients'][0]['name'], 'Перец'
+        )
+
+    def test_tag_change_invalidates(self):
+        self.get_recipe()
+        self.tag.slug = 'dinner'
+        self.tag.save()
+        self.assertEqual(self.get_recipe()['tags'][0]['slug'], 'dinner')
+
+    def test_author_change_invalidates(self):
+        self.get_recipe()
+        self.author.first_name = 'Иван'
+        self.author.save()
+        self.assertEqual(
+            self.get_recipe()['author']['first_name'], 'Иван'
+        )
+
+
+class ConditionalGetTestCase(RecipeFixturesMixin, TestCase):
+
+    def revalidate(self, client, url):
+        etag = client.get(url)['ETag']
+        return client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_not_modified_skips_serialization(self):
+        for url in ('/api/recipes/', '/api/tags/', '/api/ingredients/',
+                    f'/api/recipes/{self.recipes[0].id}/'):
+            with self.subTest(url=url):
+                etag = self.guest_client.get(url)['ETag']
+                with self.assertNumQueries(1):
+                    response = self.guest_client.get(
+                        url, HTTP_IF_NONE_MATCH=etag,
+                    )
+                self.assertEqual(
+                    response.status_code, HTTPStatus.NOT_MODIFIED
+                )
+                self.assertIn('Last-Modified', response)
+
+    def test_if_modified_since(self):
+        last_modified = self.guest_client.get('/api/tags/')['Last-Modified']
+        response = self.guest_client.get(
+            '/api/tags/', HTTP_IF_MODIFIED_SINCE=last_modified,
+        )
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+
+    def test_changes_produce_new_validator(self):
+        recipe_url = f'/api/recipes/{self.recipes[0].id}/'
+        changes = (
+            ('/api/tags/', lambda: Tag.objects.create(
+                name='Ужин', color='#8775D2', slug='dinner',
+            )),
+            ('/api/ingredients/', lambda: Ingredient.objects.create(
+                name='Перец', measurement_unit='г',
+            )),
+            ('/api/recipes/', lambda: self.recipes[-1].delete()),
+            (recipe_url, lambda: self.recipes[0].tags.clear()),
+        )
+        for url, change in changes:
+            with self.subTest(url=url):
+                etag = self.guest_client.get(url)['ETag']
+                change()
+                response = self.guest_client.get(
+                    url, HTTP_IF_NONE_MATCH=etag,
+                )
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_validator_depends_on_viewer(self):
+        url = '/api/recipes/'
+        etag = self.guest_client.get(url)['ETag']
+        response = self.user_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIn('Authorization', response['Vary'])
+        etag = response['ETag']
+        Favorites.objects.create(user=self.user, recipe=self.recipes[0])
+        response = self.user_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(
+            self.revalidate(self.user_client, url).status_code,
+            HTTPStatus.NOT_MODIFIED,
+        )
+
+
+class SparseFieldsetTestCase(RecipeFixturesMixin, TestCase):
+
+    def test_fields_limits_recipe_representation(self):
+        response = self.user_client.get(
+            '/api/recipes/', {'fields': 'id,name,is_favorited'}
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        for recipe in response.json()['results']:
+            self.assertEqual(
+                set(recipe), {'id', 'name', 'is_favorited'}
+            )
+
+    def test_omit_drops_recipe_fields(self):
+        recipe = self.guest_client.get(
+            f'/api/recipes/{self.recipes[0].id}/',
+            {'omit': 'ingredients,text'},
+        ).json()
+        self.assertNotIn('ingredients', recipe)
+        self.assertNotIn('text', recipe)
+        self.assertIn('is_subscribed', recipe['author'])
+
+    def test_fields_skip_related_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            self.user_client.get('/api/recipes/', {'fields': 'id,name'})
+        for query in context.captured_queries:
+            for table in ('recipes_recipeingredient', 'recipes_favorites',
+                          'recipes_cart', 'users_follow'):
+                self.assertNotIn(table, query['sql'])
+
+    def test_sparse_representation_is_cached_separately(self):
+        self.guest_client.get('/api/recipes/', {'fields': 'id'})
+        recipe = self.guest_client.get('/api/recipes/').json()['results'][0]
+        self.assertIn('ingredients', recipe)
+
+    def test_fields_limits_user_representation(self):
+        response = self.user_client.get(
+            '/api/users/', {'fields': 'id,username'}
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        for user in response.json()['results']:
+            self.assertEqual(set(user), {'id', 'username'})
+
+
+class BatchEndpointsTestCase(RecipeFixturesMixin, TestCase):
+
+    def post(self, url, ids, method='post'):
+        return getattr(self.user_client, method)(
+            url, {'ids': ids}, content_type='application/json',
+        )
+
+    def get_statuses(self, response):
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return {
+            result['id']: result['status']
+            for result in response.json()['results']
+        }
+
+    def test_batch_add_and_remove_recipes(self):
+        for url, model in (('/api/recipes/favorite/', Favorites),
+                           ('/api/recipes/shopping_cart/', Cart)):
+            with self.subTest(url=url):
+                model.objects.create(user=self.user, recipe=self.recipes[0])
+                ids = [recipe.id for recipe in self.recipes[:3]] + [10 ** 6]
+                self.assertEqual(self.get_statuses(self.post(url, ids)), {
+                    ids[0]: 'exists',
+                    ids[1]: 'created',
+                    ids[2]: 'created',
+                    ids[3]: 'not_found',
+                })
+                self.assertEqual(
+                    model.objects.filter(user=self.user).count(), 3
+                )
+                response = self.post(url, ids[1:], method='delete')
+                self.assertEqual(self.get_statuses(response), {
+                    ids[1]: 'deleted',
+                    ids[2]: 'deleted',
+                    ids[3]: 'not_found',
+                })
+                response = self.post(url, ids[1:2], method='delete')
+                self.assertEqual(
+                    self.get_statuses(response), {ids[1]: 'absent'}
+                )
+
+    def test_batch_add_query_count_does_not_depend_on_size(self):
+        ids = [recipe.id for recipe in self.recipes]
+        self.post('/api/recipes/favorite/', ids[:1])
+        with CaptureQueriesContext(connection) as small:
+            self.post('/api/recipes/favorite/', ids[1:2])
+        with CaptureQueriesContext(connection) as large:
+            self.post('/api/recipes/favorite/', ids[2:])
+        self.assertEqual(len(small), len(large))
+
+    def test_batch_add_invalidates_viewer_fields(self):
+        url = f'/api/recipes/{self.recipes[0].id}/'
+        etag = self.user_client.get(url)['ETag']
+        self.post('/api/recipes/shopping_cart/', [self.recipes[0].id])
+        response = self.user_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(response.json()['is_in_shopping_cart'])
+
+    def test_batch_subscribe(self):
+        ids = [self.author.id, self.user.id]
+        self.assertEqual(
+            self.get_statuses(self.post('/api/users/subscribe/', ids)),
+            {self.author.id: 'created', self.user.id: 'self'},
+        )
+        self.assertTrue(
+            Follow.objects.filter(user=self.user, author=self.author).exists()
+        )
+        response = self.post('/api/users/subscribe/', ids, method='delete')
+        self.assertEqual(
+            self.get_statuses(response),
+            {self.author.id: 'deleted', self.user.id: 'absent'},
+        )
+
+    def test_invalid_batch(self):
+        for ids in ([], ['a'], [0], list(range(1, 102))):
+            with self.subTest(ids=ids):
+                response = self.post('/api/recipes/favorite/', ids)
+                self.assertEqual(
+                    response.status_code, HTTPStatus.BAD_REQUEST
+                )
+        response = self.guest_client.post(
+            '/api/recipes/favorite/', {'ids': [1]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+
+class ToggleSemanticsTestCase(RecipeFixturesMixin, TestCase):
+
+    def request(self, method, url):
+        return getattr(self.user_client, method)(url).status_code
+
+    def test_recipe_toggles(self):
+        recipe = self.recipes[0].id
+        for name in ('favorite', 'shopping_cart'):
+            with self.subTest(name=name):
+                url = f'/api/recipes/{recipe}/{name}/'
+                missing = f'/api/recipes/{10 ** 6}/{name}/'
+                self.assertEqual(
+                    self.request('post', url), HTTPStatus.CREATED
+                )
+                self.assertEqual(
+                    self.request('post', url), HTTPStatus.BAD_REQUEST
+                )
+                self.assertEqual(
+                    self.request('post', missing), HTTPStatus.BAD_REQUEST
+                )
+                self.assertEqual(
+                    self.request('delete', url), HTTPStatus.NO_CONTENT
+                )
+                self.assertEqual(
+                    self.request('delete', url), HTTPStatus.BAD_REQUEST
+                )
+                self.assertEqual(
+                    self.request('delete', missing), HTTPStatus.NOT_FOUND
+                )
+                for method in ('post', 'delete'):
+                    self.assertEqual(
+                        self.request(method, f'/api/recipes/abc/{name}/'),
+                        HTTPStatus.NOT_FOUND,
+                    )
+
+    def test_subscribe_toggles(self):
+        url = f'/api/users/{self.author.id}/subscribe/'
+        missing = f'/api/users/{10 ** 6}/subscribe/'
+        response = self.user_client.post(url)
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual(response.json()['id'], self.author.id)
+        self.assertEqual(self.request('post', url), HTTPStatus.BAD_REQUEST)
+        for own_id in (self.user.id, f'0{self.user.id}'):
+            self.assertEqual(
+                self.request('post', f'/api/users/{own_id}/subscribe/'),
+                HTTPStatus.BAD_REQUEST,
+            )
+        for method in ('post', 'delete'):
+            self.assertEqual(
+                self.request(method, '/api/users/abc/subscribe/'),
+                HTTPStatus.NOT_FOUND,
+            )
+        self.assertEqual(self.request('post', missing), HTTPStatus.NOT_FOUND)
+        self.assertEqual(self.request('delete', url), HTTPStatus.NO_CONTENT)
+        self.assertEqual(self.request('delete', url), HTTPStatus.BAD_REQUEST)
+        self.assertEqual(
+            self.request('delete', missing), HTTPStatus.NOT_FOUND
+        )
+
+    def test_failed_receiver_rolls_back_toggle(self):
+        recipe = self.recipes[0]
+        Cart.relations.add(self.user, recipe.id)
+        for method, exists in (('add', False), ('remove', True)):
+            with self.subTest(method=method):
+                Cart.relations.remove(self.user, recipe.id)
+                if exists:
+                    Cart.relations.add(self.user, recipe.id)
+                with mock.patch(
+                    'recipes.signals.change_counters',
+                    side_effect=RuntimeError,
+                ):
+                    with self.assertRaises(RuntimeError):
+                        getattr(Cart.relations, method)(
+                            self.user, recipe.id,
+                        )
+                self.assertEqual(
+                    Cart.objects.filter(
+                        user=self.user, recipe=recipe,
+                    ).exists(),
+                    exists,
+                )
+                recipe.refresh_from_db()
+                self.assertEqual(recipe.cart_count, int(exists))
+
+    def test_reverse_managers_are_plain(self):
+        Favorites.relations.add(self.user, self.recipes[0].id)
+        self.assertEqual(self.user.favorites.get().recipe, self.recipes[0])
+        for manager in (
+            self.user.favorites, self.user.cart, self.user.subscriber,
+        ):
+            with self.subTest(manager=manager):
+                self.assertFalse(hasattr(manager, 'remove'))
+
+
+@skipIf(
+    connection.vendor == 'sqlite',
+    'SQLite в памяти блокирует таблицы без ожидания',
+)
+class ConcurrentToggleTestCase(TransactionTestCase):
+
+    workers = 8
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='reader', email='reader@foodgram.ru', password='pass',
+        )
+        self.author = User.objects.create_user(
+            username='author', email='author@foodgram.ru', password='pass',
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.recipe = Recipe.objects.create(
+            name='Рецепт', text='Описание', image='recipes/images/test.png',
+            cooking_time=10, author=self.author,
+        )
+
+    def run_parallel(self, method, url, data=None):
+        def request(_):
+            try:
+                client = Client(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+                if data is None:
+                    return getattr(client, method)(url).status_code
+                return getattr(client, method)(
+                    url, data, content_type='application/json',
+                ).json()['results'][0]['status']
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            return sorted(executor.map(request, range(self.workers)))
+
+    def test_parallel_toggles(self):
+        for url, model in (
+            (f'/api/recipes/{self.recipe.id}/favorite/', Favorites),
+            (f'/api/recipes/{self.recipe.id}/shopping_cart/', Cart),
+            (f'/api/users/{self.author.id}/subscribe/', Follow),
+        ):
+            with self.subTest(url=url):
+                statuses = self.run_parallel('post', url)
+                self.assertEqual(statuses.count(HTTPStatus.CREATED), 1)
+                self.assertEqual(
+                    statuses.count(HTTPStatus.BAD_REQUEST), self.workers - 1
+                )
+                self.assertEqual(
+                    model.objects.filter(user=self.user).count(), 1
+                )
+                statuses = self.run_parallel('delete', url)
+                self.assertEqual(statuses.count(HTTPStatus.NO_CONTENT), 1)
+                self.assertFalse(model.objects.filter(user=self.user).exists())
+
+    def test_parallel_batches(self):
+        for url, target, field in (
+            ('/api/recipes/favorite/', self.recipe, 'favorites_count'),
+            ('/api/recipes/shopping_cart/', self.recipe, 'cart_count'),
+            ('/api/users/subscribe/', self.author, 'followers_count'),
+        ):
+            with self.subTest(url=url):
+                data = {'ids': [target.id]}
+                statuses = self.run_parallel('post', url, data)
+                self.assertEqual(statuses.count('created'), 1)
+                self.assertEqual(statuses.count('exists'), self.workers - 1)
+                target.refresh_from_db()
+                self.assertEqual(getattr(target, field), 1)
+                statuses = self.run_parallel('delete', url, data)
+                self.assertEqual(statuses.count('deleted'), 1)
+                self.assertEqual(statuses.count('absent'), self.workers - 1)
+                target.refresh_from_db()
+                self.assertEqual(getattr(target, field), 0)
+
+
+class RecipeIdsFilterTestCase(RecipeFixturesMixin, TestCase):
+
+    def get(self, ids, **params):
+        return self.user_client.get(
+            '/api/recipes/', {'ids': ','.join(map(str, ids)), **params}
+        )
+
+    def test_ids_keep_requested_order(self):
+        ids = [self.recipes[5].id, self.recipes[0].id, self.recipes[9].id,
+               self.recipes[1].id, self.recipes[11].id, self.recipes[3].id,
+               self.recipes[7].id]
+        for params in ({}, {'cursor': ''}):
+            with self.subTest(params=params):
+                response = self.get(ids + [10 ** 6], **params)
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+                data = response.json()
+                self.assertEqual(data['count'], len(ids))
+                self.assertEqual(
+                    [recipe['id'] for recipe in data['results']], ids
+                )
+
+    def test_ids_use_list_query_plan(self):
+        ids = [recipe.id for recipe in self.recipes]
+        with CaptureQueriesContext(connection) as single:
+            self.get(ids[:1])
+        cache.clear()
+        with CaptureQueriesContext(connection) as many:
+            self.get(ids)
+        self.assertEqual(len(single), len(many))
+
+    def test_too_many_ids(self):
+        response = self.get(range(1, 102))
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_non_integer_ids(self):
+        for params in ({'ids': '1.7'}, {'ids': 'a'},
+                       {'has_ingredients': '1.5'}):
+            with self.subTest(params=params):
+                response = self.user_client.get('/api/recipes/', params)
+                self.assertEqual(
+                    response.status_code, HTTPStatus.BAD_REQUEST
+                )
+
+
+class IngredientIndexTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for name in ('Соль', 'Соль морская', 'Фасоль', 'Сода', 'соль'):
+            Ingredient.objects.create(name=name, measurement_unit='г')
+
+    def search(self, name):
+        response = self.client.get('/api/ingredients/', {'name': name})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return [ingredient['name'] for ingredient in response.json()]
+
+    def test_exact_and_prefix_matches_come_first(self):
+        self.assertEqual(
+            self.search('СОЛЬ'), ['Соль', 'соль', 'Соль морская', 'Фасоль']
+        )
+        self.assertEqual(self.search('со'), [
+            'Сода', 'Соль', 'соль', 'Соль морская', 'Фасоль',
+        ])
+
+    def test_index_is_refreshed_on_catalogue_change(self):
+        self.assertEqual(self.search('перец'), [])
+        Ingredient.objects.create(name='Перец', measurement_unit='г')
+        self.assertEqual(self.search('перец'), ['Перец'])
+
+    def test_search_skips_ingredient_table(self):
+        self.search('соль')
+        with CaptureQueriesContext(connection) as context:
+            self.search('соль')
+        for query in context.captured_queries:
+            self.assertNotIn('recipes_ingredient', query['sql'])
+
+    @override_settings(INGREDIENT_SEARCH_LIMIT=2)
+    def test_limit(self):
+        self.assertEqual(self.search('соль'), ['Соль', 'соль'])
+
+    @override_settings(INGREDIENT_SEARCH_LIMIT=2)
+    def test_limit_without_index(self):
+        with override_settings(INGREDIENT_INDEX_ENABLED=False):
+            self.assertEqual(len(self.search('соль')), 2)
+        self.assertEqual(len(self.search('соль')), 2)
+
+    @override_settings(INGREDIENT_INDEX_ENABLED=False)
+    def test_index_can_be_disabled(self):
+        names = self.search('Соль')
+        self.assertIn('Соль морская', names)
+        self.assertNotIn('Фасоль', names)
+
+
+class NameSearchTestCase(RecipeFixturesMixin, TestCase):
+
+    def test_recipe_search_ranks_prefix_matches_first(self):
+        Recipe.objects.filter(pk=self.recipes[0].pk).update(name='Pasta')
+        Recipe.objects.filter(pk=self.recipes[1].pk).update(
+            name='Green pasta'
+        )
+        response = self.guest_client.get('/api/recipes/', {'search': 'pas'})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(
+            [recipe['name'] for recipe in response.json()['results']],
+            ['Pasta', 'Green pasta'],
+        )
+
+    @override_settings(INGREDIENT_INDEX_ENABLED=False)
+    def test_ingredient_filter_ranks_prefix_matches_first(self):
+        for name in ('Black pepper', 'Pepper'):
+            Ingredient.objects.create(name=name, measurement_unit='g')
+        response = self.guest_client.get(
+            '/api/ingredients/', {'name': 'pep'}
+        )
+        self.assertEqual(
+            [ingredient['name'] for ingredient in response.json()],
+            ['Pepper', 'Black pepper'],
+        )
+
+
+class RecipeFullTextSearchTestCase(RecipeFixturesMixin, TestCase):
+    """Полнотекстовый поиск рецептов.
+
+    Поисковый вектор пишется в on_commit, поэтому данные меняются
+    через ORM внутри captureOnCommitCallbacks.
+    """
+
+    def search(self, **params):
+        response = self.user_client.get('/api/recipes/', params)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return [recipe['id'] for recipe in response.json()['results']]
+
+    def rename(self, recipe, **fields):
+        for field, value in fields.items():
+            setattr(recipe, field, value)
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.save()
+
+    def test_search_matches_name_text_and_ingredients(self):
+        self.rename(self.recipes[0], name='Borscht')
+        self.rename(self.recipes[1], text='Serve with borscht')
+        with self.captureOnCommitCallbacks(execute=True):
+            beet = Ingredient.objects.create(
+                name='Borscht beet', measurement_unit='g',
+            )
+            self.recipes[2].recipeingredient.create(ingredient=beet, amount=1)
+        found = self.search(q='borscht')
+        self.assertEqual(
+            set(found), {recipe.id for recipe in self.recipes[:3]},
+        )
+        if connection.vendor == 'postgresql':
+            # Вес названия A, ингредиентов B, описания C.
+            self.assertEqual(found, [
+                self.recipes[0].id, self.recipes[2].id, self.recipes[1].id,
+            ])
+
+    def test_search_combines_with_filters(self):
+        for recipe in self.recipes[:2]:
+            self.rename(recipe, name='Borscht')
+        Favorites.objects.create(user=self.user, recipe=self.recipes[1])
+        self.assertEqual(
+            self.search(q='borscht', is_favorited=1), [self.recipes[1].id],
+        )
+
+
+class IngredientMatchTestCase(RecipeFixturesMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch(
+            'api.filters.recipe_ingredient_index', RecipeIngredientIndex()
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pepper = Ingredient.objects.create(
+            name='Перец', measurement_unit='г',
+        )
+        self.oil = Ingredient.objects.create(
+            name='Масло', measurement_unit='мл',
+        )
+        self.recipes[0].recipeingredient.create(
+            ingredient=self.pepper, amount=1,
+        )
+        self.recipes[1].recipeingredient.create(
+            ingredient=self.pepper, amount=1,
+        )
+        self.recipes[1].recipeingredient.create(ingredient=self.oil, amount=1)
+
+    def match(self, ingredients, **params):
+        response = self.guest_client.get('/api/recipes/', {
+            'has_ingredients': ','.join(
+                str(ingredient.id) for ingredient in ingredients
+            ),
+            **params,
+        })
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return [recipe['id'] for recipe in response.json()['results']]
+
+    def test_exact_matches(self):
+        self.assertEqual(
+            self.match([self.ingredient], limit=20),
+            [recipe.id for recipe in reversed(self.recipes[2:])],
+        )
+        self.assertEqual(
+            self.match([self.ingredient, self.pepper, self.oil], limit=3),
+            [self.recipes[11].id, self.recipes[10].id, self.recipes[9].id],
+        )
+
+    def test_missing_ingredients_rank_by_coverage(self):
+        self.assertEqual(
+            self.match([self.pepper], missing_max=2, limit=20)[:2],
+            [self.recipes[0].id, self.recipes[1].id],
+        )
+        self.assertEqual(
+            len(self.match([self.pepper], missing_max=2, limit=20)), 2
+        )
+
+    def test_index_follows_recipe_changes(self):
+        self.assertNotIn(self.recipes[0].id, self.match([self.ingredient]))
+        RecipeIngredient.objects.filter(
+            recipe=self.recipes[0], ingredient=self.pepper,
+        ).delete()
+        self.assertIn(
+            self.recipes[0].id, self.match([self.ingredient], limit=20)
+        )
+        self.recipes[2].delete()
+        self.assertNotIn(
+            self.recipes[2].id, self.match([self.ingredient], limit=20)
+        )
+
+    @override_settings(RECIPE_MATCH_LIMIT=1)
+    def test_deleted_recipes_leave_the_index(self):
+        self.assertEqual(
+            self.match([self.ingredient, self.pepper, self.oil]),
+            [self.recipes[11].id],
+        )
+        self.recipes[11].delete()
+        self.assertEqual(
+            self.match([self.ingredient, self.pepper, self.oil]),
+            [self.recipes[10].id],
+        )
+
+    @override_settings(RECIPE_INDEX_SYNC_MARGIN=3600)
+    def test_changes_with_older_timestamps_are_synced(self):
+        # Правка, зафиксированная позже более новых, старше отметки
+        # синхронизации, но укладывается в запас.
+        self.match([self.ingredient])
+        recipe = self.recipes[3]
+        recipe.recipeingredient.all().delete()
+        Recipe.objects.filter(pk=recipe.pk).update(
+            updated_at=recipe.updated_at - timedelta(minutes=30),
+        )
+        DataVersion.objects.bump(DataVersion.RECIPES)
+        self.assertNotIn(recipe.id, self.match([self.ingredient], limit=20))
+
+    def test_sync_reads_only_changed_recipes(self):
+        self.match([self.ingredient])
+        recipe = self.recipes[3]
+        recipe.recipeingredient.all().delete()
+        with CaptureQueriesContext(connection) as context:
+            self.assertNotIn(
+                recipe.id, self.match([self.ingredient], limit=20),
+            )
+        index_queries = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('SELECT "recipes_recipe"."id", '
+                                       '"recipes_recipe"."updated_at"')
+        ]
+        self.assertEqual(len(index_queries), 1)
+        self.assertIn('"recipes_recipe"."updated_at" >=', index_queries[0])
+        self.assertFalse(any(
+            query['sql'].startswith('SELECT "recipes_recipeingredient"')
+            and 'WHERE' not in query['sql']
+            for query in context.captured_queries
+        ))
+
+
+class TagFilterTestCase(RecipeFixturesMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        lunch = Tag.objects.create(
+            name='Обед', color='#49B64E', slug='lunch',
+        )
+        dinner = Tag.objects.create(
+            name='Ужин', color='#8775D2', slug='dinner',
+        )
+        for number, recipe in enumerate(cls.recipes):
+            if number % 2:
+                recipe.tags.add(lunch)
+            if number % 3 == 0:
+                recipe.tags.add(dinner)
+            if number % 4 == 0:
+                recipe.tags.remove(cls.tag)
+
+    def get_ids(self, slugs, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.guest_client.get('/api/recipes/', {
+                'tags': slugs, 'limit': self.recipes_amount, **params,
+            })
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        for query in context.captured_queries:
+            self.assertNotIn('DISTINCT', query['sql'])
+        data = response.json()
+        self.assertEqual(data['count'], len(data['results']))
+        return [recipe['id'] for recipe in data['results']]
+
+    def test_results_match_join_filter(self):
+        slugs = ('breakfast', 'lunch', 'dinner', 'unknown')
+        for size in range(1, len(slugs) + 1):
+            for combination in combinations(slugs, size):
+                with self.subTest(tags=combination):
+                    expected = list(
+                        Recipe.objects.filter(tags__slug__in=combination)
+                        .distinct().order_by('-pub_date', '-id')
+                        .values_list('id', flat=True)
+                    )
+                    self.assertEqual(self.get_ids(combination), expected)
+                    queryset = Recipe.objects.order_by('-pub_date', '-id')
+                    for slug in combination:
+                        queryset = queryset.filter(tags__slug=slug)
+                    self.assertEqual(
+                        self.get_ids(combination, tags_mode='all'),
+                        list(queryset.values_list('id', flat=True)),
+                    )
+
+    def test_invalid_mode(self):
+        response = self.guest_client.get(
+            '/api/recipes/', {'tags': 'lunch', 'tags_mode': 'some'}
+        )
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+
+class DimensionCacheTestCase(RecipeFixturesMixin, TestCase):
+
+    def post_recipe(self, tags, ingredients):
+        return self.user_client.post('/api/recipes/', {
+            'name': 'Новый рецепт',
+            'text': 'Описание',
+            'cooking_time': 15,
+            'image': (
+                'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAAB'
+                'CAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU'
+                '5ErkJggg=='
+            ),
+            'tags': tags,
+            'ingredients': [
+                {'id': ingredient, 'amount': 10} for ingredient in ingredients
+            ],
+        }, content_type='application/json')
+
+    def test_rendering_skips_dimension_tables(self):
+        self.guest_client.get('/api/recipes/')
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.guest_client.get('/api/recipes/')
+        recipe = response.json()['results'][0]
+        self.assertEqual(recipe['tags'][0]['slug'], self.tag.slug)
+        self.assertEqual(
+            recipe['ingredients'][0]['name'], self.ingredient.name
+        )
+        for query in context.captured_queries:
+            self.assertNotIn('"recipes_tag"', query['sql'])
+            self.assertNotIn('"recipes_ingredient"', query['sql'])
+
+    def test_unknown_ids_are_rejected(self):
+        response = self.post_recipe([10 ** 6], [self.ingredient.id])
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertIn('tags', response.json())
+        response = self.post_recipe([self.tag.id], [10 ** 6])
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertIn('ingredients', response.json())
+        response = self.post_recipe(['tag'], [self.ingredient.id])
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_changes_are_picked_up(self):
+        self.guest_client.get('/api/recipes/')
+        self.tag.slug = 'morning'
+        self.tag.save()
+        lunch = Tag.objects.create(
+            name='Обед', color='#49B64E', slug='lunch',
+        )
+        recipe = self.guest_client.get('/api/recipes/').json()['results'][0]
+        self.assertEqual(recipe['tags'][0]['slug'], 'morning')
+        response = self.post_recipe([lunch.id], [self.ingredient.id])
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual(response.json()['tags'][0]['slug'], 'lunch')
+
+    def test_stale_snapshot_is_not_cached_for_new_versions(self):
+        # Другой процесс прочитал версии до правки тега, а рецепт уже
+        # после неё, и строит фрагмент по своему старому снимку.
+        versions = DataVersion.objects.get_versions(
+            DataVersion.TAGS, DataVersion.INGREDIENTS,
+        )
+        stale_tag = Tag.objects.get(pk=self.tag.pk)
+        self.tag.slug = 'morning'
+        self.tag.save()
+        recipe = Recipe.objects.get(pk=self.recipes[0].pk)
+        request = Request(APIRequestFactory().get('/'))
+        with mock.patch.object(tag_cache, 'snapshot', (
+            versions[DataVersion.TAGS], {stale_tag.pk: stale_tag},
+        )):
+            data = RecipeGetSerializer(recipe, context={
+                'request': request, dimensions.CONTEXT_KEY: versions,
+            }).data
+        self.assertEqual(data['tags'][0]['slug'], 'breakfast')
+        response = self.guest_client.get(f'/api/recipes/{recipe.pk}/')
+        self.assertEqual(response.json()['tags'][0]['slug'], 'morning')
+
+
+class RecipeWriteQueryCountTestCase(RecipeFixturesMixin, TestCase):
+
+    ingredient_counts = (1, 10, 50)
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {number}', measurement_unit='г',
+            )
+            for number in range(max(cls.ingredient_counts))
+        ]
+
+    def get_payload(self, ingredients):
+        return {
+            'name': 'Новый рецепт',
+            'text': 'Описание',
+            'cooking_time': 15,
+            'image': (
+                'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAAB'
+                'CAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU'
+                '5ErkJggg=='
+            ),
+            'tags': [self.tag.id],
+            'ingredients': [
+                {'id': ingredient, 'amount': 10} for ingredient in ingredients
+            ],
+        }
+
+    def count_queries(self, method, url, ingredients):
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.user_client, method)(
+                url, self.get_payload(ingredients),
+                content_type='application/json',
+            )
+        self.assertLess(response.status_code, HTTPStatus.BAD_REQUEST)
+        return len(context)
+
+    def test_query_count_does_not_depend_on_ingredients(self):
+        ids = [ingredient.id for ingredient in self.ingredients]
+        self.count_queries('post', '/api/recipes/', ids[:1])
+        counts = {
+            count: self.count_queries('post', '/api/recipes/', ids[:count])
+            for count in self.ingredient_counts
+        }
+        self.assertEqual(len(set(counts.values())), 1, counts)
+
+    def test_update_applies_only_changes(self):
+        recipe = Recipe.objects.create(
+            name='Свой рецепт', text='Описание',
+            image='recipes/images/test.png', cooking_time=10,
+            author=self.user,
+        )
+        recipe.tags.set([self.tag])
+        kept, changed, removed = [
+            recipe.recipeingredient.create(ingredient=ingredient, amount=5)
+            for ingredient in self.ingredients[:3]
+        ]
+        payload = self.get_payload([])
+        payload['ingredients'] = [
+            {'id': kept.ingredient_id, 'amount': 5},
+            {'id': changed.ingredient_id, 'amount': 7},
+            {'id': self.ingredients[3].id, 'amount': 1},
+        ]
+        response = self.user_client.patch(
+            f'/api/recipes/{recipe.id}/', payload,
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        rows = {
+            row.ingredient_id: row for row in recipe.recipeingredient.all()
+        }
+        self.assertEqual(rows[kept.ingredient_id].pk, kept.pk)
+        self.assertEqual(rows[changed.ingredient_id].pk, changed.pk)
+        self.assertEqual(rows[changed.ingredient_id].amount, 7)
+        self.assertNotIn(removed.ingredient_id, rows)
+        self.assertEqual(rows[self.ingredients[3].id].amount, 1)
+        self.assertEqual(
+            sorted(
+                ingredient['amount']
+                for ingredient in response.json()['ingredients']
+            ),
+            [1, 5, 7],
+        )
+
+    def count_delete_queries(self, ingredients, users):
+        recipe = Recipe.objects.create(
+            name='Удаляемый рецепт', text='Описание',
+            image='recipes/images/test.png', cooking_time=10,
+            author=self.user,
+        )
+        recipe.tags.set([self.tag])
+        for ingredient in ingredients:
+            recipe.recipeingredient.create(ingredient=ingredient, amount=5)
+        for user in users:
+            Favorites.objects.create(user=user, recipe=recipe)
+            Cart.objects.create(user=user, recipe=recipe)
+        names = [DataVersion.viewer(user.id) for user in users]
+        versions = DataVersion.objects.get_versions(*names)
+        with CaptureQueriesContext(connection) as context:
+            response = self.user_client.delete(f'/api/recipes/{recipe.id}/')
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        for name, (version, _) in DataVersion.objects.get_versions(
+            *names
+        ).items():
+            self.assertEqual(version, versions[name][0] + 1)
+        self.assertFalse(
+            ShoppingListItem.objects.filter(user__in=users).exists()
+        )
+        return len(context)
+
+    def test_delete_query_count_does_not_depend_on_popularity(self):
+        users = [
+            User.objects.create_user(
+                username=f'fan{number}', email=f'fan{number}@foodgram.ru',
+                password='pass',
+            )
+            for number in range(10)
+        ]
+        counts = {
+            (ingredients, fans): self.count_delete_queries(
+                self.ingredients[:ingredients], users[:fans],
+            )
+            for ingredients, fans in ((1, 1), (5, 3), (10, 10))
+        }
+        self.assertEqual(len(set(counts.values())), 1, counts)
+
+    def test_per_item_errors(self):
+        payload = self.get_payload([self.ingredient.id, 10 ** 6])
+        payload['tags'] = [self.tag.id, 10 ** 6]
+        response = self.user_client.post(
+            '/api/recipes/', payload, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        errors = response.json()
+        self.assertEqual(errors['ingredients'][0], {})
+        self.assertIn(str(10 ** 6), errors['ingredients'][1]['id'][0])
+        self.assertIn(str(10 ** 6), errors['tags'][0])
+
+
+class ShoppingListExportTestCase(RecipeFixturesMixin, TestCase):
+    url = '/api/recipes/download_shopping_cart/'
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        pepper = Ingredient.objects.create(
+            name='Перец', measurement_unit='щепотка',
+        )
+        for recipe in cls.recipes[:3]:
+            Cart.objects.create(user=cls.user, recipe=recipe)
+            recipe.recipeingredient.create(ingredient=pepper, amount=2)
+
+    def download(self, **params):
+        response = self.user_client.get(self.url, params)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return response
+
+    def test_formats(self):
+        cases = (
+            ({}, 'text/plain', 'Перец\t6\tщепотка \nСоль\t15\tг \n'),
+            ({'format': 'txt'}, 'text/plain',
+             'Перец\t6\tщепотка \nСоль\t15\tг \n'),
+            ({'format': 'csv'}, 'text/csv',
+             'name,amount,measurement_unit\r\n'
+             'Перец,6,щепотка\r\nСоль,15,г\r\n'),
+        )
+        for params, content_type, expected in cases:
+            with self.subTest(params=params):
+                cache.clear()
+                response = self.download(**params)
+                self.assertTrue(response.streaming)
+                self.assertTrue(response['Content-Type'].startswith(
+                    content_type
+                ))
+                self.assertEqual(
+                    b''.join(response.streaming_content).decode(), expected,
+                )
+        response = self.download(format='json')
+        self.assertTrue(response['Content-Disposition'].endswith(
+            'filename="shopping_cart.json"'
+        ))
+        self.assertEqual(
+            json.loads(b''.join(response.streaming_content)),
+            [{'name': 'Перец', 'amount': 6, 'measurement_unit': 'щепотка'},
+             {'name': 'Соль', 'amount': 15, 'measurement_unit': 'г'}],
+        )
+
+    def test_unknown_format(self):
+        response = self.user_client.get(self.url, {'format': 'pdf'})
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_cached_response(self):
+        streamed = self.download(format='csv')
+        content = b''.join(streamed.streaming_content)
+        with CaptureQueriesContext(connection) as context:
+            cached = self.download(format='csv')
+        self.assertFalse(cached.streaming)
+        self.assertEqual(cached.content, content)
+        self.assertEqual(cached['Content-Length'], str(len(content)))
+        self.assertEqual(cached['ETag'], streamed['ETag'])
+        self.assertEqual(len(context), 2)
+        response = self.user_client.get(
+            self.url, {'format': 'csv'}, HTTP_IF_NONE_MATCH=cached['ETag'],
+        )
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+
+    def test_format_from_accept_header(self):
+        txt = self.download()
+        self.assertEqual(
+            b''.join(txt.streaming_content).decode(),
+            'Перец\t6\tщепотка \nСоль\t15\tг \n',
+        )
+        for headers in ({}, {'HTTP_IF_NONE_MATCH': txt['ETag']}):
+            with self.subTest(headers=headers):
+                response = self.user_client.get(
+                    self.url, HTTP_ACCEPT='text/csv', **headers,
+                )
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+                self.assertNotEqual(response['ETag'], txt['ETag'])
+                self.assertTrue(
+                    response['Content-Type'].startswith('text/csv')
+                )
+                self.assertIn('Accept', response['Vary'])
+                content = (
+                    b''.join(response.streaming_content)
+                    if response.streaming else response.content
+                )
+                self.assertEqual(
+                    content.decode(),
+                    'name,amount,measurement_unit\r\n'
+                    'Перец,6,щепотка\r\nСоль,15,г\r\n',
+                )
+
+    def test_cart_change_invalidates(self):
+        b''.join(self.download().streaming_content)
+        self.user_client.post(f'/api/recipes/{self.recipes[3].id}/'
+                              'shopping_cart/')
+        response = self.download()
+        self.assertTrue(response.streaming)
+        self.assertIn(
+            'Соль\t20\tг', b''.join(response.streaming_content).decode(),
+        )
+
+    @override_settings(SHOPPING_LIST_CACHE_MAX_SIZE=10,
+                       SHOPPING_LIST_BLOCK_SIZE=1)
+    def test_large_result_is_not_cached(self):
+        b''.join(self.download().streaming_content)
+        self.assertTrue(self.download().streaming)
+
+
+class ShoppingListMaterializationTestCase(RecipeFixturesMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.pepper = Ingredient.objects.create(
+            name='Перец', measurement_unit='г',
+        )
+        cls.sugar = Ingredient.objects.create(
+            name='Сахар', measurement_unit='г',
+        )
+        cls.own_recipe = Recipe.objects.create(
+            name='Свой рецепт',
+            text='Описание',
+            image='recipes/images/test.png',
+            cooking_time=10,
+            author=cls.user,
+        )
+        cls.own_recipe.tags.set([cls.tag])
+        cls.own_recipe.recipeingredient.create(
+            ingredient=cls.ingredient, amount=3,
+        )
+        cls.own_recipe.recipeingredient.create(
+            ingredient=cls.pepper, amount=1,
+        )
+
+    def assertShoppingListsValid(self):
+        expected = {}
+        for cart in Cart.objects.all():
+            for row in RecipeIngredient.objects.filter(
+                recipe_id=cart.recipe_id,
+            ):
+                key = (cart.user_id, row.ingredient_id)
+                expected[key] = expected.get(key, 0) + row.amount
+        self.assertEqual(
+            {
+                (item.user_id, item.ingredient_id): item.amount
+                for item in ShoppingListItem.objects.all()
+            },
+            expected,
+        )
+
+    def test_cart_changes(self):
+        recipe = self.recipes[0]
+        self.user_client.post(f'/api/recipes/{recipe.id}/shopping_cart/')
+        self.user_client.post(
+            f'/api/recipes/{self.own_recipe.id}/shopping_cart/'
+        )
+        self.assertShoppingListsValid()
+        self.assertEqual(
+            ShoppingListItem.objects.get(
+                user=self.user, ingredient=self.ingredient,
+            ).amount,
+            8,
+        )
+        ids = [recipe.id for recipe in self.recipes[:4]]
+        self.user_client.post(
+            '/api/recipes/shopping_cart/', {'ids': ids},
+            content_type='application/json',
+        )
+        self.assertShoppingListsValid()
+        self.user_client.delete(
+            '/api/recipes/shopping_cart/', {'ids': ids[1:]},
+            content_type='application/json',
+        )
+        self.assertShoppingListsValid()
+        self.user_client.delete(f'/api/recipes/{recipe.id}/shopping_cart/')
+        self.user_client.delete(
+            f'/api/recipes/{self.own_recipe.id}/shopping_cart/'
+        )
+        self.assertShoppingListsValid()
+        self.assertFalse(ShoppingListItem.objects.exists())
+
+    def test_recipe_changes(self):
+        Cart.objects.create(user=self.user, recipe=self.own_recipe)
+        Cart.objects.create(user=self.author, recipe=self.own_recipe)
+        Cart.objects.create(user=self.author, recipe=self.recipes[0])
+        self.assertShoppingListsValid()
+        response = self.user_client.patch(
+            f'/api/recipes/{self.own_recipe.id}/',
+            {
+                'name': 'Свой рецепт',
+                'text': 'Описание',
+                'cooking_time': 10,
+                'tags': [self.tag.id],
+                'ingredients': [
+                    {'id': self.ingredient.id, 'amount': 7},
+                    {'id': self.sugar.id, 'amount': 2},
+                ],
+            },
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertShoppingListsValid()
+        self.recipes[0].recipeingredient.create(
+            ingredient=self.pepper, amount=4,
+        )
+        self.assertShoppingListsValid()
+        self.own_recipe.delete()
+        self.assertShoppingListsValid()
+
+    def test_download_reads_materialized_list(self):
+        Cart.objects.create(user=self.user, recipe=self.own_recipe)
+        response = self.user_client.get(
+            '/api/recipes/download_shopping_cart/'
+        )
+        with CaptureQueriesContext(connection) as context:
+            content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content, 'Перец\t1\tг \nСоль\t3\tг \n')
+        self.assertEqual(len(context), 1)
+        self.assertNotIn('recipes_cart', context.captured_queries[0]['sql'])
+
+    def test_reconcile_command(self):
+        Cart.objects.create(user=self.user, recipe=self.own_recipe)
+        Cart.objects.create(user=self.author, recipe=self.recipes[0])
+        ShoppingListItem.objects.filter(user=self.user).update(amount=100)
+        ShoppingListItem.objects.filter(user=self.author).delete()
+        output = io.StringIO()
+        call_command('reconcile_shopping_lists', stdout=output)
+        self.assertIn('расхождений: 2', output.getvalue())
+        self.assertEqual(
+            ShoppingListItem.objects.filter(amount=100).count(), 2,
+        )
+        call_command('reconcile_shopping_lists', '--fix', stdout=output)
+        self.assertShoppingListsValid()
+        output = io.StringIO()
+        call_command('reconcile_shopping_lists', stdout=output)
+        self.assertIn('расхождений: 0', output.getvalue())
+
+
+class SubscriptionsTestCase(TestCase):
+    authors_amount = 100
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='reader', email='reader@foodgram.ru', password='pass',
+        )
+        cls.token = Token.objects.create(user=cls.user)
+        User.objects.bulk_create([
+            User(username=f'author{number}',
+                 email=f'author{number}@foodgram.ru')
+            for number in range(cls.authors_amount)
+        ])
+        cls.authors = list(User.objects.exclude(id=cls.user.id).order_by('id'))
+        for number, author in enumerate(cls.authors):
+            Follow.objects.create(user=cls.user, author=author)
+            for index in range(number % 5):
+                Recipe.objects.create(
+                    name=f'Рецепт {number}-{index}',
+                    text='Описание',
+                    image='recipes/images/test.png',
+                    cooking_time=10,
+                    author=author,
+                )
+
+    def setUp(self):
+        cache.clear()
+        self.user_client = Client(
+            HTTP_AUTHORIZATION=f'Token {self.token.key}'
+        )
+
+    def get(self, **params):
+        response = self.user_client.get('/api/users/subscriptions/', params)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return response.json()['results']
+
+    def test_previews_and_counts(self):
+        for limit in (None, 0, 2):
+            params = {'limit': self.authors_amount}
+            if limit is not None:
+                params['recipes_limit'] = limit
+            with self.subTest(recipes_limit=limit):
+                results = self.get(**params)
+                self.assertEqual(len(results), self.authors_amount)
+                for author, data in zip(self.authors, results):
+                    recipes = author.recipes.order_by('-pub_date', '-id')
+                    self.assertEqual(data['id'], author.id)
+                    self.assertTrue(data['is_subscribed'])
+                    self.assertEqual(data['recipes_count'], recipes.count())
+                    self.assertEqual(
+                        [recipe['id'] for recipe in data['recipes']],
+                        [recipe.id for recipe in recipes[:limit]],
+                    )
+
+    def test_query_count_does_not_depend_on_authors(self):
+        counts = []
+        for limit in (1, self.authors_amount):
+            with CaptureQueriesContext(connection) as context:
+                self.get(limit=limit, recipes_limit=3)
+            counts.append(len(context))
+        self.assertEqual(counts[0], counts[1])
+        self.assertLessEqual(counts[1], 4)
+
+    def test_invalid_recipes_limit(self):
+        for limit in ('abc', -1):
+            with self.subTest(recipes_limit=limit):
+                response = self.user_client.get(
+                    '/api/users/subscriptions/', {'recipes_limit': limit},
+                )
+                self.assertEqual(
+                    response.status_code, HTTPStatus.BAD_REQUEST,
+                )
+
+    def test_invalid_recipes_limit_does_not_subscribe(self):
+        author = User.objects.create_user(
+            username='newcomer', email='newcomer@foodgram.ru',
+        )
+        url = f'/api/users/{author.id}/subscribe/'
+        response = self.user_client.post(f'{url}?recipes_limit=abc')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertFalse(
+            Follow.objects.filter(user=self.user, author=author).exists()
+        )
+        response = self.user_client.post(f'{url}?recipes_limit=1')
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+
+
+class SubscriptionResolverTestCase(RecipeFixturesMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.authors = [
+            User.objects.create_user(
+                username=f'writer{number}',
+                email=f'writer{number}@foodgram.ru',
+            )
+            for number in range(10)
+        ]
+        for author in cls.authors[::2]:
+            Follow.objects.create(user=cls.user, author=author)
+
+    def get_context(self, **context):
+        request = Request(APIRequestFactory().get('/'))
+        request.user = self.user
+        return {'request': request, **context}
+
+    def count_follow_queries(self, serializer):
+        with CaptureQueriesContext(connection) as context:
+            data = serializer.data
+        return data, sum(
+            'users_follow' in query['sql']
+            for query in context.captured_queries
+        )
+
+    def test_users_share_one_query(self):
+        data, queries = self.count_follow_queries(UserSerializer(
+            self.authors, many=True, context=self.get_context(),
+        ))
+        self.assertEqual(queries, 1)
+        self.assertEqual(
+            [user['is_subscribed'] for user in data], [True, False] * 5,
+        )
+
+    def test_nested_authors_share_one_query(self):
+        Follow.objects.create(user=self.user, author=self.author)
+        recipes = list(Recipe.objects.all())
+        data, queries = self.count_follow_queries(RecipeGetSerializer(
+            recipes, many=True, context=self.get_context(),
+        ))
+        self.assertEqual(queries, 1)
+        self.assertTrue(all(
+            recipe['author']['is_subscribed'] for recipe in data
+        ))
+
+    def test_cached_by_viewer_version(self):
+        versions = DataVersion.objects.get_versions(
+            DataVersion.viewer(self.user.id),
+        )
+        context = {dimensions.CONTEXT_KEY: versions}
+        _, queries = self.count_follow_queries(UserSerializer(
+            self.authors, many=True, context=self.get_context(**context),
+        ))
+        self.assertEqual(queries, 1)
+        data, queries = self.count_follow_queries(UserSerializer(
+            self.authors, many=True, context=self.get_context(**context),
+        ))
+        self.assertEqual(queries, 0)
+        self.assertEqual(
+            [user['is_subscribed'] for user in data], [True, False] * 5,
+        )
+        response = self.user_client.post(
+            f'/api/users/{self.authors[1].id}/subscribe/'
+        )
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        versions = DataVersion.objects.get_versions(
+            DataVersion.viewer(self.user.id),
+        )
+        data, queries = self.count_follow_queries(UserSerializer(
+            self.authors, many=True,
+            context=self.get_context(**{dimensions.CONTEXT_KEY: versions}),
+        ))
+        self.assertEqual(queries, 1)
+        self.assertTrue(data[1]['is_subscribed'])
+
+
+class CounterTestCase(RecipeFixturesMixin, TestCase):
+
+    def assertCounters(self, obj, **counters):
+        obj.refresh_from_db()
+        for field, value in counters.items():
+            self.assertEqual(getattr(obj, field), value, field)
+
+    def test_relations(self):
+        recipe = self.recipes[0]
+        self.assertCounters(self.author, recipes_count=self.recipes_amount)
+        for name, field in (('favorite', 'favorites_count'),
+                            ('shopping_cart', 'cart_count')):
+            with self.subTest(name=name):
+                url = f'/api/recipes/{recipe.id}/{name}/'
+                self.user_client.post(url)
+                self.user_client.post(url)
+                self.assertCounters(recipe, **{field: 1})
+                self.user_client.post(
+                    f'/api/recipes/{name}/',
+                    {'ids': [recipe.id, self.recipes[1].id]},
+                    content_type='application/json',
+                )
+                self.assertCounters(recipe, **{field: 1})
+                self.assertCounters(self.recipes[1], **{field: 1})
+                self.user_client.delete(
+                    f'/api/recipes/{name}/',
+                    {'ids': [recipe.id, self.recipes[1].id]},
+                    content_type='application/json',
+                )
+                self.user_client.delete(url)
+                self.assertCounters(recipe, **{field: 0})
+                self.assertCounters(self.recipes[1], **{field: 0})
+        self.user_client.post(f'/api/users/{self.author.id}/subscribe/')
+        self.assertCounters(self.author, followers_count=1)
+        self.user_client.delete(
+            '/api/users/subscribe/', {'ids': [self.author.id]},
+            content_type='application/json',
+        )
+        self.assertCounters(self.author, followers_count=0)
+
+    def test_cascade_deletes(self):
+        recipe = self.recipes[0]
+        Favorites.objects.create(user=self.user, recipe=recipe)
+        Cart.objects.create(user=self.user, recipe=recipe)
+        Follow.objects.create(user=self.user, author=self.author)
+        self.assertCounters(recipe, favorites_count=1, cart_count=1)
+        self.assertCounters(self.author, followers_count=1)
+        self.user.delete()
+        self.assertCounters(recipe, favorites_count=0, cart_count=0)
+        self.assertCounters(self.author, followers_count=0)
+        recipe.delete()
+        self.assertCounters(
+            self.author, recipes_count=self.recipes_amount - 1,
+        )
+
+    def test_user_delete_is_bulk(self):
+        counts = []
+        for amount in (1, 10):
+            user = User.objects.create_user(
+                username=f'user{amount}', email=f'user{amount}@foodgram.ru',
+                password='pass',
+            )
+            for recipe in self.recipes[:amount]:
+                Favorites.objects.create(user=user, recipe=recipe)
+                Cart.objects.create(user=user, recipe=recipe)
+            Follow.objects.create(user=user, author=self.author)
+            Follow.objects.create(user=self.user, author=user)
+            name = DataVersion.viewer(self.user.id)
+            version, _ = DataVersion.objects.get_versions(name)[name]
+            with CaptureQueriesContext(connection) as context:
+                user.delete()
+            counts.append(len(context))
+            self.assertEqual(
+                DataVersion.objects.get_versions(name)[name][0], version + 1,
+            )
+            for recipe in self.recipes[:amount]:
+                self.assertCounters(recipe, favorites_count=0, cart_count=0)
+            self.assertCounters(self.author, followers_count=0)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_save_keeps_counters(self):
+        recipe = Recipe.objects.get(pk=self.recipes[0].pk)
+        author = User.objects.get(pk=self.author.pk)
+        Favorites.objects.create(user=self.user, recipe=recipe)
+        Follow.objects.create(user=self.user, author=author)
+        recipe.name = 'Новое название'
+        recipe.save()
+        author.first_name = 'Автор'
+        author.save()
+        self.assertCounters(recipe, favorites_count=1, name='Новое название')
+        self.assertCounters(author, followers_count=1, first_name='Автор')
+
+    def test_reconcile_command(self):
+        Favorites.objects.create(user=self.user, recipe=self.recipes[0])
+        User.objects.filter(pk=self.author.pk).update(recipes_count=0)
+        Recipe.objects.update(favorites_count=5)
+        output = io.StringIO()
+        call_command('reconcile_counters', stdout=output)
+        self.assertIn('User.recipes_count: расхождений 1', output.getvalue())
+        self.assertIn(
+            f'Recipe.favorites_count: расхождений {self.recipes_amount}',
+            output.getvalue(),
+        )
+        call_command('reconcile_counters', '--fix', stdout=output)
+        self.assertCounters(self.author, recipes_count=self.recipes_amount)
+        self.assertCounters(self.recipes[0], favorites_count=1)
+        self.assertCounters(self.recipes[1], favorites_count=0)
+        output = io.StringIO()
+        call_command('reconcile_counters', stdout=output)
+        self.assertNotIn('расхождений 1', output.getvalue())
+
+
+@skipIf(
+    connection.vendor == 'sqlite',
+    'SQLite в памяти блокирует таблицы без ожидания',
+)
+class ConcurrentCounterTestCase(TransactionTestCase):
+
+    workers = 8
+
+    def setUp(self):
+        self.author = User.objects.create_user(
+            username='author', email='author@foodgram.ru', password='pass',
+        )
+        self.recipe = Recipe.objects.create(
+            name='Рецепт', text='Описание', image='recipes/images/test.png',
+            cooking_time=10, author=self.author,
+        )
+        self.tokens = [
+            Token.objects.create(user=User.objects.create_user(
+                username=f'reader{number}',
+                email=f'reader{number}@foodgram.ru',
+            )).key
+            for number in range(self.workers)
+        ]
+
+    def run_parallel(self, method, url):
+        def request(token):
+            try:
+                client = Client(HTTP_AUTHORIZATION=f'Token {token}')
+                return getattr(client, method)(url).status_code
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            return list(executor.map(request, self.tokens))
+
+    def test_parallel_increments(self):
+        for url, obj, field in (
+            (f'/api/recipes/{self.recipe.id}/favorite/', self.recipe,
+             'favorites_count'),
+            (f'/api/recipes/{self.recipe.id}/shopping_cart/', self.recipe,
+             'cart_count'),
+            (f'/api/users/{self.author.id}/subscribe/', self.author,
+             'followers_count'),
+        ):
+            with self.subTest(url=url):
+                self.run_parallel('post', url)
+                obj.refresh_from_db()
+                self.assertEqual(getattr(obj, field), self.workers)
+                self.run_parallel('delete', url)
+                obj.refresh_from_db()
+                self.assertEqual(getattr(obj, field), 0)
+
+
+@override_settings(FEED_FANOUT_THRESHOLD=1)
+class FeedTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.writer, cls.star, cls.fan, cls.stranger = [
+            User.objects.create_user(
+                username=name, email=f'{name}@foodgram.ru', password='pass',
+            )
+            for name in ('reader', 'writer', 'star', 'fan', 'stranger')
+        ]
+        cls.token = Token.objects.create(user=cls.user)
+        Follow.objects.create(user=cls.user, author=cls.writer)
+        Follow.objects.create(user=cls.user, author=cls.star)
+        Follow.objects.create(user=cls.fan, author=cls.star)
+        for number in range(4):
+            for author in (cls.writer, cls.star, cls.stranger):
+                cls.create_recipe(author, number)
+
+    @staticmethod
+    def create_recipe(author, number):
+        return Recipe.objects.create(
+            name=f'Рецепт {author.username} {number}',
+            text='Описание',
+            image='recipes/images/test.png',
+            cooking_time=10,
+            author=author,
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.user_client = Client(
+            HTTP_AUTHORIZATION=f'Token {self.token.key}'
+        )
+
+    def get_feed_ids(self, limit=3):
+        ids = []
+        url, params = '/api/recipes/feed/', {'limit': limit}
+        while url:
+            response = self.user_client.get(url, params)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            data = response.json()
+            ids.extend(recipe['id'] for recipe in data['results'])
+            url, params = data['next'], None
+        return ids
+
+    def expected_ids(self, *authors):
+        return list(
+            Recipe.objects.filter(author__in=authors)
+            .order_by('-pub_date', '-id').values_list('id', flat=True)
+        )
+
+    def timeline_ids(self, user):
+        return set(
+            TimelineEntry.objects.filter(user=user)
+            .values_list('recipe_id', flat=True)
+        )
+
+    def test_fan_out_on_write_and_read(self):
+        self.assertEqual(
+            self.timeline_ids(self.user), set(self.expected_ids(self.writer)),
+        )
+        self.assertFalse(TimelineEntry.objects.filter(user=self.fan).exists())
+        self.assertEqual(
+            self.get_feed_ids(), self.expected_ids(self.writer, self.star),
+        )
+
+    def test_pages_merge_timeline_and_fan_out_on_read(self):
+        expected = self.expected_ids(self.writer, self.star)
+        for limit in (1, 2, 5):
+            with self.subTest(limit=limit):
+                self.assertEqual(self.get_feed_ids(limit), expected)
+        response = self.user_client.get('/api/recipes/feed/', {'limit': 5})
+        response = self.user_client.get(response.json()['next'])
+        response = self.user_client.get(response.json()['previous'])
+        self.assertEqual(
+            [recipe['id'] for recipe in response.json()['results']],
+            expected[:5],
+        )
+
+    def test_page_reads_timeline_keys(self):
+        with CaptureQueriesContext(connection) as context:
+            self.get_feed_ids(limit=2)
+        recipe_queries = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('SELECT "recipes_recipe"."id"')
+        ]
+        self.assertTrue(recipe_queries)
+        for sql in recipe_queries:
+            self.assertNotIn('recipes_timelineentry', sql)
+            self.assertNotIn(' OR ', sql)
+        self.assertTrue(any(
+            'FROM "recipes_timelineentry"' in query['sql']
+            and 'LIMIT 3' in query['sql']
+            for query in context.captured_queries
+        ))
+
+    def test_migration_backfills_timelines(self):
+        migration = importlib.import_module(
+            'recipes.migrations.0011_timelineentry'
+        )
+        TimelineEntry.objects.all().delete()
+        with override_settings(FEED_TIMELINE_LENGTH=3):
+            migration.fill_timelines(apps, None)
+        self.assertEqual(
+            self.timeline_ids(self.user),
+            set(self.expected_ids(self.writer)[:3]),
+        )
+        self.assertFalse(TimelineEntry.objects.filter(user=self.fan).exists())
+
+    def test_follow_changes(self):
+        self.user_client.delete(f'/api/users/{self.writer.id}/subscribe/')
+        self.assertEqual(self.timeline_ids(self.user), set())
+        self.assertEqual(self.get_feed_ids(), self.expected_ids(self.star))
+        self.user_client.post(
+            '/api/users/subscribe/',
+            {'ids': [self.writer.id, self.stranger.id]},
+            content_type='application/json',
+        )
+        self.assertEqual(
+            self.get_feed_ids(),
+            self.expected_ids(self.writer, self.star, self.stranger),
+        )
+        recipe = self.create_recipe(self.stranger, 10)
+        self.assertIn(recipe.id, self.timeline_ids(self.user))
+        self.assertEqual(self.get_feed_ids(limit=100)[0], recipe.id)
+
+    def test_rebuild_command(self):
+        TimelineEntry.objects.all().delete()
+        TimelineEntry.objects.create(
+            user=self.fan, recipe=Recipe.objects.first(),
+            pub_date=Recipe.objects.first().pub_date,
+        )
+        call_command('rebuild_timelines', stdout=io.StringIO())
+        self.assertEqual(
+            self.timeline_ids(self.user), set(self.expected_ids(self.writer)),
+        )
+        self.assertFalse(TimelineEntry.objects.filter(user=self.fan).exists())
+        with override_settings(FEED_TIMELINE_LENGTH=2):
+            call_command(
+                'rebuild_timelines', '--trim-only', stdout=io.StringIO(),
+            )
+        self.assertEqual(
+            self.timeline_ids(self.user),
+            set(self.expected_ids(self.writer)[:2]),
+        )
+
+
+class ViewerContextTestCase(RecipeFixturesMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.favorites = cls.recipes[::2]
+        for recipe in cls.favorites:
+            Favorites.objects.create(user=cls.user, recipe=recipe)
+        Cart.objects.create(user=cls.user, recipe=cls.recipes[1])
+
+    def get_recipes(self, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.user_client.get(
+                '/api/recipes/', {'limit': self.recipes_amount, **params},
+            )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return response.json()['results'], sum(
+            'recipes_favorites' in query['sql']
+            for query in context.captured_queries
+        )
+
+    def assertFlags(self, results):
+        favorite_ids = {recipe.id for recipe in self.favorites}
+        for recipe in results:
+            self.assertEqual(
+                recipe['is_favorited'], recipe['id'] in favorite_ids,
+            )
+            self.assertEqual(
+                recipe['is_in_shopping_cart'],
+                recipe['id'] == self.recipes[1].id,
+            )
+
+    def test_id_set(self):
+        ids = IdSet([5, 1, 3])
+        self.assertEqual(list(ids), [1, 3, 5])
+        self.assertIn(3, ids)
+        self.assertNotIn(4, ids)
+        self.assertNotIn(6, ids)
+
+    def test_filter_and_serializer_share_one_query(self):
+        results, queries = self.get_recipes(is_favorited=1)
+        self.assertEqual(queries, 1)
+        self.assertEqual(
+            {recipe['id'] for recipe in results},
+            {recipe.id for recipe in self.favorites},
+        )
+        self.assertFlags(results)
+        results, queries = self.get_recipes(is_favorited=1)
+        self.assertEqual(queries, 0)
+        Favorites.objects.create(user=self.user, recipe=self.recipes[1])
+        results, queries = self.get_recipes(is_favorited=1)
+        self.assertEqual(queries, 1)
+        self.assertEqual(len(results), len(self.favorites) + 1)
+
+    @override_settings(VIEWER_MAX_IDS=2)
+    def test_large_sets_are_not_loaded(self):
+        # Попытка загрузки и проверка страницы, с фильтром ещё выборка
+        # и подсчёт через соединение с избранным.
+        for params, expected in (({}, 2), ({'is_favorited': 1}, 4)):
+            with self.subTest(params=params):
+                cache.clear()
+                results, queries = self.get_recipes(**params)
+                self.assertFlags(results)
+                self.assertEqual(queries, expected)
+        self.assertEqual(
+            {recipe['id'] for recipe in results},
+            {recipe.id for recipe in self.favorites},
+        )
+        recipe = self.recipes[1]
+        response = self.user_client.get(f'/api/recipes/{recipe.id}/')
+        self.assertFalse(response.json()['is_favorited'])
+        self.assertTrue(response.json()['is_in_shopping_cart'])
+
+    @override_settings(VIEWER_MAX_IDS=2)
+    def test_over_limit_is_cached(self):
+        # Второй запрос той же версии не повторяет попытку загрузки
+        # и проверяет только страницу.
+        cache.clear()
+        for expected in (2, 1):
+            results, queries = self.get_recipes()
+            self.assertFlags(results)
+            self.assertEqual(queries, expected)
+        Favorites.objects.create(user=self.user, recipe=self.recipes[1])
+        results, queries = self.get_recipes()
+        self.assertEqual(queries, 2)
@@ -0,0 +1,146 @@
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+
+from recipes import dimensions
+from recipes.models import Cart, DataVersion, Favorites
+from users.models import Follow
+
+FAVORITES = 'favorites'
+CART = 'cart'
+SUBSCRIPTIONS = 'subscriptions'
+# Значение в кэше для множеств больше VIEWER_MAX_IDS.
+OVER_LIMIT = 'over-limit'
+
+
+class IdSet:
+    """Неизменяемое множество id в виде отсортированного массива.
+
+    Занимает 8 байт на id, проверка вхождения — двоичный поиск.
+    """
+
+    def __init__(self, ids):
+        self.ids = array('q', sorted(ids))
+
+    def __contains__(self, pk):
+        index = bisect_left(self.ids, pk)
+        return index < len(self.ids) and self.ids[index] == pk
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ViewerContext:
+    """Избранное, корзина и подписки пользователя запроса.
+
+    Каждое множество загружается одним запросом при первом обращении
+    и используется всеми фильтрами и сериализаторами запроса. Если
+    версия данных зрителя известна из условного GET, множества берутся
+    из кэша. Множества больше VIEWER_MAX_IDS не загружаются: для таких
+    пользователей связи проверяются только для объектов текущей
+    страницы (preload), поэтому память ограничена. То, что множество
+    слишком велико, тоже кэшируется, и следующие запросы той же версии
+    сразу переходят к preload.
+    """
+
+    relations = {
+        FAVORITES: (Favorites, 'recipe_id'),
+        CART: (Cart, 'recipe_id'),
+        SUBSCRIPTIONS: (Follow, 'author_id'),
+    }
+
+    def __init__(self, user, version=None):
+        self.user = user
+        self.version = version
+        self.sets = {}
+        self.members = {relation: {} for relation in self.relations}
+
+    def get_cache_key(self, relation):
+        if self.version is None:
+            return None
+        return f'viewer-ids:{self.user.id}:{relation}:{self.version[0]}'
+
+    def get_ids(self, relation):
+        """IdSet связей или None, если их больше VIEWER_MAX_IDS."""
+        if relation not in self.sets:
+            self.sets[relation] = self.load(relation)
+        return self.sets[relation]
+
+    def load(self, relation):
+        if self.user.is_anonymous:
+            return IdSet(())
+        key = self.get_cache_key(relation)
+        ids = cache.get(key) if key else None
+        if ids == OVER_LIMIT:
+            return None
+        if ids is not None:
+            return ids
+        model, field = self.relations[relation]
+        limit = settings.VIEWER_MAX_IDS
+        pks = model.objects.filter(user=self.user).values_list(
+            field, flat=True,
+        )[:limit + 1]
+        ids = IdSet(pks)
+        if len(ids) > limit:
+            ids = None
+        if key:
+            cache.set(
+                key, OVER_LIMIT if ids is None else ids,
+                settings.RECIPE_CACHE_TIMEOUT,
+            )
+        return ids
+
+    def preload(self, relation, pks):
+        """Проверяет связи сразу для нескольких объектов одним запросом.
+
+        Нужен только пользователям, чьи множества не загружаются целиком.
+        """
+        members = self.members[relation]
+        pks = [pk for pk in pks if pk not in members]
+        if not pks or self.get_ids(relation) is not None:
+            return
+        model, field = self.relations[relation]
+        members.update(dict.fromkeys(pks, False))
+        members.update(dict.fromkeys(
+            model.objects.filter(
+                user=self.user, **{f'{field}__in': pks}
+            ).values_list(field, flat=True),
+            True,
+        ))
+
+    def contains(self, relation, pk):
+        ids = self.get_ids(relation)
+        if ids is not None:
+            return pk in ids
+        self.preload(relation, [pk])
+        return self.members[relation][pk]
+
+
+def get_viewer(request):
+    """ViewerContext запроса, создаётся при первом обращении."""
+    viewer = getattr(request, 'viewer', None)
+    if viewer is None:
+        viewer = request.viewer = ViewerContext(request.user)
+    return viewer
+
+
+def get_context_viewer(context):
+    """ViewerContext из контекста сериализатора.
+
+    Версия данных зрителя берётся из версий, которые вьюсет
+    уже загрузил для условного GET.
+    """
+    request = context.get('request')
+    if request is None:
+        return ViewerContext(AnonymousUser())
+    viewer = get_viewer(request)
+    versions = context.get(dimensions.CONTEXT_KEY)
+    if viewer.version is None and versions and request.user.is_authenticated:
+        viewer.version = versions.get(DataVersion.viewer(request.user.id))
+    return viewer
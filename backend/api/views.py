@@ -1,37 +1,85 @@
-import io
-
-from django.db.models import Sum
-from django.http import FileResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
 
-from api.filters import IngredientFilter, RecipeFilter
-from api.paginations import CustomPagination
-from api.serializers import (IngredientSerializer, RecipeGetSerializer,
-                             RecipePostSerializer, TagSerializer)
+from api.batch import batch_add, batch_remove, get_batch_results
+from api.exports import EXPORT_FORMATS, get_shopping_list, stream_export
+from api.filters import IngredientFilter, NameSearchFilter, RecipeFilter
+from api.mixins import ConditionalGetMixin
+from api.paginations import FeedPagination, RecipePagination
+from api.renderers import ShoppingListCSVRenderer, ShoppingListTextRenderer
+from api.serializers import (IdListSerializer, IngredientSerializer,
+                             RecipeGetSerializer, RecipePostSerializer,
+                             TagSerializer)
 from django_filters.rest_framework import DjangoFilterBackend
-from recipes.models import (Cart, Favorites, Ingredient, Recipe,
-                            RecipeIngredient, Tag)
+from recipes import dimensions
+from recipes.ingredient_index import ingredient_index
+from recipes.models import (Cart, DataVersion, Favorites, Ingredient, Recipe,
+                            Tag)
 from recipes.serializers import ShortRecipeSerializer
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
-from rest_framework.filters import SearchFilter
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from users.permissions import IsAuthorOrReadOnly
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+def get_recipe_id(pk):
+    """Id рецепта из url в виде числа, нечисловой id даёт 404."""
+    try:
+        return int(pk)
+    except ValueError:
+        raise Http404
+
+
+class RecipeViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """Вьюсет с реализацией добавления/удаления.
 
     В Избраное и Корзину покупок,
     а также возможностью выгрузить Список покупок.
     """
 
-    queryset = Recipe.objects.order_by('-pub_date')
-    pagination_class = CustomPagination
-    filter_backends = [DjangoFilterBackend, SearchFilter]
+    queryset = Recipe.objects.order_by('-pub_date', '-id')
+    pagination_class = RecipePagination
+    filter_backends = [DjangoFilterBackend, NameSearchFilter]
     filterset_class = RecipeFilter
     permission_classes = (IsAuthorOrReadOnly,)
+    version_name = DataVersion.RECIPES
+    extra_version_names = (DataVersion.TAGS, DataVersion.INGREDIENTS)
+    viewer_specific = True
+
+    def get_queryset(self):
+        # Для чтения флаги зрителя берутся из ViewerContext запроса.
+        if self.action in ('list', 'retrieve', 'feed'):
+            return self.queryset
+        return self.queryset.with_viewer_flags(self.request.user)
+
+    def get_detail_validators(self, request, pk):
+        try:
+            updated_at = Recipe.objects.filter(pk=pk).values_list(
+                'updated_at', flat=True,
+            ).first()
+        except ValueError:
+            return None
+        if updated_at is None:
+            return None
+        versions = [(updated_at.isoformat(), updated_at)]
+        if request.user.is_authenticated:
+            # Версии справочников читаются тем же запросом, что и версия
+            # зрителя, и пригодятся сериализатору.
+            versions += self.load_versions(
+                request, self.get_version_names(request)[1:],
+            ).values()
+        return self.build_validators(request, versions)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if hasattr(self, 'versions'):
+            context[dimensions.CONTEXT_KEY] = self.versions
+        return context
 
     def get_serializer_class(self):
         if self.request.method in ['POST', 'PATCH']:
@@ -39,24 +87,37 @@ class RecipeViewSet(viewsets.ModelViewSet):
         return RecipeGetSerializer
 
     def add_to(self, model, user, pk):
-        if Recipe.objects.filter(id=pk).exists():
-            obj, created = model.objects.get_or_create(
-                user=user, recipe=Recipe.objects.get(id=pk),
-            )
-            if created:
-                serializer = ShortRecipeSerializer(Recipe.objects.get(id=pk))
-                return Response(
-                    serializer.data, status=status.HTTP_201_CREATED
-                )
-        return Response(status=status.HTTP_400_BAD_REQUEST)
+        pk = get_recipe_id(pk)
+        if model.relations.add(user, pk) is None:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        serializer = ShortRecipeSerializer(Recipe.objects.get(id=pk))
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def remove_from(self, model, user, pk):
-        recipe = get_object_or_404(Recipe, pk=pk)
-        if model.objects.filter(user=user, recipe=recipe).exists():
-            model.objects.filter(user=user, recipe=recipe).delete()
+        pk = get_recipe_id(pk)
+        if model.relations.remove(user, pk):
             return Response(status=status.HTTP_204_NO_CONTENT)
+        get_object_or_404(Recipe, pk=pk)
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
+    def add_many(self, model, request):
+        serializer = IdListSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        statuses = batch_add(
+            model, request.user, Recipe.objects,
+            serializer.validated_data['ids'],
+        )
+        return Response(get_batch_results(statuses))
+
+    def remove_many(self, model, request):
+        serializer = IdListSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        statuses = batch_remove(
+            model, request.user, Recipe.objects,
+            serializer.validated_data['ids'],
+        )
+        return Response(get_batch_results(statuses))
+
     @action(
         detail=True,
         methods=('POST',),
@@ -70,6 +131,19 @@ class RecipeViewSet(viewsets.ModelViewSet):
     def delete_from_favorite(self, request, pk):
         return self.remove_from(Favorites, request.user, pk)
 
+    @action(
+        detail=False,
+        methods=('POST',),
+        url_path='favorite',
+        permission_classes=(IsAuthenticated,),
+    )
+    def favorite_many(self, request):
+        return self.add_many(Favorites, request)
+
+    @favorite_many.mapping.delete
+    def delete_many_from_favorite(self, request):
+        return self.remove_many(Favorites, request)
+
     @action(
         detail=True,
         methods=('POST',),
@@ -83,42 +157,124 @@ class RecipeViewSet(viewsets.ModelViewSet):
     def delete_from_shopping_cart(self, request, pk):
         return self.remove_from(Cart, request.user, pk)
 
+    @action(
+        detail=False,
+        methods=('POST',),
+        url_path='shopping_cart',
+        permission_classes=(IsAuthenticated,),
+    )
+    def shopping_cart_many(self, request):
+        return self.add_many(Cart, request)
+
+    @shopping_cart_many.mapping.delete
+    def delete_many_from_shopping_cart(self, request):
+        return self.remove_many(Cart, request)
+
+    @action(
+        detail=False,
+        methods=('GET',),
+        url_path='feed',
+        permission_classes=(IsAuthenticated,),
+        pagination_class=FeedPagination,
+    )
+    def feed(self, request):
+        """Рецепты авторов из подписок пользователя, от новых к старым."""
+        return self.conditional_response(
+            request, self.get_list_validators(request), self.get_feed,
+        )
+
+    def get_feed(self, request):
+        page = self.paginate_queryset(self.get_queryset())
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
     @action(
         detail=False,
         methods=('GET',),
         url_path='download_shopping_cart',
         permission_classes=(IsAuthenticated,),
+        renderer_classes=(
+            ShoppingListTextRenderer, ShoppingListCSVRenderer, JSONRenderer,
+        ),
     )
     def download_shopping_cart(self, request):
-        shopping_cart = (
-            RecipeIngredient.objects.filter(recipe__cart__user=request.user)
-            .values(
-                'ingredient__name',
-                'ingredient__measurement_unit',
+        """Список покупок в формате txt, csv или json (?format=).
+
+        Формат выбирается стандартным согласованием DRF, выгрузка
+        отдаётся потоком, небольшие результаты кэшируются по версии
+        корзины пользователя.
+        """
+        versions = DataVersion.objects.get_versions(
+            DataVersion.RECIPES, DataVersion.INGREDIENTS,
+            DataVersion.viewer(request.user.id),
+        )
+        # Формат может прийти в Accept, а не в url, поэтому он входит
+        # в валидаторы и в ключ кэша наравне с версиями.
+        validators = self.build_validators(
+            request,
+            [*versions.values(), (request.accepted_renderer.format, None)],
+        )
+        response = self.conditional_response(
+            request, validators, self.export_shopping_cart, validators[0],
+        )
+        patch_vary_headers(response, ('Accept',))
+        return response
+
+    def export_shopping_cart(self, request, etag):
+        file_format = request.accepted_renderer.format
+        content_type, export = EXPORT_FORMATS[file_format]
+        cache_key = f'shopping-list:{etag}'
+        content = cache.get(cache_key)
+        if content is None:
+            response = StreamingHttpResponse(
+                stream_export(
+                    export(get_shopping_list(request.user)), cache_key,
+                ),
+                content_type=content_type,
             )
-            .annotate(amount=Sum('amount'))
-            .order_by('ingredient__name')
+        else:
+            response = HttpResponse(content, content_type=content_type)
+            response['Content-Length'] = len(content)
+        response['Content-Disposition'] = (
+            f'attachment; filename="shopping_cart.{file_format}"'
         )
-        output = io.StringIO()
-        for item in shopping_cart:
-            output.write(f"{item['ingredient__name']}\t")
-            output.write(f"{item['amount']}\t")
-            output.write(f"{item['ingredient__measurement_unit']} \n")
-        response = FileResponse(output.getvalue(), content_type='text/plain')
-        response['Content-Disposition'] = ('attachment;'
-                                           ' filename="shopping_cart.txt"')
         return response
 
 
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+class TagViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Tag.objects.order_by('id')
+    version_name = DataVersion.TAGS
     serializer_class = TagSerializer
     pagination_class = None
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Ingredient.objects.order_by('id')
+    version_name = DataVersion.INGREDIENTS
     serializer_class = IngredientSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_class = IngredientFilter
     search_fields = ('^name',)
+
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if not name or not settings.INGREDIENT_INDEX_ENABLED:
+            return super().list(request, *args, **kwargs)
+        return self.conditional_response(
+            request, self.get_list_validators(request), self.search, name,
+        )
+
+    def search(self, request, name):
+        return Response(ingredient_index.search(
+            name,
+            self.versions[DataVersion.INGREDIENTS],
+            settings.INGREDIENT_SEARCH_LIMIT,
+        ))
+
+    def filter_queryset(self, queryset):
+        # Без индекса поиск идёт через search_by_name; ответ ограничен
+        # так же, как у индекса, чтобы настройка не меняла его размер.
+        queryset = super().filter_queryset(queryset)
+        if self.request.query_params.get('name'):
+            return queryset[:settings.INGREDIENT_SEARCH_LIMIT]
+        return queryset
@@ -26,3 +26,9 @@ MIN_COOKING_TIME_VALUE = 1
 MAX_COOKING_TIME_VALUE = 4320
 
 FILTER_VALUE = [0, 1]
+
+MAX_BATCH_SIZE = 100
+
+MAX_INLINE_IDS = 500
+
+SEARCH_CONFIG = 'russian'
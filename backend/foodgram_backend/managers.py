@@ -0,0 +1,151 @@
+from django.db import connections, models, transaction
+from django.db.models.signals import post_delete, post_save
+
+
+def delete_rows(queryset):
+    """Удаляет строки выборки одним DELETE, без сигналов и каскадов.
+
+    Для моделей с получателями post_delete, когда построчные сигналы
+    не нужны. Возвращает число удалённых строк.
+    """
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    opts = queryset.model._meta
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {qn(opts.db_table)} '
+            f'WHERE {qn(opts.pk.column)} IN ({sql})',
+            params,
+        )
+        return cursor.rowcount
+
+
+class RelationManager(models.Manager):
+    """Менеджер связей пользователя с объектом (избранное, подписки).
+
+    Добавление и удаление выполняются одним запросом
+    INSERT ... ON CONFLICT DO NOTHING RETURNING и DELETE ... RETURNING,
+    поэтому параллельные запросы не приводят к ошибкам уникальности,
+    а результат отражает то, что сделал именно этот запрос.
+    Для одиночных связей сигналы post_save и post_delete отправляются
+    вручную в той же транзакции, что и запрос, пакетные add_many
+    и remove_many их не отправляют.
+    Подключается вторым менеджером (relations): менеджеры обратных связей
+    вроде user.favorites Django строит на основе менеджера по умолчанию,
+    и методы add/remove не должны им достаться.
+    """
+
+    def __init__(self, target_field):
+        super().__init__()
+        self.target_field = target_field
+
+    def get_sql_names(self, connection):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        target = opts.get_field(self.target_field)
+        target_opts = target.related_model._meta
+        return {
+            'table': qn(opts.db_table),
+            'pk': qn(opts.pk.column),
+            'user': qn(opts.get_field('user').column),
+            'target': qn(target.column),
+            'target_table': qn(target_opts.db_table),
+            'target_pk': qn(target_opts.pk.column),
+        }
+
+    def prepare_target_id(self, target_id):
+        field = self.model._meta.get_field(self.target_field)
+        return field.target_field.get_prep_value(target_id)
+
+    def execute_returning(self, sql, params, **names):
+        """Первые значения всех строк, возвращённых RETURNING."""
+        connection = connections[self.db]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                sql.format(**self.get_sql_names(connection), **names),
+                params,
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def build_instance(self, pk, user, target_id):
+        return self.model(**{
+            'pk': pk,
+            'user': user,
+            f'{self.target_field}_id': target_id,
+        })
+
+    def add(self, user, target_id):
+        """Создаёт связь, если объект существует и связи ещё нет.
+
+        Возвращает созданную связь или None.
+        """
+        target_id = self.prepare_target_id(target_id)
+        with transaction.atomic(using=self.db):
+            pks = self.execute_returning(
+                'INSERT INTO {table} ({user}, {target}) '
+                'SELECT %s, {target_pk} FROM {target_table} '
+                'WHERE {target_pk} = %s '
+                'ON CONFLICT DO NOTHING RETURNING {pk}',
+                [user.pk, target_id],
+            )
+            if not pks:
+                return None
+            pk, = pks
+            instance = self.build_instance(pk, user, target_id)
+            post_save.send(
+                sender=self.model, instance=instance, created=True,
+                update_fields=None, raw=False, using=self.db,
+            )
+        return instance
+
+    def remove(self, user, target_id):
+        """Удаляет связь. Возвращает True, если она существовала."""
+        target_id = self.prepare_target_id(target_id)
+        with transaction.atomic(using=self.db):
+            pks = self.execute_returning(
+                'DELETE FROM {table} WHERE {user} = %s AND {target} = %s '
+                'RETURNING {pk}',
+                [user.pk, target_id],
+            )
+            if not pks:
+                return False
+            pk, = pks
+            post_delete.send(
+                sender=self.model,
+                instance=self.build_instance(pk, user, target_id),
+                using=self.db,
+            )
+        return True
+
+    def add_many(self, user, target_ids):
+        """Создаёт связи с существующими объектами из target_ids.
+
+        Возвращает id объектов, связи с которыми создал именно этот
+        запрос. Сигналы post_save не отправляются.
+        """
+        if not target_ids:
+            return []
+        return self.execute_returning(
+            'INSERT INTO {table} ({user}, {target}) '
+            'SELECT %s, {target_pk} FROM {target_table} '
+            'WHERE {target_pk} IN ({ids}) '
+            'ON CONFLICT DO NOTHING RETURNING {target}',
+            [user.pk, *map(self.prepare_target_id, target_ids)],
+            ids=', '.join(['%s'] * len(target_ids)),
+        )
+
+    def remove_many(self, user, target_ids):
+        """Удаляет связи с объектами из target_ids.
+
+        Возвращает id объектов, связи с которыми удалил именно этот
+        запрос. Сигналы post_delete не отправляются.
+        """
+        if not target_ids:
+            return []
+        return self.execute_returning(
+            'DELETE FROM {table} WHERE {user} = %s AND {target} IN ({ids}) '
+            'RETURNING {target}',
+            [user.pk, *map(self.prepare_target_id, target_ids)],
+            ids=', '.join(['%s'] * len(target_ids)),
+        )
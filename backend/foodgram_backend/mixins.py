@@ -0,0 +1,18 @@
+class CounterFieldsMixin:
+    """Модель с денормализованными счётчиками.
+
+    Счётчики меняются только атомарными UPDATE с F(), поэтому save()
+    существующего объекта их не перезаписывает: иначе устаревшее
+    значение из памяти затёрло бы параллельные изменения.
+    """
+
+    counter_fields = ()
+
+    def save(self, *args, update_fields=None, **kwargs):
+        if update_fields is None and not self._state.adding:
+            skipped = {*self.counter_fields, *self.get_deferred_fields()}
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in skipped
+            ]
+        super().save(*args, update_fields=update_fields, **kwargs)
@@ -24,6 +24,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'recipes.apps.RecipesConfig',
     'colorfield',
     'rest_framework',
@@ -75,6 +76,20 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': config(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache',
+        ),
+        'LOCATION': config('CACHE_LOCATION', default='foodgram'),
+    }
+}
+
+RECIPE_CACHE_TIMEOUT = config(
+    'RECIPE_CACHE_TIMEOUT', default=60 * 60 * 24, cast=int
+)
+
 DJOSER = {
     'LOGIN_FIELD': 'email',
     'HIDE_USERS': False,
@@ -98,6 +113,44 @@ REST_FRAMEWORK = {
     ],
 }
 
+PAGINATION_COUNT_ESTIMATE_THRESHOLD = config(
+    'PAGINATION_COUNT_ESTIMATE_THRESHOLD', default=10000, cast=int
+)
+PAGINATION_COUNT_CACHE_TIMEOUT = config(
+    'PAGINATION_COUNT_CACHE_TIMEOUT', default=60, cast=int
+)
+
+INGREDIENT_INDEX_ENABLED = config(
+    'INGREDIENT_INDEX_ENABLED', default=True, cast=bool
+)
+INGREDIENT_SEARCH_LIMIT = config(
+    'INGREDIENT_SEARCH_LIMIT', default=100, cast=int
+)
+RECIPE_MATCH_LIMIT = config('RECIPE_MATCH_LIMIT', default=500, cast=int)
+RECIPE_INDEX_SYNC_MARGIN = config(
+    'RECIPE_INDEX_SYNC_MARGIN', default=300, cast=int
+)
+
+FEED_FANOUT_THRESHOLD = config(
+    'FEED_FANOUT_THRESHOLD', default=1000, cast=int
+)
+FEED_TIMELINE_LENGTH = config('FEED_TIMELINE_LENGTH', default=500, cast=int)
+
+VIEWER_MAX_IDS = config('VIEWER_MAX_IDS', default=10000, cast=int)
+
+SHOPPING_LIST_CHUNK_SIZE = config(
+    'SHOPPING_LIST_CHUNK_SIZE', default=500, cast=int
+)
+SHOPPING_LIST_BLOCK_SIZE = config(
+    'SHOPPING_LIST_BLOCK_SIZE', default=8192, cast=int
+)
+SHOPPING_LIST_CACHE_MAX_SIZE = config(
+    'SHOPPING_LIST_CACHE_MAX_SIZE', default=256 * 1024, cast=int
+)
+SHOPPING_LIST_CACHE_TIMEOUT = config(
+    'SHOPPING_LIST_CACHE_TIMEOUT', default=60 * 60, cast=int
+)
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Пакетные добавление и удаление связей пользователя (batch_add,
+# batch_remove) обходят post_save и post_delete отдельных строк.
+# Аргументы: sender — модель связи, user, target_ids.
+relations_added = Signal()
+relations_removed = Signal()
@@ -32,13 +32,17 @@ class UserAdmin(PaginatedAdminPanel):
     list_display_links = ('username',)
     ordering = ('username',)
 
-    @admin.display(description='Количество рецептов')
+    @admin.display(
+        description='Количество рецептов', ordering='recipes_count',
+    )
     def count_recipes(self, obj):
-        return obj.recipes.count()
+        return obj.recipes_count
 
-    @admin.display(description='Количество подписчиков')
+    @admin.display(
+        description='Количество подписчиков', ordering='followers_count',
+    )
     def count_followers(self, obj):
-        return obj.subscribe.count()
+        return obj.followers_count
 
 
 @admin.register(Recipe)
@@ -59,9 +63,11 @@ class RecipeAdmin(PaginatedAdminPanel):
     inlines = (IngredientsInline,)
     filter_horizontal = ('tags',)
 
-    @admin.display(description='Добавлений в Избранное')
+    @admin.display(
+        description='Добавлений в Избранное', ordering='favorites_count',
+    )
     def count_favorites(self, recipe):
-        return recipe.favorites.count()
+        return recipe.favorites_count
 
     @admin.display(description='Теги')
     def get_tags(self, recipe):
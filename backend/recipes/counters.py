@@ -0,0 +1,63 @@
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from recipes.models import Cart, Favorites, Recipe
+from users.models import Follow, User
+
+# Счётчик: (модель, поле, модель связи, поле связи с моделью).
+COUNTERS = (
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'followers_count', Follow, 'author'),
+    (Recipe, 'favorites_count', Favorites, 'recipe'),
+    (Recipe, 'cart_count', Cart, 'recipe'),
+)
+
+# Модель связи → (модель со счётчиком, поле, поле связи).
+COUNTED_RELATIONS = {
+    source: (model, field, source_field)
+    for model, field, source, source_field in COUNTERS
+}
+
+
+def change_counter(queryset, field, delta):
+    """Атомарно прибавляет delta к счётчику, не опуская его ниже нуля."""
+    if delta:
+        queryset.update(**{field: Greatest(F(field) + delta, 0)})
+
+
+def change_counters(source, target_ids, delta):
+    """Меняет счётчик объектов, к которым добавлены или удалены связи."""
+    model, field, _ = COUNTED_RELATIONS[source]
+    change_counter(model.objects.filter(pk__in=target_ids), field, delta)
+
+
+def count_related(source, source_field):
+    return Coalesce(
+        Subquery(
+            source.objects.filter(**{source_field: OuterRef('pk')})
+            .order_by().values(source_field)
+            .annotate(count=Count('pk')).values('count')
+        ),
+        0,
+    )
+
+
+def reconcile_counters(fix=False):
+    """Сверяет счётчики с таблицами связей.
+
+    Возвращает список (модель, поле, число расходящихся строк);
+    при fix расходящиеся строки исправляются одним UPDATE на счётчик.
+    """
+    report = []
+    for model, field, source, source_field in COUNTERS:
+        actual = count_related(source, source_field)
+        drifted = model.objects.annotate(actual=actual).exclude(
+            **{field: F('actual')}
+        )
+        amount = drifted.count()
+        if amount and fix:
+            model.objects.filter(pk__in=drifted.values('pk')).update(
+                **{field: actual}
+            )
+        report.append((model, field, amount))
+    return report
@@ -0,0 +1,57 @@
+import threading
+
+from recipes.models import DataVersion, Ingredient, Tag
+
+CONTEXT_KEY = 'dimension_versions'
+
+
+class DimensionCache:
+    """Справочник в памяти процесса: id → экземпляр модели.
+
+    Снимок таблицы строится при первом обращении и перестраивается при
+    смене версии справочника (общей для всех процессов) или после
+    сигналов сохранения и удаления в текущем процессе.
+    Экземпляры общие для всех запросов и не должны изменяться.
+    """
+
+    def __init__(self, model, version_name):
+        self.model = model
+        self.version_name = version_name
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        # Поля сериализаторов копируются вместе с аргументами,
+        # справочник должен оставаться общим.
+        return self
+
+    def invalidate(self):
+        self.snapshot = None
+
+    def get_objects(self, context):
+        version = get_versions(context)[self.version_name]
+        snapshot = self.snapshot
+        if snapshot is None or snapshot[0] != version:
+            with self.lock:
+                snapshot = self.snapshot
+                if snapshot is None or snapshot[0] != version:
+                    snapshot = self.snapshot = (version, {
+                        obj.pk: obj for obj in self.model.objects.all()
+                    })
+        return snapshot[1]
+
+    def get(self, pk, context):
+        return self.get_objects(context).get(pk)
+
+
+def get_versions(context):
+    """Версии справочников, один запрос на контекст сериализатора."""
+    if CONTEXT_KEY not in context:
+        context[CONTEXT_KEY] = DataVersion.objects.get_versions(
+            DataVersion.TAGS, DataVersion.INGREDIENTS,
+        )
+    return context[CONTEXT_KEY]
+
+
+tag_cache = DimensionCache(Tag, DataVersion.TAGS)
+ingredient_cache = DimensionCache(Ingredient, DataVersion.INGREDIENTS)
@@ -0,0 +1,171 @@
+import threading
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+
+from recipes.models import DataVersion, Ingredient, Recipe, RecipeIngredient
+
+
+class IngredientIndex:
+    """Индекс названий ингредиентов в памяти процесса.
+
+    Названия хранятся в отсортированном массиве без учёта регистра,
+    поиск по префиксу выполняется бинарным поиском. Индекс строится
+    при первом обращении и перестраивается при смене версии каталога.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def build():
+        items = sorted(
+            Ingredient.objects.values('id', 'name', 'measurement_unit'),
+            key=lambda item: (item['name'].casefold(), item['id']),
+        )
+        return [item['name'].casefold() for item in items], items
+
+    def get_snapshot(self, version):
+        snapshot = self.snapshot
+        if snapshot is None or snapshot[0] != version:
+            with self.lock:
+                snapshot = self.snapshot
+                if snapshot is None or snapshot[0] != version:
+                    snapshot = self.snapshot = (version, *self.build())
+        return snapshot[1], snapshot[2]
+
+    def search(self, query, version, limit):
+        """Ингредиенты, название которых содержит query.
+
+        Сначала идут точные совпадения, затем совпадения по началу
+        названия, затем остальные.
+        """
+        keys, items = self.get_snapshot(version)
+        query = query.casefold()
+        start = bisect_left(keys, query)
+        end = bisect_left(keys, query + chr(0x10FFFF), start)
+        result = items[start:min(end, start + limit)]
+        if len(result) < limit:
+            result += islice(
+                (
+                    item for key, item in zip(keys, items)
+                    if query in key and not key.startswith(query)
+                ),
+                limit - len(result),
+            )
+        return result
+
+
+class RecipeIngredientIndex:
+    """Обратный индекс ингредиент → рецепты в памяти процесса.
+
+    При смене версии рецептов перечитываются только рецепты, чей
+    updated_at не старше отметки последней синхронизации за вычетом
+    RECIPE_INDEX_SYNC_MARGIN секунд. Запас покрывает транзакции,
+    зафиксированные позже более новых, и расхождение часов воркеров;
+    правка, ставшая видимой позже этого запаса, подхватится при её
+    следующем изменении. Удаления отслеживаются отдельной версией
+    RECIPE_DELETIONS: только при её смене индекс сверяется с полным
+    списком рецептов.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.deletions = None
+        self.synced_at = None
+        self.updated = {}
+        self.recipes = {}
+        self.index = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def add(self, recipe_id, ingredient_ids):
+        self.remove(recipe_id)
+        self.recipes[recipe_id] = frozenset(ingredient_ids)
+        for ingredient_id in self.recipes[recipe_id]:
+            self.index[ingredient_id].add(recipe_id)
+
+    def remove(self, recipe_id):
+        for ingredient_id in self.recipes.pop(recipe_id, ()):
+            self.index[ingredient_id].discard(recipe_id)
+
+    def load(self, current, complete=False):
+        """Перечитывает состав рецептов current (id → updated_at).
+
+        Загружаются только рецепты, чей updated_at отличается
+        от запомненного; complete означает, что current — все рецепты.
+        """
+        changed = [
+            recipe_id for recipe_id, updated_at in current.items()
+            if self.updated.get(recipe_id) != updated_at
+        ]
+        if not changed:
+            return
+        rows = RecipeIngredient.objects.all()
+        if not complete or len(changed) < len(current):
+            rows = rows.filter(recipe_id__in=changed)
+        ingredients = defaultdict(list)
+        for recipe_id, ingredient_id in rows.values_list(
+            'recipe_id', 'ingredient_id',
+        ):
+            ingredients[recipe_id].append(ingredient_id)
+        for recipe_id in changed:
+            self.add(recipe_id, ingredients[recipe_id])
+            self.updated[recipe_id] = current[recipe_id]
+        latest = max(current[recipe_id] for recipe_id in changed)
+        if self.synced_at is None or latest > self.synced_at:
+            self.synced_at = latest
+
+    def reconcile(self):
+        current = dict(Recipe.objects.values_list('id', 'updated_at'))
+        for recipe_id in self.updated.keys() - current.keys():
+            self.remove(recipe_id)
+            del self.updated[recipe_id]
+        self.load(current, complete=True)
+
+    def sync(self, version):
+        if self.version == version:
+            return
+        deletions = DataVersion.objects.get_versions(
+            DataVersion.RECIPE_DELETIONS,
+        )[DataVersion.RECIPE_DELETIONS]
+        if self.synced_at is None or deletions != self.deletions:
+            self.reconcile()
+        else:
+            since = self.synced_at - timedelta(
+                seconds=settings.RECIPE_INDEX_SYNC_MARGIN,
+            )
+            self.load(dict(
+                Recipe.objects.filter(updated_at__gte=since)
+                .values_list('id', 'updated_at')
+            ))
+        self.version = version
+        self.deletions = deletions
+
+    def search(self, ingredient_ids, missing_max, version, limit):
+        """Рецепты, которым не хватает не больше missing_max ингредиентов.
+
+        Сортировка по доле имеющихся ингредиентов, затем по числу
+        недостающих.
+        """
+        with self.lock:
+            self.sync(version)
+            hits = Counter()
+            for ingredient_id in set(ingredient_ids):
+                hits.update(self.index.get(ingredient_id, ()))
+            matches = []
+            for recipe_id, found in hits.items():
+                total = len(self.recipes[recipe_id])
+                if total - found <= missing_max:
+                    matches.append(
+                        (-found / total, total - found, -recipe_id)
+                    )
+        matches.sort()
+        return [-recipe_id for _, _, recipe_id in matches[:limit]]
+
+
+ingredient_index = IngredientIndex()
+recipe_ingredient_index = RecipeIngredientIndex()
@@ -0,0 +1,136 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+from itertools import accumulate
+from unittest import mock
+
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from recipes.ingredient_index import RecipeIngredientIndex
+from recipes.models import (DataVersion, Ingredient, Recipe,
+                            RecipeIngredient)
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет подбор рецептов по набору ингредиентов '
+        'на синтетическом индексе и синхронизацию индекса с базой '
+        'после записи (изменения базы откатываются)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipes', type=int, default=50000)
+        parser.add_argument('--ingredients', type=int, default=2000)
+        parser.add_argument('--per-recipe', type=int, default=8)
+        parser.add_argument('--fridge', type=int, default=20)
+        parser.add_argument('--missing-max', type=int, default=2)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--writes', type=int, default=20)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['recipes'])
+        ingredients = range(1, options['ingredients'] + 1)
+        # Популярные ингредиенты встречаются чаще остальных.
+        weights = list(accumulate(1 / rank for rank in ingredients))
+        index = RecipeIngredientIndex()
+        started = time.perf_counter()
+        for recipe_id in range(1, options['recipes'] + 1):
+            index.add(recipe_id, rng.choices(
+                ingredients, cum_weights=weights, k=options['per_recipe'],
+            ))
+        build = time.perf_counter() - started
+        index.version = 'benchmark'
+        timings, found = [], []
+        for _ in range(options['queries']):
+            fridge = rng.choices(
+                ingredients, cum_weights=weights, k=options['fridge'],
+            )
+            started = time.perf_counter()
+            result = index.search(
+                fridge, options['missing_max'], 'benchmark', 500,
+            )
+            timings.append((time.perf_counter() - started) * 1000)
+            found.append(len(result))
+        timings.sort()
+        self.stdout.write(
+            f'Рецептов: {options["recipes"]}, '
+            f'построение индекса: {build:.2f} с\n'
+            f'Запросов: {options["queries"]}, '
+            f'найдено в среднем: {statistics.mean(found):.0f}\n'
+            f'Задержка, мс: медиана {statistics.median(timings):.2f}, '
+            f'p95 {timings[int(len(timings) * 0.95) - 1]:.2f}, '
+            f'максимум {timings[-1]:.2f}'
+        )
+        if options['writes']:
+            with transaction.atomic():
+                self.benchmark_sync(rng, weights, options)
+                transaction.set_rollback(True)
+
+    def benchmark_sync(self, rng, weights, options):
+        author = User.objects.create_user(
+            username='benchmark', email='benchmark@foodgram.ru',
+        )
+        ingredients = Ingredient.objects.bulk_create(
+            Ingredient(name=f'Ингредиент {number}', measurement_unit='г')
+            for number in range(options['ingredients'])
+        )
+        # Каталог старше запаса синхронизации, как в рабочей базе.
+        # Даты задаются при вставке: UPDATE оставил бы в индексе по
+        # updated_at мёртвые версии строк до конца транзакции.
+        with mock.patch(
+            'django.utils.timezone.now',
+            return_value=timezone.now() - timedelta(days=1),
+        ):
+            recipes = Recipe.objects.bulk_create(
+                (
+                    Recipe(
+                        name=f'Рецепт {number}',
+                        text='Описание',
+                        image='recipes/images/benchmark.png',
+                        cooking_time=10,
+                        author=author,
+                    )
+                    for number in range(options['recipes'])
+                ),
+                batch_size=5000,
+            )
+        RecipeIngredient.objects.bulk_create(
+            (
+                RecipeIngredient(
+                    recipe=recipe, ingredient=ingredient, amount=1,
+                )
+                for recipe in recipes
+                for ingredient in set(rng.choices(
+                    ingredients, cum_weights=weights,
+                    k=options['per_recipe'],
+                ))
+            ),
+            batch_size=5000,
+        )
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE recipes_recipe')
+                cursor.execute('ANALYZE recipes_recipeingredient')
+        index = RecipeIngredientIndex()
+        started = time.perf_counter()
+        index.sync(DataVersion.objects.get_versions(DataVersion.RECIPES))
+        build = time.perf_counter() - started
+        timings = []
+        for _ in range(options['writes']):
+            Recipe.objects.filter(pk=rng.choice(recipes).pk).touch()
+            version = DataVersion.objects.get_versions(DataVersion.RECIPES)
+            started = time.perf_counter()
+            index.sync(version)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        self.stdout.write(
+            f'Синхронизация с базой: первая загрузка {build:.2f} с\n'
+            f'После записи ({options["writes"]}), мс: '
+            f'медиана {statistics.median(timings):.2f}, '
+            f'p95 {timings[int(len(timings) * 0.95) - 1]:.2f}, '
+            f'максимум {timings[-1]:.2f}'
+        )
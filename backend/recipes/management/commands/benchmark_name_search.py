@@ -0,0 +1,126 @@
+import random
+import time
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api.filters import search_by_name
+from recipes.models import Ingredient, Recipe
+from users.models import User
+
+SYLLABLES = (
+    'ка', 'ро', 'ми', 'со', 'ль', 'пе', 'рец', 'ту', 'ва', 'ре', 'ник',
+    'ло', 'ша', 'гри', 'бы', 'ман', 'го', 'лук', 'чес', 'нок',
+)
+QUERIES = ('со', 'соль', 'перец', 'ман', 'лукчес')
+# Форма запроса и индекс, который она должна использовать. Триграммный
+# индекс по UPPER(name) обслуживает icontains только начиная с трёх
+# символов, более короткие запросы читают таблицу целиком.
+SHAPES = (
+    (
+        'istartswith',
+        lambda queryset, query: queryset.filter(name__istartswith=query),
+        lambda query: 'name_prefix_idx',
+    ),
+    (
+        'search_by_name',
+        search_by_name,
+        lambda query: 'name_trgm_idx' if len(query) >= 3 else None,
+    ),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Создаёт синтетический каталог, выводит планы и время поисковых '
+        'запросов по названию и откатывает изменения'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Бенчмарк рассчитан на PostgreSQL')
+        with transaction.atomic():
+            self.populate(options['rows'])
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE recipes_ingredient')
+                cursor.execute('ANALYZE recipes_recipe')
+                self.check_trigrams(cursor)
+            for model in (Ingredient, Recipe):
+                for shape in SHAPES:
+                    for query in QUERIES:
+                        self.report(model, shape, query, options['repeat'])
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def make_name(rng):
+        return ''.join(
+            rng.choice(SYLLABLES) for _ in range(rng.randint(2, 5))
+        ).capitalize()
+
+    def populate(self, rows):
+        rng = random.Random(rows)
+        author = User.objects.create_user(
+            username='benchmark', email='benchmark@foodgram.ru',
+        )
+        Ingredient.objects.bulk_create(
+            (
+                Ingredient(
+                    name=f'{self.make_name(rng)} {number}',
+                    measurement_unit='г',
+                )
+                for number in range(rows)
+            ),
+            batch_size=5000,
+        )
+        Recipe.objects.bulk_create(
+            (
+                Recipe(
+                    name=f'{self.make_name(rng)} {number}',
+                    text='Описание',
+                    image='recipes/images/benchmark.png',
+                    cooking_time=10,
+                    author=author,
+                )
+                for number in range(rows)
+            ),
+            batch_size=5000,
+        )
+
+    def check_trigrams(self, cursor):
+        # При LC_CTYPE=C кириллица не считается буквами: pg_trgm не
+        # выделяет из неё триграмм, и индекс совпадает со всеми строками.
+        cursor.execute('SELECT show_trgm(%s)', [QUERIES[-1]])
+        if not cursor.fetchone()[0]:
+            self.stderr.write(
+                'В локали базы pg_trgm не выделяет триграммы из кириллицы, '
+                'триграммный индекс не сузит выборку'
+            )
+
+    def report(self, model, shape, query, repeat):
+        title, build, expected = shape
+        queryset = build(model.objects.order_by('id'), query)[:10]
+        plan = queryset.explain()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            list(queryset.all())
+        elapsed = (time.perf_counter() - started) / repeat * 1000
+        index = expected(query)
+        # Частый префикс дешевле дочитать по первичному ключу до LIMIT,
+        # расхождением считается только полное чтение таблицы.
+        used = next(
+            (
+                name for name in ('name_prefix_idx', 'name_trgm_idx', 'pkey')
+                if name in plan
+            ),
+            None,
+        )
+        self.stdout.write(
+            f'{model.__name__} {title} {query!r}: {elapsed:.2f} мс, '
+            f'ожидается {index or "Seq Scan"}, в плане {used or "Seq Scan"}'
+            f'{" — РАСХОДИТСЯ" if index and not used else ""}'
+        )
+        self.stdout.write(plan)
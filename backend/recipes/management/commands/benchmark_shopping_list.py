@@ -0,0 +1,133 @@
+import io
+import random
+import time
+import tracemalloc
+
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from django.test.utils import override_settings
+
+from api.exports import export_txt, get_shopping_list, stream_export
+from recipes.models import (Cart, Ingredient, Recipe, RecipeIngredient,
+                            ShoppingListItem)
+from users.models import User
+
+
+def legacy_export(user):
+    """Прежняя выгрузка: весь файл собирается в StringIO."""
+    shopping_cart = (
+        RecipeIngredient.objects.filter(recipe__cart__user=user)
+        .values(
+            'ingredient__name',
+            'ingredient__measurement_unit',
+        )
+        .annotate(amount=Sum('amount'))
+        .order_by('ingredient__name')
+    )
+    output = io.StringIO()
+    for item in shopping_cart:
+        output.write(f"{item['ingredient__name']}\t")
+        output.write(f"{item['amount']}\t")
+        output.write(f"{item['ingredient__measurement_unit']} \n")
+    yield output.getvalue().encode()
+
+
+def streaming_export(user):
+    return stream_export(
+        export_txt(get_shopping_list(user)), 'shopping-list:benchmark',
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает пиковую память и время до первого байта прежней '
+        'и потоковой выгрузки списка покупок и откатывает изменения'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=[10, 500, 5000],
+        )
+        parser.add_argument('--ingredients', type=int, default=20000)
+        parser.add_argument('--per-recipe', type=int, default=8)
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), override_settings(
+            SHOPPING_LIST_CACHE_MAX_SIZE=0,
+        ):
+            ingredients = self.populate_ingredients(options['ingredients'])
+            for size in options['sizes']:
+                user = self.populate_cart(
+                    size, ingredients, options['per_recipe'],
+                )
+                for name, export in (('StringIO', legacy_export),
+                                     ('поток', streaming_export)):
+                    self.report(size, name, export, user)
+            transaction.set_rollback(True)
+
+    def populate_ingredients(self, amount):
+        Ingredient.objects.bulk_create(
+            (
+                Ingredient(name=f'Ингредиент {number}', measurement_unit='г')
+                for number in range(amount)
+            ),
+            batch_size=5000,
+        )
+        return list(Ingredient.objects.values_list('id', flat=True))
+
+    def populate_cart(self, size, ingredients, per_recipe):
+        rng = random.Random(size)
+        user = User.objects.create_user(
+            username=f'benchmark{size}', email=f'benchmark{size}@foodgram.ru',
+        )
+        Recipe.objects.bulk_create(
+            (
+                Recipe(
+                    name=f'Рецепт {number}',
+                    text='Описание',
+                    image='recipes/images/benchmark.png',
+                    cooking_time=10,
+                    author=user,
+                )
+                for number in range(size)
+            ),
+            batch_size=5000,
+        )
+        recipe_ids = Recipe.objects.filter(author=user).values_list(
+            'id', flat=True,
+        )
+        RecipeIngredient.objects.bulk_create(
+            (
+                RecipeIngredient(
+                    recipe_id=recipe_id, ingredient_id=ingredient_id,
+                    amount=rng.randint(1, 500),
+                )
+                for recipe_id in recipe_ids
+                for ingredient_id in rng.sample(ingredients, per_recipe)
+            ),
+            batch_size=5000,
+        )
+        Cart.objects.bulk_create(
+            (Cart(user=user, recipe_id=recipe_id) for recipe_id in recipe_ids),
+            batch_size=5000,
+        )
+        ShoppingListItem.objects.rebuild(user_ids=[user.id])
+        return user
+
+    def report(self, size, name, export, user):
+        tracemalloc.start()
+        started = time.perf_counter()
+        chunks = export(user)
+        length = len(next(chunks, b''))
+        first_byte = time.perf_counter() - started
+        for chunk in chunks:
+            length += len(chunk)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write(
+            f'{size} рецептов, {name}: первый байт '
+            f'{first_byte * 1000:.1f} мс, всего {elapsed * 1000:.1f} мс, '
+            f'пик памяти {peak / 1024:.0f} КБ, {length} байт'
+        )
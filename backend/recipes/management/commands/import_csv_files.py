@@ -4,7 +4,7 @@ import os
 from django.conf import settings
 from django.core.management import BaseCommand
 
-from recipes.models import Ingredient
+from recipes.models import DataVersion, Ingredient
 
 TABLES = {
     Ingredient: 'ingredients.csv',
@@ -28,4 +28,5 @@ class Command(BaseCommand):
                     delimiter=','
                 )
                 model.objects.bulk_create([model(**data) for data in reader])
+        DataVersion.objects.bump(DataVersion.INGREDIENTS)
         self.stdout.write(('Данные csv-файлов импортированы'))
@@ -0,0 +1,32 @@
+from django.core.management import BaseCommand
+
+from recipes.models import TimelineEntry
+from users.models import Follow
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересобирает ленты подписок по текущим подпискам '
+        'и обрезает их до FEED_TIMELINE_LENGTH записей'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, nargs='+')
+        parser.add_argument(
+            '--trim-only', action='store_true',
+            help='Только обрезать ленты, не пересобирая их',
+        )
+
+    def handle(self, *args, **options):
+        if not options['trim_only']:
+            user_ids = options['users'] or sorted(
+                set(Follow.objects.values_list('user_id', flat=True))
+                | set(TimelineEntry.objects.values_list('user_id', flat=True))
+            )
+            for user_id in user_ids:
+                TimelineEntry.objects.rebuild(user_id)
+            self.stdout.write(f'Пересобрано лент: {len(user_ids)}')
+        entries = TimelineEntry.objects.all()
+        if options['users']:
+            entries = entries.filter(user_id__in=options['users'])
+        self.stdout.write(f'Удалено лишних записей: {entries.trim()}')
@@ -0,0 +1,20 @@
+from django.core.management import BaseCommand
+
+from recipes.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = (
+        'Сверяет счётчики рецептов, подписчиков, избранного и корзины '
+        'с таблицами связей и при --fix исправляет расхождения'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true')
+
+    def handle(self, *args, **options):
+        for model, field, amount in reconcile_counters(options['fix']):
+            self.stdout.write(
+                f'{model.__name__}.{field}: расхождений {amount}'
+                + (', исправлено' if amount and options['fix'] else '')
+            )
@@ -0,0 +1,52 @@
+from django.core.management import BaseCommand
+
+from recipes.models import Cart, ShoppingListItem
+
+
+class Command(BaseCommand):
+    help = (
+        'Сверяет материализованные списки покупок с корзинами '
+        'и при --fix пересобирает расходящиеся'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        user_ids = sorted(
+            set(Cart.objects.values_list('user_id', flat=True))
+            | set(ShoppingListItem.objects.values_list('user_id', flat=True))
+        )
+        batch_size = options['batch_size']
+        mismatched = []
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            expected = {
+                (row['user_id'], row['ingredient_id']): row['total']
+                for row in ShoppingListItem.objects.get_totals(batch)
+            }
+            actual = {
+                (user_id, ingredient_id): amount
+                for user_id, ingredient_id, amount in
+                ShoppingListItem.objects.filter(user_id__in=batch)
+                .values_list('user_id', 'ingredient_id', 'amount')
+            }
+            broken = sorted({
+                user_id for user_id, ingredient_id in expected.keys()
+                | actual.keys()
+                if expected.get((user_id, ingredient_id))
+                != actual.get((user_id, ingredient_id))
+            })
+            if broken and options['fix']:
+                ShoppingListItem.objects.rebuild(user_ids=broken)
+            mismatched.extend(broken)
+        self.stdout.write(
+            f'Проверено пользователей: {len(user_ids)}, '
+            f'расхождений: {len(mismatched)}'
+            + (', исправлено' if mismatched and options['fix'] else '')
+        )
+        if mismatched and options['verbosity'] > 1:
+            self.stdout.write(
+                'id пользователей: ' + ', '.join(map(str, mismatched))
+            )
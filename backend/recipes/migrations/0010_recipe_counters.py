@@ -0,0 +1,47 @@
+# Generated by Django 3.2.16 on 2026-10-18 02:48
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+COUNTERS = (
+    ('users', 'User', 'recipes_count', 'recipes', 'Recipe', 'author'),
+    ('users', 'User', 'followers_count', 'users', 'Follow', 'author'),
+    ('recipes', 'Recipe', 'favorites_count', 'recipes', 'Favorites',
+     'recipe'),
+    ('recipes', 'Recipe', 'cart_count', 'recipes', 'Cart', 'recipe'),
+)
+
+
+def fill_counters(apps, schema_editor):
+    for app, name, field, source_app, source_name, source_field in COUNTERS:
+        source = apps.get_model(source_app, source_name)
+        apps.get_model(app, name).objects.update(**{field: Coalesce(
+            models.Subquery(
+                source.objects.filter(**{source_field: models.OuterRef('pk')})
+                .order_by().values(source_field)
+                .annotate(count=models.Count('pk')).values('count')
+            ),
+            0,
+        )})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_recipe_author_pub_date_idx'),
+        ('users', '0002_user_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='cart_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Добавлений в корзину'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Добавлений в избранное'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations
+
+# icontains на PostgreSQL сравнивает UPPER(name), поэтому триграммный
+# индекс строится по тому же выражению.
+INDEXES = (
+    ('recipes_ingredient_name_trgm_idx', 'recipes_ingredient'),
+    ('recipes_recipe_name_trgm_idx', 'recipes_recipe'),
+)
+
+
+def create_indexes(apps, schema_editor, expression):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, table in INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+        schema_editor.execute(
+            f'CREATE INDEX {name} ON {table} USING gin ({expression})'
+        )
+
+
+def create_upper_indexes(apps, schema_editor):
+    create_indexes(apps, schema_editor, 'UPPER(name::text) gin_trgm_ops')
+
+
+def create_name_indexes(apps, schema_editor):
+    create_indexes(apps, schema_editor, 'name gin_trgm_ops')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0011_timelineentry'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_upper_indexes, create_name_indexes),
+    ]
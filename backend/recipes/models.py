@@ -1,9 +1,16 @@
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models.functions import RowNumber
+from django.utils import timezone
 
 from colorfield.fields import ColorField
 from foodgram_backend import constants
-from users.models import User
+from foodgram_backend.managers import RelationManager
+from foodgram_backend.mixins import CounterFieldsMixin
+from users.models import Follow, User
 
 
 class Tag(models.Model):
@@ -55,7 +62,125 @@ class Ingredient(models.Model):
         return self.name
 
 
-class Recipe(models.Model):
+class RecipeQuerySet(models.QuerySet):
+    """План запросов для выдачи рецептов."""
+
+    VIEWER_FLAGS = ('is_favorited', 'is_in_shopping_cart',
+                    'author_is_subscribed')
+
+    def with_viewer_flags(self, user, flags=VIEWER_FLAGS):
+        if user.is_anonymous:
+            return self.annotate(**{
+                flag: models.Value(False, output_field=models.BooleanField())
+                for flag in flags
+            })
+        subqueries = {
+            'is_favorited': Favorites.objects.filter(
+                user=user, recipe=models.OuterRef('pk'),
+            ),
+            'is_in_shopping_cart': Cart.objects.filter(
+                user=user, recipe=models.OuterRef('pk'),
+            ),
+            'author_is_subscribed': Follow.objects.filter(
+                user=user, author=models.OuterRef('author'),
+            ),
+        }
+        return self.annotate(**{
+            flag: models.Exists(subqueries[flag]) for flag in flags
+        })
+
+    @staticmethod
+    def related_lookups(fields=('author', 'ingredients')):
+        """Связи для выдачи рецептов.
+
+        Теги и ингредиенты берутся из справочников в памяти
+        (recipes.dimensions), поэтому их таблицы не присоединяются.
+        """
+        lookups = {
+            'author': 'author',
+            'ingredients': 'recipeingredient',
+        }
+        return [lookups[field] for field in fields if field in lookups]
+
+    @staticmethod
+    def get_tag_ids(recipe_ids):
+        tag_ids = {recipe_id: [] for recipe_id in recipe_ids}
+        for recipe_id, tag_id in Recipe.tags.through.objects.filter(
+            recipe_id__in=recipe_ids,
+        ).order_by('tag_id').values_list('recipe_id', 'tag_id'):
+            tag_ids[recipe_id].append(tag_id)
+        return tag_ids
+
+    def get_previews(self, author_ids, limit=None):
+        """Последние рецепты авторов: не больше limit на автора.
+
+        Все авторы обслуживаются одним запросом с ROW_NUMBER()
+        OVER (PARTITION BY author). Возвращает словарь
+        id автора → список рецептов.
+        """
+        previews = {author_id: [] for author_id in author_ids}
+        recipes = self.filter(author_id__in=author_ids).only(
+            'id', 'name', 'image', 'cooking_time', 'author_id', 'pub_date',
+        )
+        if limit is None:
+            recipes = recipes.order_by('author_id', '-pub_date', '-id')
+        else:
+            sql, params = recipes.order_by().annotate(
+                preview_rank=models.Window(
+                    expression=RowNumber(),
+                    partition_by=[models.F('author_id')],
+                    order_by=[
+                        models.F('pub_date').desc(), models.F('id').desc(),
+                    ],
+                ),
+            ).query.sql_with_params()
+            recipes = self.model.objects.raw(
+                f'SELECT * FROM ({sql}) ranked WHERE preview_rank <= %s '
+                'ORDER BY author_id, preview_rank',
+                (*params, limit),
+            )
+        for recipe in recipes:
+            previews[recipe.author_id].append(recipe)
+        return previews
+
+    def update_search_vector(self):
+        """Пересчитывает поисковый вектор (только PostgreSQL).
+
+        Вес A у названия, B у названий ингредиентов, C у описания.
+        """
+        if connections[self.db].vendor != 'postgresql':
+            return 0
+        ingredient_names = models.Subquery(
+            RecipeIngredient.objects.filter(recipe=models.OuterRef('pk'))
+            .values('recipe')
+            .annotate(names=StringAgg('ingredient__name', ' '))
+            .values('names')
+        )
+        config = constants.SEARCH_CONFIG
+        return self.update(search_vector=(
+            SearchVector('name', weight='A', config=config)
+            + SearchVector(ingredient_names, weight='B', config=config)
+            + SearchVector('text', weight='C', config=config)
+        ))
+
+    def touch(self):
+        """Обновляет версию рецептов, сбрасывая их кэш."""
+        updated = self.update(updated_at=timezone.now())
+        if updated:
+            DataVersion.objects.bump(DataVersion.RECIPES)
+        return updated
+
+
+class RecipeManager(models.Manager.from_queryset(RecipeQuerySet)):
+    """Поисковый вектор нужен только в WHERE и не загружается."""
+
+    def get_queryset(self):
+        return super().get_queryset().defer('search_vector')
+
+
+class Recipe(CounterFieldsMixin, models.Model):
+    counter_fields = ('favorites_count', 'cart_count')
+
     name = models.CharField(
         verbose_name='Название',
         max_length=constants.MAX_RECIPE_NAME_LENGTH,
@@ -96,10 +221,45 @@ class Recipe(models.Model):
         auto_now_add=True,
         db_index=True,
     )
+    updated_at = models.DateTimeField(
+        verbose_name='Дата изменения',
+        auto_now=True,
+    )
+    search_vector = SearchVectorField(
+        verbose_name='Поисковый вектор',
+        null=True,
+        editable=False,
+    )
+    favorites_count = models.PositiveIntegerField(
+        verbose_name='Добавлений в избранное',
+        default=0,
+        editable=False,
+    )
+    cart_count = models.PositiveIntegerField(
+        verbose_name='Добавлений в корзину',
+        default=0,
+        editable=False,
+    )
+
+    objects = RecipeManager()
 
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = [
+            models.Index(
+                fields=['pub_date', 'id'],
+                name='recipe_pub_date_id_idx',
+            ),
+            models.Index(
+                fields=['author', '-pub_date', '-id'],
+                name='recipe_author_pub_date_idx',
+            ),
+            models.Index(
+                fields=['updated_at', 'id'],
+                name='recipe_updated_at_id_idx',
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -182,6 +342,9 @@ class Favorites(models.Model):
         on_delete=models.CASCADE,
     )
 
+    objects = models.Manager()
+    relations = RelationManager('recipe')
+
     class Meta:
         verbose_name = 'Избранный рецепт'
         verbose_name_plural = 'Избранные рецепты'
@@ -207,6 +370,9 @@ class Cart(models.Model):
         on_delete=models.CASCADE,
     )
 
+    objects = models.Manager()
+    relations = RelationManager('recipe')
+
     class Meta:
         verbose_name = 'Корзина'
         verbose_name_plural = 'Корзины'
@@ -216,3 +382,409 @@ class Cart(models.Model):
                 name='unique_recipe_user_in_cart',
             )
         ]
+
+
+class ShoppingListQuerySet(models.QuerySet):
+    """Поддержка материализованного списка покупок.
+
+    Добавление и удаление рецепта в корзине меняют суммы только
+    его ингредиентов; после правки рецепта затронутые строки
+    пересчитываются по исходным таблицам.
+    """
+
+    def get_sql_names(self, connection):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        source = RecipeIngredient._meta
+        return {
+            'table': qn(opts.db_table),
+            'user': qn(opts.get_field('user').column),
+            'ingredient': qn(opts.get_field('ingredient').column),
+            'amount': qn(opts.get_field('amount').column),
+            'source': qn(source.db_table),
+            'source_recipe': qn(source.get_field('recipe').column),
+            'source_ingredient': qn(source.get_field('ingredient').column),
+            'source_amount': qn(source.get_field('amount').column),
+        }
+
+    def add_recipes(self, user_id, recipe_ids):
+        """Прибавляет ингредиенты рецептов к списку пользователя."""
+        if not recipe_ids:
+            return
+        connection = connections[self.db]
+        placeholders = ', '.join(['%s'] * len(recipe_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {table} ({user}, {ingredient}, {amount}) '
+                'SELECT %s, {source_ingredient}, SUM({source_amount}) '
+                'FROM {source} '
+                f'WHERE {{source_recipe}} IN ({placeholders}) '
+                'GROUP BY {source_ingredient} '
+                'ON CONFLICT ({user}, {ingredient}) DO UPDATE '
+                'SET {amount} = {table}.{amount} + EXCLUDED.{amount}'.format(
+                    **self.get_sql_names(connection)
+                ),
+                [user_id, *recipe_ids],
+            )
+
+    def remove_recipes(self, user_id, recipe_ids):
+        """Вычитает ингредиенты рецептов из списка пользователя."""
+        if not recipe_ids:
+            return
+        source = RecipeIngredient.objects.filter(recipe_id__in=recipe_ids)
+        items = self.filter(user_id=user_id)
+        items.filter(
+            ingredient_id__in=source.values('ingredient_id'),
+        ).update(amount=models.F('amount') - models.Subquery(
+            source.filter(ingredient=models.OuterRef('ingredient'))
+            .values('ingredient')
+            .annotate(total=models.Sum('amount'))
+            .values('total')
+        ))
+        items.filter(amount__lte=0).delete()
+
+    @staticmethod
+    def get_totals(user_ids=None, ingredient_ids=None):
+        """Суммы ингредиентов по корзинам: user_id, ingredient_id, total."""
+        carts = Cart.objects.all()
+        if user_ids is not None:
+            carts = carts.filter(user_id__in=user_ids)
+        if ingredient_ids is not None:
+            carts = carts.filter(
+                recipe__recipeingredient__ingredient_id__in=ingredient_ids,
+            )
+        return carts.values(
+            'user_id',
+            ingredient_id=models.F('recipe__recipeingredient__ingredient_id'),
+        ).annotate(
+            total=models.Sum('recipe__recipeingredient__amount'),
+        ).filter(total__gt=0).order_by()
+
+    def rebuild(self, user_ids=None, ingredient_ids=None):
+        """Пересчитывает строки по корзинам и ингредиентам рецептов.
+
+        Без аргументов пересобирает таблицу целиком.
+        """
+        items = self.all()
+        if user_ids is not None:
+            items = items.filter(user_id__in=user_ids)
+        if ingredient_ids is not None:
+            items = items.filter(ingredient_id__in=ingredient_ids)
+        totals = self.get_totals(user_ids, ingredient_ids)
+        with transaction.atomic(using=self.db, savepoint=False):
+            # У модели нет получателей сигналов и зависимых связей,
+            # поэтому delete() выполняется одним DELETE без выборки.
+            items.delete()
+            self.bulk_create(
+                (
+                    self.model(
+                        user_id=row['user_id'],
+                        ingredient_id=row['ingredient_id'],
+                        amount=row['total'],
+                    )
+                    for row in totals.iterator()
+                ),
+                batch_size=1000,
+                ignore_conflicts=True,
+            )
+
+    def rebuild_recipe(self, recipe_id, ingredient_ids):
+        """Пересчитывает списки всех, у кого рецепт в корзине."""
+        user_ids = list(Cart.objects.filter(recipe_id=recipe_id).values_list(
+            'user_id', flat=True,
+        ))
+        if user_ids:
+            self.rebuild(user_ids=user_ids, ingredient_ids=ingredient_ids)
+
+
+class ShoppingListItem(models.Model):
+    """Сумма ингредиента по всем рецептам в корзине пользователя."""
+
+    user = models.ForeignKey(
+        User,
+        verbose_name='Пользователь',
+        related_name='shopping_list',
+        on_delete=models.CASCADE,
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        verbose_name='Ингредиент',
+        related_name='shopping_list',
+        on_delete=models.CASCADE,
+    )
+    amount = models.IntegerField(
+        verbose_name='Количество',
+    )
+
+    objects = ShoppingListQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Строка списка покупок'
+        verbose_name_plural = 'Список покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_user_ingredient_in_shopping_list',
+            )
+        ]
+
+
+class TimelineQuerySet(models.QuerySet):
+    """Ленты подписок пользователей.
+
+    Новый рецепт раскладывается в ленты подписчиков при публикации
+    (fan-out on write). Рецепты авторов, у которых подписчиков больше
+    FEED_FANOUT_THRESHOLD, не раскладываются и подмешиваются при чтении
+    (fan-out on read). В ленте хранится не больше FEED_TIMELINE_LENGTH
+    записей на пользователя, лишние удаляются при обрезке.
+    """
+
+    def get_sql_names(self, connection):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        follow = Follow._meta
+        user = User._meta
+        return {
+            'table': qn(opts.db_table),
+            'user': qn(opts.get_field('user').column),
+            'recipe': qn(opts.get_field('recipe').column),
+            'pub_date': qn(opts.get_field('pub_date').column),
+            'follow': qn(follow.db_table),
+            'follow_user': qn(follow.get_field('user').column),
+            'follow_author': qn(follow.get_field('author').column),
+            'user_table': qn(user.db_table),
+            'user_pk': qn(user.pk.column),
+            'followers_count': qn(user.get_field('followers_count').column),
+        }
+
+    @staticmethod
+    def fanout_authors():
+        return User.objects.filter(
+            followers_count__lte=settings.FEED_FANOUT_THRESHOLD,
+        )
+
+    def fan_out(self, recipe):
+        """Добавляет рецепт в ленты подписчиков автора одним запросом."""
+        connection = connections[self.db]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {table} ({user}, {recipe}, {pub_date}) '
+                'SELECT {follow_user}, %s, %s FROM {follow} '
+                'WHERE {follow_author} = %s AND ('
+                'SELECT {followers_count} FROM {user_table} '
+                'WHERE {user_pk} = %s) <= %s '
+                'ON CONFLICT DO NOTHING'.format(
+                    **self.get_sql_names(connection)
+                ),
+                [
+                    recipe.pk,
+                    connection.ops.adapt_datetimefield_value(recipe.pub_date),
+                    recipe.author_id,
+                    recipe.author_id,
+                    settings.FEED_FANOUT_THRESHOLD,
+                ],
+            )
+
+    def add_recipes(self, user_id, recipes):
+        self.bulk_create(
+            [
+                self.model(
+                    user_id=user_id, recipe_id=recipe.pk,
+                    pub_date=recipe.pub_date,
+                )
+                for recipe in recipes
+            ],
+            ignore_conflicts=True,
+        )
+
+    def add_authors(self, user_id, author_ids):
+        """Дополняет ленту последними рецептами новых подписок."""
+        recipes = Recipe.objects.filter(
+            author_id__in=self.fanout_authors().filter(pk__in=author_ids),
+        ).only('id', 'pub_date').order_by('-pub_date', '-id')[
+            :settings.FEED_TIMELINE_LENGTH
+        ]
+        self.add_recipes(user_id, recipes)
+
+    def remove_authors(self, user_id, author_ids):
+        self.filter(
+            user_id=user_id, recipe__author_id__in=author_ids,
+        ).delete()
+
+    def rebuild(self, user_id):
+        """Пересобирает ленту пользователя по его подпискам."""
+        with transaction.atomic(using=self.db, savepoint=False):
+            self.filter(user_id=user_id).delete()
+            self.add_authors(
+                user_id,
+                Follow.objects.filter(user_id=user_id).values('author_id'),
+            )
+
+    def trim(self, length=None):
+        """Оставляет в каждой ленте не больше length последних записей."""
+        if length is None:
+            length = settings.FEED_TIMELINE_LENGTH
+        sql, params = self.order_by().annotate(
+            timeline_rank=models.Window(
+                expression=RowNumber(),
+                partition_by=[models.F('user_id')],
+                order_by=[
+                    models.F('pub_date').desc(), models.F('recipe_id').desc(),
+                ],
+            ),
+        ).values('id', 'timeline_rank').query.sql_with_params()
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {table} WHERE id IN ('
+                f'SELECT id FROM ({sql}) ranked WHERE timeline_rank > %s)',
+                (*params, length),
+            )
+            return cursor.rowcount
+
+    def get_feed_keys(self, user, limit, position=None, reverse=False):
+        """Ключи (pub_date, id рецепта) страницы ленты пользователя.
+
+        Записи ленты читаются диапазоном по индексу
+        (user, -pub_date, -recipe), рецепты авторов с fan-out on read
+        добавляются не больше limit штук после той же позиции.
+        Возвращает не больше limit ключей в порядке выдачи.
+        """
+        entries = self.filter(user=user)
+        recipes = Recipe.objects.filter(author_id__in=Follow.objects.filter(
+            user=user,
+            author__followers_count__gt=settings.FEED_FANOUT_THRESHOLD,
+        ).values('author_id'))
+        if position is not None:
+            pub_date, pk = position
+            lookup = 'gt' if reverse else 'lt'
+            entries = entries.filter(
+                models.Q(**{f'pub_date__{lookup}': pub_date})
+                | models.Q(pub_date=pub_date, **{f'recipe_id__{lookup}': pk})
+            )
+            recipes = recipes.filter(
+                models.Q(**{f'pub_date__{lookup}': pub_date})
+                | models.Q(pub_date=pub_date, **{f'id__{lookup}': pk})
+            )
+        order = '' if reverse else '-'
+        keys = set(entries.order_by(
+            f'{order}pub_date', f'{order}recipe_id',
+        ).values_list('pub_date', 'recipe_id')[:limit])
+        keys.update(recipes.order_by(
+            f'{order}pub_date', f'{order}id',
+        ).values_list('pub_date', 'id')[:limit])
+        return sorted(keys, reverse=not reverse)[:limit]
+
+
+class TimelineEntry(models.Model):
+    """Рецепт в ленте подписок пользователя."""
+
+    user = models.ForeignKey(
+        User,
+        verbose_name='Пользователь',
+        related_name='timeline',
+        on_delete=models.CASCADE,
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        verbose_name='Рецепт',
+        related_name='timeline_entries',
+        on_delete=models.CASCADE,
+    )
+    pub_date = models.DateTimeField(
+        verbose_name='Дата публикации рецепта',
+    )
+
+    objects = TimelineQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Ленты подписок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_user_recipe_in_timeline',
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=['user', '-pub_date', '-recipe'],
+                name='timeline_user_pub_date_idx',
+            ),
+        ]
+
+
+class DataVersionQuerySet(models.QuerySet):
+
+    def bump(self, *names):
+        """Увеличивает версии наборов данных одним запросом.
+
+        Отсутствующие версии создаются со значением 1.
+        """
+        names = list(dict.fromkeys(names))
+        if not names:
+            return
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {table} ({name}, {version}, {updated_at}) '
+                'VALUES {rows} ON CONFLICT ({name}) DO UPDATE '
+                'SET {version} = {table}.{version} + 1, '
+                '{updated_at} = EXCLUDED.{updated_at}'.format(
+                    table=qn(opts.db_table),
+                    name=qn(opts.get_field('name').column),
+                    version=qn(opts.get_field('version').column),
+                    updated_at=qn(opts.get_field('updated_at').column),
+                    rows=', '.join(['(%s, 1, %s)'] * len(names)),
+                ),
+                [value for name in names for value in (name, now)],
+            )
+
+    def get_versions(self, *names):
+        versions = dict.fromkeys(names, (0, None))
+        versions.update(
+            (name, (version, updated_at))
+            for name, version, updated_at in self.filter(
+                name__in=names
+            ).values_list('name', 'version', 'updated_at')
+        )
+        return versions
+
+
+class DataVersion(models.Model):
+    """Счётчик изменений набора данных для условных GET-запросов."""
+
+    RECIPES = 'recipes'
+    RECIPE_DELETIONS = 'recipe-deletions'
+    TAGS = 'tags'
+    INGREDIENTS = 'ingredients'
+
+    name = models.CharField(
+        verbose_name='Набор данных',
+        max_length=64,
+        primary_key=True,
+    )
+    version = models.PositiveBigIntegerField(
+        verbose_name='Версия',
+        default=1,
+    )
+    updated_at = models.DateTimeField(
+        verbose_name='Дата изменения',
+    )
+
+    objects = DataVersionQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Версия данных'
+        verbose_name_plural = 'Версии данных'
+
+    def __str__(self):
+        return f'{self.name}: {self.version}'
+
+    @staticmethod
+    def viewer(user_id):
+        return f'viewer:{user_id}'
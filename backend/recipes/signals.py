@@ -0,0 +1,289 @@
+from threading import local
+
+from django.core.signals import request_started
+from django.db import transaction
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
+from django.dispatch import receiver
+
+from foodgram_backend.signals import relations_added, relations_removed
+from recipes.counters import COUNTED_RELATIONS, change_counters
+from recipes.dimensions import ingredient_cache, tag_cache
+from recipes.models import (Cart, DataVersion, Favorites, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingListItem, Tag,
+                            TimelineEntry)
+from users.models import Follow, User
+
+
+class Deleting(local):
+    """Рецепты и пользователи, которые сейчас удаляются в этом потоке.
+
+    Избранное, корзина, ингредиенты и подписки удаляются вместе с ними
+    каскадом, и их построчные получатели post_delete ничего не делают:
+    затронутых пользователей и счётчики собирает pre_delete родителя,
+    а после каскада они обновляются одним запросом на набор.
+    """
+
+    def __init__(self):
+        self.recipe_ids = set()
+        self.user_ids = set()
+
+
+deleting = Deleting()
+
+
+@receiver(request_started)
+def reset_deleting(**kwargs):
+    # После отката неудавшегося удаления отметки не должны пережить
+    # запрос.
+    deleting.__init__()
+
+
+def is_cascaded(instance):
+    """Строка удаляется каскадом вместе с рецептом или пользователем."""
+    return (
+        getattr(instance, 'recipe_id', None) in deleting.recipe_ids
+        or getattr(instance, 'user_id', None) in deleting.user_ids
+        or getattr(instance, 'author_id', None) in deleting.user_ids
+    )
+
+
+def update_search_vector(**lookups):
+    """Пересчитывает поисковый вектор после фиксации транзакции."""
+    transaction.on_commit(
+        lambda: Recipe.objects.filter(**lookups).update_search_vector()
+    )
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def recipe_changed(sender, instance, **kwargs):
+    DataVersion.objects.bump(DataVersion.RECIPES)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved(sender, instance, **kwargs):
+    update_search_vector(pk=instance.pk)
+
+
+@receiver(pre_delete, sender=Recipe)
+def recipe_deleting(sender, instance, **kwargs):
+    # Строки корзины, избранного и ингредиенты удаляются каскадом без
+    # построчной обработки, поэтому затронутые пользователи и строки
+    # списков покупок запоминаются заранее и обновляются после удаления
+    # рецепта.
+    deleting.recipe_ids.add(instance.pk)
+    instance.shopping_list_user_ids = list(
+        Cart.objects.filter(recipe=instance).values_list('user_id', flat=True)
+    )
+    instance.shopping_list_ingredient_ids = list(
+        instance.recipeingredient.values_list('ingredient_id', flat=True)
+    ) if instance.shopping_list_user_ids else []
+    instance.viewer_ids = set(instance.shopping_list_user_ids).union(
+        Favorites.objects.filter(recipe=instance).values_list(
+            'user_id', flat=True,
+        )
+    )
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    deleting.recipe_ids.discard(instance.pk)
+    DataVersion.objects.bump(DataVersion.RECIPE_DELETIONS, *map(
+        DataVersion.viewer, getattr(instance, 'viewer_ids', ()),
+    ))
+    if getattr(instance, 'shopping_list_user_ids', None):
+        ShoppingListItem.objects.rebuild(
+            user_ids=instance.shopping_list_user_ids,
+            ingredient_ids=instance.shopping_list_ingredient_ids,
+        )
+
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def recipe_ingredient_changed(sender, instance, **kwargs):
+    if is_cascaded(instance):
+        return
+    Recipe.objects.filter(pk=instance.recipe_id).touch()
+    update_search_vector(pk=instance.recipe_id)
+    ShoppingListItem.objects.rebuild_recipe(
+        instance.recipe_id, [instance.ingredient_id],
+    )
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def recipe_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        Recipe.objects.filter(pk=instance.pk).touch()
+    elif pk_set:
+        Recipe.objects.filter(pk__in=pk_set).touch()
+    else:
+        Recipe.objects.filter(tags=instance).touch()
+
+
+@receiver(post_save, sender=Tag)
+@receiver(pre_delete, sender=Tag)
+def tag_changed(sender, instance, **kwargs):
+    tag_cache.invalidate()
+    Recipe.objects.filter(tags=instance).touch()
+    DataVersion.objects.bump(DataVersion.TAGS)
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_changed(sender, instance, created, **kwargs):
+    ingredient_cache.invalidate()
+    if not created:
+        Recipe.objects.filter(recipeingredient__ingredient=instance).touch()
+        update_search_vector(recipeingredient__ingredient=instance.pk)
+    DataVersion.objects.bump(DataVersion.INGREDIENTS)
+
+
+@receiver(post_delete, sender=Ingredient)
+def ingredient_deleted(sender, instance, **kwargs):
+    ingredient_cache.invalidate()
+    DataVersion.objects.bump(DataVersion.INGREDIENTS)
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, update_fields, **kwargs):
+    if created or update_fields == frozenset(('last_login',)):
+        return
+    Recipe.objects.filter(author=instance).touch()
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    # Связи пользователя удаляются каскадом без построчной обработки:
+    # счётчики объектов, с которыми он был связан, и версии его
+    # подписчиков обновляются после удаления.
+    deleting.user_ids.add(instance.pk)
+    instance.counted_ids = {
+        source: list(source.objects.filter(user=instance).values_list(
+            f'{COUNTED_RELATIONS[source][2]}_id', flat=True,
+        ))
+        for source in (Favorites, Cart, Follow)
+    }
+    instance.follower_ids = list(
+        Follow.objects.filter(author=instance).values_list(
+            'user_id', flat=True,
+        )
+    )
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    deleting.user_ids.discard(instance.pk)
+    for source, target_ids in getattr(instance, 'counted_ids', {}).items():
+        change_counters(source, target_ids, -1)
+    DataVersion.objects.bump(*map(
+        DataVersion.viewer, getattr(instance, 'follower_ids', ()),
+    ))
+
+
+@receiver(post_save, sender=Favorites)
+@receiver(post_delete, sender=Favorites)
+@receiver(post_save, sender=Cart)
+@receiver(post_delete, sender=Cart)
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def viewer_relation_changed(sender, instance, **kwargs):
+    if is_cascaded(instance):
+        return
+    DataVersion.objects.bump(DataVersion.viewer(instance.user_id))
+
+
+@receiver(post_save, sender=Cart)
+def cart_item_saved(sender, instance, created, **kwargs):
+    if created:
+        ShoppingListItem.objects.add_recipes(
+            instance.user_id, [instance.recipe_id],
+        )
+
+
+@receiver(post_delete, sender=Cart)
+def cart_item_deleted(sender, instance, **kwargs):
+    if is_cascaded(instance):
+        return
+    ShoppingListItem.objects.remove_recipes(
+        instance.user_id, [instance.recipe_id],
+    )
+
+
+@receiver(relations_added, sender=Cart)
+def cart_items_added(sender, user, target_ids, **kwargs):
+    ShoppingListItem.objects.add_recipes(user.id, target_ids)
+
+
+@receiver(relations_removed, sender=Cart)
+def cart_items_removed(sender, user, target_ids, **kwargs):
+    ShoppingListItem.objects.remove_recipes(user.id, target_ids)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=Favorites)
+@receiver(post_save, sender=Cart)
+@receiver(post_save, sender=Follow)
+def counted_relation_saved(sender, instance, created, **kwargs):
+    if created:
+        _, _, field = COUNTED_RELATIONS[sender]
+        change_counters(sender, [getattr(instance, f'{field}_id')], 1)
+
+
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Favorites)
+@receiver(post_delete, sender=Cart)
+@receiver(post_delete, sender=Follow)
+def counted_relation_deleted(sender, instance, **kwargs):
+    if is_cascaded(instance):
+        return
+    _, _, field = COUNTED_RELATIONS[sender]
+    change_counters(sender, [getattr(instance, f'{field}_id')], -1)
+
+
+@receiver(relations_added, sender=Favorites)
+@receiver(relations_added, sender=Cart)
+@receiver(relations_added, sender=Follow)
+def counted_relations_added(sender, target_ids, **kwargs):
+    change_counters(sender, target_ids, 1)
+
+
+@receiver(relations_removed, sender=Favorites)
+@receiver(relations_removed, sender=Cart)
+@receiver(relations_removed, sender=Follow)
+def counted_relations_removed(sender, target_ids, **kwargs):
+    change_counters(sender, target_ids, -1)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_published(sender, instance, created, **kwargs):
+    if created:
+        TimelineEntry.objects.fan_out(instance)
+
+
+@receiver(post_save, sender=Follow)
+def follow_saved(sender, instance, created, **kwargs):
+    if created:
+        TimelineEntry.objects.add_authors(
+            instance.user_id, [instance.author_id],
+        )
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    if is_cascaded(instance):
+        return
+    TimelineEntry.objects.remove_authors(
+        instance.user_id, [instance.author_id],
+    )
+
+
+@receiver(relations_added, sender=Follow)
+def follows_added(sender, user, target_ids, **kwargs):
+    TimelineEntry.objects.add_authors(user.id, target_ids)
+
+
+@receiver(relations_removed, sender=Follow)
+def follows_removed(sender, user, target_ids, **kwargs):
+    TimelineEntry.objects.remove_authors(user.id, target_ids)
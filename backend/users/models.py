@@ -2,11 +2,15 @@ from django.contrib.auth.models import AbstractUser
 from django.db import models
 
 from foodgram_backend import constants
+from foodgram_backend.managers import RelationManager
+from foodgram_backend.mixins import CounterFieldsMixin
 
 
-class User(AbstractUser):
+class User(CounterFieldsMixin, AbstractUser):
     """Модель пользователя."""
 
+    counter_fields = ('recipes_count', 'followers_count')
+
     username = models.CharField(
         verbose_name='Логин',
         max_length=constants.MAX_USERNAME_LENGTH,
@@ -35,6 +39,16 @@ class User(AbstractUser):
         blank=True,
         max_length=100,
     )
+    recipes_count = models.PositiveIntegerField(
+        verbose_name='Количество рецептов',
+        default=0,
+        editable=False,
+    )
+    followers_count = models.PositiveIntegerField(
+        verbose_name='Количество подписчиков',
+        default=0,
+        editable=False,
+    )
 
     class Meta:
         ordering = ('id',)
@@ -67,6 +81,9 @@ class Follow(models.Model):
         verbose_name='Подписан на',
     )
 
+    objects = models.Manager()
+    relations = RelationManager('author')
+
     class Meta:
         constraints = [
             models.UniqueConstraint(
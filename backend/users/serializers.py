@@ -1,3 +1,5 @@
+from api.fieldsets import SparseFieldsetMixin
+from api.viewer import SUBSCRIPTIONS, get_context_viewer
 from djoser.serializers import UserCreateSerializer
 from recipes.serializers import ShortRecipeSerializer
 from rest_framework import serializers
@@ -22,7 +24,7 @@ class CreateUserSerializer(UserCreateSerializer):
         return validate_username(value)
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     is_subscribed = serializers.SerializerMethodField()
 
     class Meta:
@@ -37,10 +39,11 @@ class UserSerializer(serializers.ModelSerializer):
         )
 
     def get_is_subscribed(self, obj):
-        request = self.context.get('request')
-        if not request or request.user.is_anonymous:
-            return False
-        return Follow.objects.filter(user=request.user, author=obj).exists()
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
+        return get_context_viewer(self.context).contains(
+            SUBSCRIPTIONS, obj.pk,
+        )
 
 
 class FollowSerializer(serializers.ModelSerializer):
@@ -51,30 +54,42 @@ class FollowSerializer(serializers.ModelSerializer):
     last_name = serializers.ReadOnlyField(source='author.last_name')
     is_subscribed = serializers.SerializerMethodField()
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.ReadOnlyField(source='author.recipes.count')
+    recipes_count = serializers.ReadOnlyField(source='author.recipes_count')
 
     class Meta:
         model = Follow
         fields = ('email', 'id', 'username', 'first_name',
                   'last_name', 'is_subscribed', 'recipes', 'recipes_count')
 
+    @staticmethod
+    def get_recipes_limit(request):
+        limit = request.query_params.get('recipes_limit')
+        if not limit:
+            return None
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            raise serializers.ValidationError(
+                {'recipes_limit': 'Ожидается неотрицательное целое число'}
+            )
+        return limit
+
     def get_recipes(self, obj):
-        request = self.context.get('request')
-        limit = request.GET.get('recipes_limit')
-        recipes = obj.author.recipes.all()
-        if limit:
-            recipes = recipes[:int(limit)]
+        previews = self.context.get('recipe_previews')
+        if previews is not None:
+            recipes = previews[obj.author_id]
+        else:
+            limit = self.get_recipes_limit(self.context['request'])
+            recipes = obj.author.recipes.order_by('-pub_date', '-id')
+            if limit is not None:
+                recipes = recipes[:limit]
         serializer = ShortRecipeSerializer(recipes, many=True, read_only=True)
         return serializer.data
 
     def get_is_subscribed(self, obj):
-        user = self.context.get('request').user
-        if not user.is_anonymous:
-            return Follow.objects.filter(
-                user=obj.user,
-                author=obj.author
-            ).exists()
-        return False
+        return obj.user_id == self.context.get('request').user.id
 
     def validate(self, data):
         user = self.context['request'].user
@@ -1,7 +1,13 @@
+from django.db.models import BooleanField, Exists, OuterRef, Value
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 
-from api.paginations import CustomPagination
+from api.batch import SELF, batch_add, batch_remove, get_batch_results
+from api.fieldsets import get_requested_fields
+from api.paginations import ApproximateCountPagination
+from api.serializers import IdListSerializer
 from djoser.views import UserViewSet
+from recipes.models import Recipe
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.permissions import (IsAuthenticated,
@@ -11,14 +17,36 @@ from users.models import Follow, User
 from users.serializers import FollowSerializer, UserSerializer
 
 
+def get_author_id(id):
+    """Id автора из url в виде числа: '05' и '5' — один и тот же автор."""
+    try:
+        return int(id)
+    except ValueError:
+        raise Http404
+
+
 class CustomUserViewSet(UserViewSet):
     """Вьюсет с обработкой url содержащих me, subscribe, subscriptions."""
 
     queryset = User.objects.all()
     serializer_class = UserSerializer
-    pagination_class = CustomPagination
+    pagination_class = ApproximateCountPagination
     permission_classes = (IsAuthenticatedOrReadOnly,)
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        user = self.request.user
+        fields = get_requested_fields(self.request, ('is_subscribed',))
+        if not fields:
+            return queryset
+        if user.is_anonymous:
+            return queryset.annotate(
+                is_subscribed=Value(False, output_field=BooleanField())
+            )
+        return queryset.annotate(is_subscribed=Exists(
+            Follow.objects.filter(user=user, author=OuterRef('pk'))
+        ))
+
     @action(
         methods=('GET',),
         url_path='me',
@@ -36,12 +64,19 @@ class CustomUserViewSet(UserViewSet):
         permission_classes=(IsAuthenticated,),
     )
     def read_subscribe(self, request):
-        user = request.user
-        subscriptions = Follow.objects.filter(user=user)
-        page = self.paginate_queryset(subscriptions)
-        serializer = FollowSerializer(
-            page, many=True, context={'request': request},
+        limit = FollowSerializer.get_recipes_limit(request)
+        subscriptions = (
+            Follow.objects.filter(user=request.user)
+            .select_related('author')
+            .order_by('id')
         )
+        page = self.paginate_queryset(subscriptions)
+        serializer = FollowSerializer(page, many=True, context={
+            'request': request,
+            'recipe_previews': Recipe.objects.get_previews(
+                [subscription.author_id for subscription in page], limit,
+            ),
+        })
         return self.get_paginated_response(serializer.data)
 
     @action(
@@ -52,17 +87,20 @@ class CustomUserViewSet(UserViewSet):
     )
     def subscribe(self, request, id=None):
         user = request.user
-        author = get_object_or_404(User, id=id)
-        if user == author:
+        id = get_author_id(id)
+        # Ответ строится после вставки, поэтому параметры ответа
+        # проверяются заранее, чтобы ошибка не оставила подписку.
+        FollowSerializer.get_recipes_limit(request)
+        if user.id == id:
             return Response({
                 'errors': 'Вы не можете подписываться на самого себя'
             }, status=status.HTTP_400_BAD_REQUEST)
-        if Follow.objects.filter(user=user, author=author).exists():
+        subscription = Follow.relations.add(user, id)
+        if subscription is None:
+            get_object_or_404(User, id=id)
             return Response({
                 'errors': 'Вы уже подписаны на данного пользователя'
             }, status=status.HTTP_400_BAD_REQUEST)
-        subscription = Follow.objects.create(
-            user=user, author=author)
         serializer = FollowSerializer(
             subscription,
             context={'request': request},
@@ -71,9 +109,36 @@ class CustomUserViewSet(UserViewSet):
 
     @subscribe.mapping.delete
     def delete_subscribe(self, request, id=None):
-        user = request.user
-        author = self.get_object()
-        if Follow.objects.filter(user=user, author=author).exists():
-            Follow.objects.get(user=user, author=author).delete()
+        id = get_author_id(id)
+        if Follow.relations.remove(request.user, id):
             return Response(status=status.HTTP_204_NO_CONTENT)
+        get_object_or_404(User, id=id)
         return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    @action(
+        methods=('POST',),
+        url_path='subscribe',
+        detail=False,
+        permission_classes=(IsAuthenticated,),
+    )
+    def subscribe_many(self, request):
+        serializer = IdListSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        statuses = batch_add(
+            Follow, request.user,
+            User.objects.exclude(id=request.user.id),
+            serializer.validated_data['ids'],
+        )
+        if request.user.id in statuses:
+            statuses[request.user.id] = SELF
+        return Response(get_batch_results(statuses))
+
+    @subscribe_many.mapping.delete
+    def delete_many_subscribe(self, request):
+        serializer = IdListSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        statuses = batch_remove(
+            Follow, request.user, User.objects,
+            serializer.validated_data['ids'],
+        )
+        return Response(get_batch_results(statuses))